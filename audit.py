@@ -1,4 +1,8 @@
 
+import gzip
+import hashlib
+import json
+import os
 import time
 
 class AuditLogger:
@@ -17,6 +21,101 @@ class AuditLogger:
             except Exception as e:
                 print(f"[ERROR] Failed to write audit log: {e}")
 
+
+class AuditArchive:
+    """Append-only store of audit rows rolled out of the database.
+
+    Each segment is a gzip-compressed JSON Lines file covering a contiguous id range.
+    manifest.json lists the segments in the order written (id order, unless the database
+    was recreated) with their time range and SHA-256,
+    so readers can skip segments by time and detect tampering or corruption.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory="audit_archive"):
+        self.directory = directory
+        self.segments = self._load_manifest()
+
+    def _load_manifest(self):
+        path = os.path.join(self.directory, self.MANIFEST)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self):
+        path = os.path.join(self.directory, self.MANIFEST)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.segments, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _sha256(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def write_segment(self, rows):
+        """Archives (id, event_type, details, timestamp, ip_address) rows, sorted by id."""
+        if not rows:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"audit-{rows[0][0]:012d}-{rows[-1][0]:012d}.jsonl.gz"
+        path = os.path.join(self.directory, name)
+        suffix = 1
+        while os.path.exists(path):
+            # Ids restart when the database is recreated; never overwrite an older segment
+            suffix += 1
+            name = f"audit-{rows[0][0]:012d}-{rows[-1][0]:012d}-{suffix}.jsonl.gz"
+            path = os.path.join(self.directory, name)
+        with gzip.open(path + ".tmp", 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps({'id': row[0], 'event_type': row[1], 'details': row[2],
+                                    'timestamp': row[3], 'ip_address': row[4]}) + "\n")
+        os.replace(path + ".tmp", path)
+        segment = {
+            'file': name,
+            'first_id': rows[0][0],
+            'last_id': rows[-1][0],
+            'first_ts': min(row[3] for row in rows),
+            'last_ts': max(row[3] for row in rows),
+            'count': len(rows),
+            'sha256': self._sha256(path),
+        }
+        # The manifest is written last: a segment only counts once it is listed
+        self.segments.append(segment)
+        self._save_manifest()
+        return segment
+
+    def verify(self, segment) -> bool:
+        path = os.path.join(self.directory, segment['file'])
+        return os.path.exists(path) and self._sha256(path) == segment['sha256']
+
+    def iter_records(self, since=None, until=None, event_type=None, ip_address=None):
+        """Streams archived rows oldest first as (id, event_type, details, timestamp, ip_address).
+        Raises ValueError if a segment fails its checksum."""
+        for segment in list(self.segments):
+            if since is not None and segment['last_ts'] < since:
+                continue
+            if until is not None and segment['first_ts'] > until:
+                continue
+            if not self.verify(segment):
+                raise ValueError(f"Audit archive segment {segment['file']} failed checksum verification")
+            with gzip.open(os.path.join(self.directory, segment['file']), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if since is not None and record['timestamp'] < since:
+                        continue
+                    if until is not None and record['timestamp'] > until:
+                        continue
+                    if event_type is not None and record['event_type'] != event_type:
+                        continue
+                    if ip_address is not None and record['ip_address'] != ip_address:
+                        continue
+                    yield (record['id'], record['event_type'], record['details'], record['timestamp'], record['ip_address'])
+
 # Global logger instance will be initialized in main app
 _logger = None
 
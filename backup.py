@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+import audit
+
+
+class BackupScheduler:
+    """Takes online database backups on a schedule and keeps the newest few.
+
+    Backups are named by time, so the schedule survives restarts: the age of the newest
+    file decides when the next one is due. Each backup has a copy of the key file next
+    to it (<name>.db.key), taken with the snapshot; restore the two together.
+    """
+    CHECK_INTERVAL = 300  # Seconds between checks whether a backup is due
+    PREFIX = "lan_messenger-"
+    SUFFIX = ".db"
+
+    def __init__(self, db, directory="backups", interval_hours: float = 24, keep: int = 7):
+        self.db = db
+        self.directory = directory
+        self.interval = interval_hours * 3600
+        self.keep = keep
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            return  # Scheduled backups disabled
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def list_backups(self):
+        """Backup file paths, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith(self.PREFIX) and n.endswith(self.SUFFIX))
+        return [os.path.join(self.directory, n) for n in names]
+
+    def _is_due(self) -> bool:
+        backups = self.list_backups()
+        return not backups or time.time() - os.path.getmtime(backups[-1]) >= self.interval
+
+    def _run(self):
+        # Checked immediately, then periodically
+        while True:
+            if self._is_due():
+                try:
+                    self.run_backup()
+                except Exception as e:
+                    print(f"[DEBUG] Backup failed: {e}")
+                    logger = audit.get_logger()
+                    if logger: logger.log("DB_BACKUP", f"Scheduled backup failed: {e}")
+            if self._stop.wait(self.CHECK_INTERVAL):
+                break
+
+    def run_backup(self) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{self.PREFIX}{time.strftime('%Y%m%d-%H%M%S')}{self.SUFFIX}"
+        result = self.db.backup_to(os.path.join(self.directory, name))
+        removed = self._rotate()
+        print(f"[DEBUG] Backup written to {result['path']} in {result['seconds']:.2f}s")
+        logger = audit.get_logger()
+        if logger:
+            logger.log("DB_BACKUP", f"Verified backup {name} ({result['bytes'] / 1024:.1f} KB), "
+                                    f"{len(removed)} old backups rotated out.")
+        return result
+
+    def _rotate(self):
+        """Deletes all but the newest *keep* backups. Returns the removed paths."""
+        backups = self.list_backups()
+        removed = backups[:-self.keep] if self.keep > 0 else []
+        for path in removed:
+            os.remove(path)
+            if os.path.exists(path + ".key"):
+                os.remove(path + ".key")
+        return removed
@@ -0,0 +1,92 @@
+import hashlib
+
+# Shares are hashed in leaves of this size; GET_CHUNK_HASHES reports it with the leaves
+CHUNK_SIZE = 1024 * 1024
+LEAF_SIZE = 32  # Bytes per leaf: a raw SHA-256 digest
+
+
+def hash_file(path, chunk_size: int = CHUNK_SIZE):
+    """Reads *path* once and returns (sha256 hex digest, leaves), the leaves being the
+    concatenated SHA-256 digests of each *chunk_size* piece."""
+    whole = hashlib.sha256()
+    leaves = bytearray()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            whole.update(chunk)
+            leaves += hashlib.sha256(chunk).digest()
+    return whole.hexdigest(), bytes(leaves)
+
+
+def merkle_root(leaves: bytes) -> str:
+    """Hex root of the binary hash tree over *leaves*; an odd node is carried up unchanged."""
+    level = [leaves[i:i + LEAF_SIZE] for i in range(0, len(leaves), LEAF_SIZE)]
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        paired = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0].hex()
+
+
+def leaf_count(size: int, chunk_size: int = CHUNK_SIZE) -> int:
+    return -(-size // chunk_size)
+
+
+class ChunkMismatch(ValueError):
+    """A received chunk does not match its leaf hash."""
+    def __init__(self, index: int, offset: int):
+        super().__init__(f"Chunk {index} at offset {offset} failed verification")
+        self.index = index
+        self.offset = offset
+
+
+class ChunkVerifier:
+    """Checks data received in order, from *offset*, against the leaf hashes of a *size*-byte file.
+
+    feed() holds each chunk back until it is complete and matches its leaf, so bad data
+    never reaches the disk; it raises ChunkMismatch with the offset to re-fetch from.
+    Bytes outside whole chunks (an unaligned start, or a range ending mid-chunk, see
+    flush) pass through unchecked and are left to the whole-file checksum.
+    """
+
+    def __init__(self, leaves: bytes, chunk_size: int, size: int, offset: int = 0):
+        self.leaves = leaves
+        self.chunk_size = chunk_size
+        self.size = size
+        self.position = offset  # Offset of the next byte fed
+        self._aligned = offset % chunk_size == 0
+        self._pending = bytearray()  # The current chunk so far
+
+    def feed(self, data) -> bytes:
+        """Takes the next received bytes and returns those now ready to be written."""
+        released = []
+        view = memoryview(data)
+        while view:
+            boundary = min((self.position // self.chunk_size + 1) * self.chunk_size, self.size)
+            n = min(len(view), boundary - self.position)
+            if n <= 0:
+                raise ValueError("Received data past the end of the file")
+            part, view = view[:n], view[n:]
+            self.position += n
+            if not self._aligned:
+                released.append(bytes(part))
+                self._aligned = self.position == boundary
+                continue
+            self._pending += part
+            if self.position == boundary:
+                index = (self.position - 1) // self.chunk_size
+                if hashlib.sha256(self._pending).digest() != self.leaves[index * LEAF_SIZE:(index + 1) * LEAF_SIZE]:
+                    offset = self.position - len(self._pending)
+                    self._pending.clear()
+                    raise ChunkMismatch(index, offset)
+                released.append(bytes(self._pending))
+                self._pending.clear()
+        return b"".join(released)
+
+    def flush(self) -> bytes:
+        """Releases a partial chunk held back when the received range ends mid-chunk."""
+        data = bytes(self._pending)
+        self._pending.clear()
+        return data
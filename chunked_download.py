@@ -0,0 +1,402 @@
+import os
+import threading
+import time
+import audit
+from hash_index import HashIndex, RunningHash
+from chunk_hashes import ChunkMismatch, ChunkVerifier
+
+
+class RangeNotSupported(Exception):
+    """The peer ignored a PULL_FILE range (an older version)."""
+
+
+class _Superseded(Exception):
+    """Another stream finished the range first (endgame duplicate)."""
+
+
+class ChunkedDownloader:
+    """Fetches one large file as byte ranges over several parallel connections, from one
+    peer or from every peer sharing the same content (swarm mode).
+
+    Ranges are handed out from a shared work list, so faster streams simply take more
+    of them, and written in place with os.pwrite into a preallocated <name>.part file.
+    Completed ranges are recorded in the same .part.json sidecar FileTransferManager
+    uses, so an interrupted transfer resumes either way. The stream count starts at one
+    per source (at least two) and grows while each added stream still raises aggregate
+    throughput, up to *max_streams*; new streams go to the fastest source. A source that
+    keeps failing is dropped and its ranges go to the others. Once no work is left,
+    idle streams duplicate ranges still in flight on other sources (endgame), so one
+    slow peer cannot hold up the end of the transfer.
+
+    The file is hashed in order as it arrives: data written at the hash frontier goes
+    straight into the digest, and ranges that completed ahead of it are read back with
+    os.pread once the frontier reaches them, so the file is never re-read in full.
+    With the share's chunk hashes, each chunk is checked before it is written; a bad one
+    ends that stream's range there and only the rest of the range is fetched again.
+    """
+    RANGE_SIZE = 8 * 1024 * 1024
+    # Files smaller than this are not worth more than one stream
+    MIN_SIZE = 32 * 1024 * 1024
+    INITIAL_STREAMS = 2
+    SAMPLE_INTERVAL = 1.0  # Seconds between throughput samples
+    GAIN_THRESHOLD = 1.1  # Keep adding streams while each one adds at least 10%
+
+    def __init__(self, manager, sources, local_path, size, expected_checksum=None,
+                 max_streams=4, port=None, progress=None, chunks=None):
+        """*manager* is the FileTransferManager whose connections and sidecar helpers are used.
+        *sources* lists (peer_ip, remote_path) pairs serving identical content.
+        *progress(received, size)* is called from the stream threads as data arrives.
+        *chunks* is (chunk_size, leaves) from FileTransferManager.get_chunk_hashes, if known."""
+        self.manager = manager
+        self.sources = [{'ip': ip, 'path': path, 'alive': True, 'error': None, 'bytes': 0, 'seconds': 0.0}
+                        for ip, path in sources]
+        self.remote_path = self.sources[0]['path']
+        self.local_path = str(local_path)
+        self.size = size
+        self.expected_checksum = expected_checksum
+        self.max_streams = max(1, max_streams)
+        self.port = port
+        self.progress = progress
+        self.chunks = chunks
+        self.stats = None  # Aggregate, per-stream and per-source throughput of the last run
+        self._lock = threading.Lock()
+        self._pending = []  # (start, end) ranges not yet taken
+        self._done = set()  # (start, end) ranges written
+        self._done_bytes = 0
+        self._in_flight = {}  # (start, end) -> {stream index: bytes written so far}
+        self._stream_stats = []  # Per stream: {'source', 'bytes', 'seconds'}
+        self._workers = []
+        self._fd = None
+        self._digest = RunningHash()  # Covers bytes [0, self._digest.length) of the file
+        self._hash_lock = threading.Lock()
+        self._rehash = False  # Reading a range back failed; verify by hashing the whole file
+
+    def _plan(self):
+        """Splits whatever the sidecar does not record as done into RANGE_SIZE pieces."""
+        state = self.manager._load_partial(self.local_path, self.remote_path, self.expected_checksum)
+        done = []
+        if state and state.get('size') == self.size:
+            done = sorted(tuple(r) for r in state.get('done') or [(0, state['received'])] if r[1] > r[0])
+        pending = []
+        position = 0
+        for start, end in done + [(self.size, self.size)]:
+            while position < start:
+                pending.append((position, min(position + self.RANGE_SIZE, start)))
+                position = pending[-1][1]
+            position = max(position, end)
+        self._done = set(done)
+        self._pending = pending
+        self._done_bytes = sum(end - start for start, end in done)
+
+    def _open_part(self):
+        self._fd = os.open(self.local_path + ".part", os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        if os.fstat(self._fd).st_size != self.size:
+            if hasattr(os, 'posix_fallocate') and self.size:
+                try:
+                    os.posix_fallocate(self._fd, 0, self.size)
+                except OSError:
+                    pass  # Not supported by this filesystem; ftruncate still sizes the file
+            os.ftruncate(self._fd, self.size)
+
+    def _write_at(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self._fd, data, offset)
+        else:
+            # No positional writes on this platform (Windows); serialize seek + write
+            with self._lock:
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                os.write(self._fd, data)
+
+    def _save_progress(self):
+        with self._lock:
+            done = sorted(self._done)
+        received = 0  # Contiguous prefix, for a single-stream resume
+        for start, end in done:
+            if start > received:
+                break
+            received = max(received, end)
+        self.manager._save_partial(self.local_path, {
+            'peer': self.sources[0]['ip'], 'path': self.remote_path, 'checksum': self.expected_checksum,
+            'size': self.size, 'received': received, 'done': done,
+        })
+
+    def _received(self):
+        """Bytes written so far, counting each in-flight range once. Call with the lock held."""
+        return self._done_bytes + sum(max(progress.values(), default=0) for progress in self._in_flight.values())
+
+    def _take_range(self, index):
+        with self._lock:
+            source = self.sources[self._stream_stats[index]['source']]
+            if not source['alive']:
+                return None
+            if self._pending:
+                piece = self._pending.pop(0)
+            else:
+                # Endgame: help with the range furthest from done that no stream of ours is on
+                candidates = [(piece[1] - piece[0] - max(progress.values(), default=0), piece)
+                              for piece, progress in self._in_flight.items()
+                              if not any(self._stream_stats[i]['source'] == self._stream_stats[index]['source'] for i in progress)]
+                if not candidates:
+                    return None
+                piece = max(candidates)[1]
+            self._in_flight.setdefault(piece, {})[index] = 0
+            return piece
+
+    def _fetch_range(self, index, piece):
+        stats = self._stream_stats[index]
+        source = self.sources[stats['source']]
+        start, end = piece
+        with self.manager._connect(source['ip'], self.port) as s:
+            resp = self.manager._open_pull(s, source['path'], start, end - start)
+            if resp.get('offset', 0) != start or resp.get('length') != end - start:
+                raise RangeNotSupported("Peer does not support ranged downloads")
+            verifier = ChunkVerifier(self.chunks[1], self.chunks[0], self.size, start) if self.chunks else None
+            position = start  # Next byte to write; verified chunks lag what has been received
+            received = start
+            while received < end:
+                data = s.recv(min(65536, end - received))
+                if not data:
+                    raise ConnectionError("Connection closed prematurely")
+                received += len(data)
+                with self._lock:
+                    if piece in self._done:
+                        raise _Superseded()
+                if verifier:
+                    data = verifier.feed(data)
+                    if received == end:
+                        data += verifier.flush()
+                    if not data:
+                        continue
+                self._store(data, position)
+                position += len(data)
+                with self._lock:
+                    progress = self._in_flight.get(piece)
+                    if progress is None:
+                        raise _Superseded()
+                    progress[index] = position - start
+                    stats['bytes'] += len(data)
+                    source['bytes'] += len(data)
+                    total = self._received()
+                if self.progress:
+                    try:
+                        self.progress(total, self.size)
+                    except Exception as e:
+                        print(f"[DEBUG] Progress callback error for {self.remote_path}: {e}")
+
+    def _store(self, data, offset):
+        """Writes received data in place, feeding the digest when it lands on the hash frontier.
+        Bytes below the frontier (a retried or duplicated range) are already hashed and are
+        left as they are, so the digest always matches the file."""
+        with self._hash_lock:
+            if self._fd is None:
+                # run() has finished; a stream that was superseded must not touch a reused fd
+                raise _Superseded()
+            hashed = self._digest.length - offset
+            if hashed >= len(data):
+                return
+            if hashed > 0:
+                data, offset = data[hashed:], self._digest.length
+            self._write_at(data, offset)
+            if offset == self._digest.length and not self._rehash:
+                self._digest.update(data)
+
+    def _advance_hash(self):
+        """Moves the hash frontier through ranges that completed ahead of it, reading them back."""
+        with self._hash_lock:
+            while not self._rehash and self._fd is not None:
+                position = self._digest.length
+                with self._lock:
+                    end = max((end for start, end in self._done if start <= position < end), default=None)
+                if end is None:
+                    return
+                try:
+                    while position < end:
+                        data = self._read_at(min(HashIndex.BLOCK_SIZE, end - position), position)
+                        if not data:
+                            raise OSError(f"{self.local_path}.part is shorter than expected")
+                        self._digest.update(data)
+                        position += len(data)
+                except OSError as e:
+                    # The digest no longer matches an offset; _finish_download reads the file back instead
+                    print(f"[DEBUG] Hashing {self.local_path}.part in place failed: {e}")
+                    self._rehash = True
+                    return
+
+    def _read_at(self, size, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, size, offset)
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, size)
+
+    def _release(self, index, piece, finished, good_until=None):
+        """Takes stream *index* off *piece*; requeues the piece if nobody else is on it.
+        *good_until* is where a bad chunk was found: the verified head is kept and only
+        the rest is requeued."""
+        with self._lock:
+            progress = self._in_flight.get(piece)
+            if progress is None:
+                # Another stream already finished the piece, or split it after a bad chunk;
+                # this stream's copy (seen as _Superseded) must not mark it done again
+                return
+            progress.pop(index, None)
+            if finished and piece not in self._done:
+                self._done.add(piece)
+                self._done_bytes += piece[1] - piece[0]
+                self._in_flight.pop(piece, None)
+            elif good_until is not None and piece not in self._done:
+                # Other streams on this piece see it gone and stop
+                self._in_flight.pop(piece, None)
+                if good_until > piece[0]:
+                    self._done.add((piece[0], good_until))
+                    self._done_bytes += good_until - piece[0]
+                self._pending.insert(0, (good_until, piece[1]))
+            elif not progress and piece not in self._done:
+                self._in_flight.pop(piece, None)
+                self._pending.insert(0, piece)
+
+    def _worker(self, index):
+        stats = self._stream_stats[index]
+        source = self.sources[stats['source']]
+        attempts = 0
+        backoff = self.manager.RESUME_BACKOFF
+        while True:
+            piece = self._take_range(index)
+            if piece is None:
+                return
+            began = time.perf_counter()
+            error, fatal = None, False
+            try:
+                self._fetch_range(index, piece)
+            except _Superseded:
+                pass
+            except ChunkMismatch as e:
+                self.manager._report_bad_chunk(os.path.basename(self.local_path), source['ip'], e)
+                error = e
+            except (OSError, ValueError) as e:
+                # Resets, timeouts and TLS errors: put the range back and retry
+                error = e
+            except Exception as e:
+                # Refused, or ranges unsupported: this source cannot serve the file
+                error, fatal = e, True
+            finally:
+                elapsed = time.perf_counter() - began
+                stats['seconds'] += elapsed
+                source['seconds'] += elapsed
+            self._release(index, piece, finished=error is None,
+                          good_until=error.offset if isinstance(error, ChunkMismatch) else None)
+            if error is None:
+                attempts, backoff = 0, self.manager.RESUME_BACKOFF
+                self._save_progress()
+                self._advance_hash()
+                continue
+            attempts += 1
+            if fatal or attempts > self.manager.RESUME_ATTEMPTS:
+                print(f"[DEBUG] Dropping source {source['ip']} for {self.remote_path}: {error}")
+                with self._lock:
+                    source['alive'] = False
+                    source['error'] = error
+                return
+            print(f"[DEBUG] Stream {index} lost range {piece[0]}-{piece[1]} from {source['ip']} ({error}); retrying")
+            time.sleep(backoff)
+            backoff *= 2
+
+    def _add_stream(self, source_index):
+        self._stream_stats.append({'source': source_index, 'bytes': 0, 'seconds': 0.0})
+        worker = threading.Thread(target=self._worker, args=(len(self._stream_stats) - 1,), daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _fastest_source(self):
+        """Index of the live source with the best per-stream throughput so far."""
+        with self._lock:
+            live = [(source['bytes'] / source['seconds'] if source['seconds'] else 0, i)
+                    for i, source in enumerate(self.sources) if source['alive']]
+        return max(live)[1] if live else None
+
+    def _report(self, elapsed):
+        def rate(item):
+            return round(item['bytes'] * 8 / item['seconds'] / 1e6, 1) if item['seconds'] else 0.0
+        streams = [{'stream': i, 'source': self.sources[st['source']]['ip'], 'bytes': st['bytes'],
+                    'seconds': round(st['seconds'], 3), 'mbps': rate(st)}
+                   for i, st in enumerate(self._stream_stats)]
+        sources = [{'source': source['ip'], 'bytes': source['bytes'], 'mbps': rate(source), 'alive': source['alive']}
+                   for source in self.sources]
+        total = sum(st['bytes'] for st in self._stream_stats)
+        self.stats = {'bytes': total, 'seconds': round(elapsed, 3),
+                      'mbps': round(total * 8 / elapsed / 1e6, 1) if elapsed else 0.0,
+                      'streams': streams, 'sources': sources}
+        print(f"[DEBUG] {self.remote_path}: {self.stats['mbps']} Mbit/s over {len(streams)} streams "
+              f"({', '.join(str(st['mbps']) for st in streams)} Mbit/s each) from {len(sources)} sources")
+
+    def _wait(self, timeout):
+        """Waits up to *timeout* seconds for the streams. Returns True while any is running."""
+        deadline = time.monotonic() + timeout
+        for worker in list(self._workers):
+            worker.join(max(0, deadline - time.monotonic()))
+        return any(worker.is_alive() for worker in self._workers)
+
+    def run(self) -> bool:
+        """Downloads and verifies the file. Returns True on success; on failure the .part file
+        and sidecar are kept for a later resume. Raises RangeNotSupported when the only source
+        cannot serve ranges, so the caller can fall back to a single stream."""
+        self._plan()
+        self._open_part()
+        start = time.perf_counter()
+        try:
+            # A resumed file's existing prefix is hashed once, so new data can follow it in order
+            self._advance_hash()
+            initial = min(max(self.INITIAL_STREAMS, len(self.sources)), self.max_streams, max(1, len(self._pending)))
+            for i in range(initial):
+                self._add_stream(i % len(self.sources))
+            with self._lock:
+                last_bytes = self._received()
+            last_time, last_rate, growing = time.perf_counter(), None, True
+            while True:
+                if not self._wait(self.SAMPLE_INTERVAL):
+                    # Every stream has stopped; ranges left behind by a dropped source go to a live one
+                    fastest = self._fastest_source()
+                    if not self._pending or fastest is None:
+                        break
+                    self._add_stream(fastest)
+                    continue
+                now = time.perf_counter()
+                with self._lock:
+                    current, work_left = self._received(), len(self._pending)
+                    if not work_left and not self._in_flight:
+                        break  # Streams still backing off from a failing source have nothing left to do
+                rate = (current - last_bytes) / (now - last_time)
+                last_bytes, last_time = current, now
+                if growing and work_left and len(self._workers) < self.max_streams:
+                    if last_rate is None or rate >= last_rate * self.GAIN_THRESHOLD:
+                        fastest = self._fastest_source()
+                        if fastest is not None:
+                            self._add_stream(fastest)
+                        last_rate = rate
+                    else:
+                        growing = False  # Throughput has leveled off; stay at this count
+            if not self._pending and not self._in_flight:
+                self._advance_hash()
+        finally:
+            # Streams superseded in the endgame may still be running; they check for this under the lock
+            with self._hash_lock:
+                os.close(self._fd)
+                self._fd = None
+            self._report(time.perf_counter() - start)
+
+        if self._pending or self._in_flight:
+            errors = [source['error'] for source in self.sources]
+            if len(self.sources) == 1 and isinstance(errors[0], RangeNotSupported):
+                raise errors[0]
+            self._save_progress()
+            print(f"[DEBUG] Parallel download of {self.remote_path} incomplete ({errors}); kept for a later resume")
+            return False
+        logger = audit.get_logger()
+        if logger:
+            peers = ", ".join(source['ip'] for source in self.sources)
+            logger.log("FILE_TRANSFER", f"Downloaded '{self.remote_path}' from {peers} over "
+                                        f"{len(self._stream_stats)} streams at {self.stats['mbps']} Mbit/s.")
+        digest = None
+        if self._digest.length == self.size and not self._rehash:
+            digest = self._digest.hexdigest()
+        return self.manager._finish_download(self.local_path, self.expected_checksum, digest)
@@ -9,7 +9,22 @@ DEFAULT_SETTINGS = {
     "tcp_file_port": 12346,
     "bind_ip": "0.0.0.0",
     "auth_token": "",  # empty means no auth
-    "allowed_ips": []  # empty list means allow all
+    "allowed_ips": [],  # empty list means allow all
+    "tombstone_retention_days": 7,  # deleted messages are kept this long so peers stay in sync
+    "maintenance_idle_seconds": 120,  # database maintenance only runs after this much inactivity
+    "audit_retention_days": 90,  # older audit records move to compressed archive segments (0 = keep)
+    "audit_max_rows": 50000,  # cap on audit records kept in the database (0 = no cap)
+    "backup_interval_hours": 24,  # online database backups (0 = disabled)
+    "backup_keep": 7,  # number of backups kept in backup_dir
+    "backup_dir": "backups",
+    "session_unlock_minutes": 0,  # opt-in: after an inactivity lock, unlock from a sealed in-memory keyring for this long (0 = off)
+    "warmup_conversations": 5,  # private chats preloaded in the background after unlock
+    "retention_max_messages": 0,  # history kept per conversation (0 = no limit); expired messages go first
+    "retention_max_age_days": 0,  # messages older than this are pruned (0 = keep)
+    "retention_max_mb": 0,  # stored history per conversation (0 = no limit)
+    "retention_total_mb": 0,  # stored history across all conversations (0 = no limit)
+    "retention_overrides": {},  # peer IP ("*" = global chat) -> {"max_messages", "max_age_days", "max_mb"}
+    "download_streams": 4  # most parallel connections for one large download (1 = single stream)
 }
 
 SETTINGS_FILE = "settings.json"
@@ -3,36 +3,176 @@ import uuid
 import time
 import threading
 import os
+import shutil
 import base64
-import functools
+import binascii
+from collections import OrderedDict
 from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
+from history_cache import HistoryCache, MessageRecord
+from chunk_hashes import merkle_root
+
+# Stored ciphertext is a BLOB: key generation (1 byte) + nonce (12 bytes) + AES-GCM ciphertext.
+# Generation 1 is the original data key; each key rotation adds the next one.
+CIPHERTEXT_VERSION = 1
+MAX_KEY_GENERATION = 255
+# Key file holding more than one data key: magic + salt(16) + nonce(12) + AES-GCM(keyring payload)
+KEYRING_MAGIC = b"LMKR\x01"
+# Older releases stored "enc:" + base64(nonce + ciphertext) as TEXT.
+LEGACY_CIPHERTEXT_PREFIX = "enc:"
+
+# Columns that hold EncryptionManager output, per table.
+ENCRYPTED_COLUMNS = {
+    'messages': ('content',),
+    'files': ('filename', 'path'),
+    'app_config': ('value',),
+}
+
+
+def _ciphertext_tag(value):
+    """Short identifier of a ciphertext (its format byte and random nonce)."""
+    return value[:13] if isinstance(value, bytes) else value[:24]
+
+
+class DecryptCache:
+    """LRU/TTL cache of decrypted values keyed by row identity, e.g. ('messages', msg_id, 'content').
+    Memory is bounded by a byte budget. Plaintext is kept in bytearrays so it can be zeroed
+    when evicted, invalidated or wiped. Each entry remembers the tag of the ciphertext it came
+    from, so a row that was rewritten never returns stale plaintext."""
+    ENTRY_OVERHEAD = 128  # Rough per-entry bookkeeping cost counted against the budget
+
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024, ttl: float = 900):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (tag, bytearray, expires_at)
+        self._rows = {}  # (table, row_id) -> set of keys
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _discard(self, key):
+        tag, buf, _ = self._entries.pop(key)
+        self.size -= len(buf) + self.ENTRY_OVERHEAD
+        buf[:] = bytes(len(buf))
+        row = key[:2]
+        keys = self._rows.get(row)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._rows[row]
+
+    def get(self, key, tag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != tag or entry[2] < time.monotonic():
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1].decode()
+
+    def put(self, key, tag, plaintext: str):
+        buf = bytearray(plaintext.encode())
+        cost = len(buf) + self.ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (tag, buf, time.monotonic() + self.ttl)
+            self._rows.setdefault(key[:2], set()).add(key)
+            self.size += cost
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, table: str, row_id):
+        """Drops every cached column of one row."""
+        with self._lock:
+            for key in list(self._rows.get((table, row_id), ())):
+                self._discard(key)
+
+    def wipe(self):
+        """Zeroes and drops all cached plaintext."""
+        with self._lock:
+            for _, buf, _ in self._entries.values():
+                buf[:] = bytes(len(buf))
+            self._entries.clear()
+            self._rows.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
 
 class EncryptionManager:
-    def __init__(self, key_file=None, password=None):
+    # Row sets at least this large are decrypted across a worker pool
+    PARALLEL_DECRYPT_THRESHOLD = 256
+    DECRYPT_BATCH_SIZE = 128
+    KDF_ITERATIONS = 600000
+
+    def __init__(self, key_file=None, password=None, session_minutes: float = 0):
         self.key_file = key_file or ".master.key"
-        self.key = None
+        # > 0 lets lock(keep_session=True) be undone within this many minutes from memory
+        self.session_minutes = session_minutes
+        self._session = None  # (wrap salt, sealed keys, expires_at) while locked with a session
+        self.key = None  # Active data key
         self.aesgcm = None
+        self.generation = CIPHERTEXT_VERSION  # Generation of the active key
+        self._keyring = {}  # generation -> AESGCM, every key still needed to decrypt
+        self._raw_keys = {}  # generation -> key bytes, for re-saving the key file
+        # Password-derived wrapping key, kept while unlocked so the keyring can be re-saved
+        self._wrap_key = None
+        self._wrap_salt = None
+        self._decrypt_pool = None
+        self._decrypt_pool_lock = threading.Lock()
+        self.cache = DecryptCache()
+        self.last_batch_timings = []  # [(row_count, seconds)] for the latest decrypt_many call
         if password:
             self.unlock(password)
 
     def is_locked(self) -> bool:
         return self.aesgcm is None
 
-    def lock(self):
+    def lock(self, keep_session: bool = False):
+        """Forgets all keys. With *keep_session* (inactivity locks) the keyring is first sealed
+        under the password-derived wrapping key, which is then forgotten like the rest, so the
+        copy has the same KDF_ITERATIONS protection as the key file. unlock() within
+        session_minutes restores the keys from it without reading the key file."""
+        self._session = None
+        if keep_session and self.session_minutes > 0 and not self.is_locked() and self._wrap_key is not None:
+            self._session = (self._wrap_salt, self._seal(self._keyring_payload()),
+                             time.monotonic() + self.session_minutes * 60)
         self.key = None
         self.aesgcm = None
-        self.decrypt.cache_clear()
+        self._keyring = {}
+        self._raw_keys = {}
+        self._wrap_key = None
+        self._wrap_salt = None
+        self.cache.wipe()
 
-    def _derive_key(self, password: str, salt: bytes) -> bytes:
+    def _derive_key(self, password: str, salt: bytes, iterations: int = None) -> bytes:
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
             length=32,
             salt=salt,
-            iterations=600000,
+            iterations=iterations or self.KDF_ITERATIONS,
             backend=default_backend()
         )
         return kdf.derive(password.encode())
@@ -46,85 +186,536 @@ class EncryptionManager:
         self.unlock(password)
 
     def unlock(self, password: str):
-        """Unlocks the master key using the provided password."""
+        """Unlocks the data keys using the provided password."""
+        if self._session is not None:
+            self._unlock_session(password)
+        else:
+            self._unlock_key_file(password)
+
+    def _unlock_session(self, password: str):
+        salt, sealed, expires_at = self._session
+        # One attempt only: a wrong or late password falls back to the key file next time
+        self._session = None
+        if time.monotonic() > expires_at:
+            self._unlock_key_file(password)
+            return
+        self._load_keyring_payload(self._unwrap(password, salt, sealed))
+
+    def _unlock_key_file(self, password: str):
         if os.path.exists(self.key_file):
             with open(self.key_file, "rb") as f:
                 data = f.read()
 
             # Migration check: if file is exactly 32 bytes, it's an old unencrypted key
             if len(data) == 32:
-                self.key = data
+                self._set_keys({CIPHERTEXT_VERSION: data}, CIPHERTEXT_VERSION)
                 # Re-save encrypted
-                self._save_encrypted_key(password, self.key)
+                self._save_encrypted_key(password, data)
+            elif data.startswith(KEYRING_MAGIC):
+                salt = data[len(KEYRING_MAGIC):len(KEYRING_MAGIC) + 16]
+                self._load_keyring_payload(self._unwrap(password, salt, data[len(KEYRING_MAGIC) + 16:]))
             elif len(data) != 76:
                 raise ValueError("Corrupted key file: invalid file size.")
             else:
-                try:
-                    # Format: salt(16) + nonce(12) + encrypted_key(32 + 16 for tag) = 76 bytes
-                    salt = data[:16]
-                    nonce = data[16:28]
-                    ciphertext = data[28:]
-
-                    pw_key = self._derive_key(password, salt)
-                    aesgcm_pw = AESGCM(pw_key)
-                    self.key = aesgcm_pw.decrypt(nonce, ciphertext, None)
-                except Exception as e:
-                    raise ValueError("Invalid password or corrupted key file.") from e
+                # Format: salt(16) + nonce(12) + encrypted_key(32 + 16 for tag) = 76 bytes
+                salt = data[:16]
+                self._set_keys({CIPHERTEXT_VERSION: self._unwrap(password, salt, data[16:])}, CIPHERTEXT_VERSION)
         else:
             # Generate new key
-            self.key = AESGCM.generate_key(bit_length=256)
-            self._save_encrypted_key(password, self.key)
+            key = AESGCM.generate_key(bit_length=256)
+            self._set_keys({CIPHERTEXT_VERSION: key}, CIPHERTEXT_VERSION)
+            self._save_encrypted_key(password, key)
+
+    def _unwrap(self, password: str, salt: bytes, sealed: bytes) -> bytes:
+        """Decrypts nonce(12) + ciphertext with the password-derived key and keeps that key for re-saves."""
+        try:
+            pw_key = self._derive_key(password, salt)
+            plain = AESGCM(pw_key).decrypt(sealed[:12], sealed[12:], None)
+        except Exception as e:
+            raise ValueError("Invalid password or corrupted key file.") from e
+        self._wrap_key, self._wrap_salt = pw_key, salt
+        return plain
+
+    def _keyring_payload(self) -> bytes:
+        """Active generation(1) + [generation(1) + key(32)]..."""
+        return bytes((self.generation,)) + b"".join(bytes((generation,)) + key
+                                                    for generation, key in sorted(self._raw_keys.items()))
 
-        self.aesgcm = AESGCM(self.key)
+    def _load_keyring_payload(self, payload: bytes):
+        keys = {payload[i]: payload[i + 1:i + 33] for i in range(1, len(payload), 33)}
+        self._set_keys(keys, payload[0])
+
+    def _set_keys(self, keys: dict, active: int):
+        self._raw_keys = dict(keys)
+        self._keyring = {generation: AESGCM(key) for generation, key in keys.items()}
+        self.generation = active
+        self.key = keys[active]
+        self.aesgcm = self._keyring[active]
 
     def _save_encrypted_key(self, password: str, key: bytes):
         salt = os.urandom(16)
-        nonce = os.urandom(12)
         pw_key = self._derive_key(password, salt)
-        aesgcm_pw = AESGCM(pw_key)
-        ciphertext = aesgcm_pw.encrypt(nonce, key, None)
+        self._wrap_key, self._wrap_salt = pw_key, salt
+        self._write_key_file(salt + self._seal(key))
+
+    def _seal(self, plain: bytes) -> bytes:
+        nonce = os.urandom(12)
+        return nonce + AESGCM(self._wrap_key).encrypt(nonce, plain, None)
+
+    def _save_keyring(self):
+        """Re-saves all data keys under the wrapping key from the last unlock (no KDF run)."""
+        if self._wrap_key is None:
+            raise RuntimeError("Key manager is locked.")
+        if list(self._raw_keys) == [CIPHERTEXT_VERSION]:
+            # A single original key keeps the format older releases can read
+            self._write_key_file(self._wrap_salt + self._seal(self._raw_keys[CIPHERTEXT_VERSION]))
+            return
+        self._write_key_file(KEYRING_MAGIC + self._wrap_salt + self._seal(self._keyring_payload()))
 
-        data = salt + nonce + ciphertext
+    def _write_key_file(self, data: bytes):
+        # Written to a temporary file first: a torn key file would lose every key
+        tmp_path = self.key_file + ".tmp"
         try:
-            fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
             with os.fdopen(fd, "wb") as f:
                 f.write(data)
         except Exception:
-            with open(self.key_file, "wb") as f:
+            with open(tmp_path, "wb") as f:
                 f.write(data)
             try:
-                os.chmod(self.key_file, 0o600)
+                os.chmod(tmp_path, 0o600)
             except Exception:
                 pass
+        os.replace(tmp_path, self.key_file)
 
-    def encrypt(self, data: str) -> str:
+    def rotate_key(self) -> int:
+        """Adds a new data key and makes it active. Old keys stay until retire_keys().
+        Returns the new generation."""
+        if self.is_locked():
+            raise RuntimeError("Key manager is locked.")
+        generation = max(self._raw_keys) + 1
+        if generation > MAX_KEY_GENERATION:
+            raise RuntimeError("No key generations left.")
+        keys = dict(self._raw_keys)
+        keys[generation] = AESGCM.generate_key(bit_length=256)
+        self._set_keys(keys, generation)
+        self._save_keyring()
+        return generation
+
+    def retire_keys(self):
+        """Drops every key except the active one. Only call once no data uses them."""
+        if self.is_locked():
+            raise RuntimeError("Key manager is locked.")
+        self._set_keys({self.generation: self.key}, self.generation)
+        self._save_keyring()
+
+    def snapshot(self) -> "EncryptionManager":
+        """A copy of the current keys for one long-running job, unaffected by lock().
+        It cannot re-save the key file; lock() it when the job ends."""
+        if self.is_locked():
+            raise RuntimeError("Key manager is locked.")
+        copy = EncryptionManager(self.key_file)
+        copy._set_keys(dict(self._raw_keys), self.generation)
+        return copy
+
+    def key_generations(self) -> List[int]:
+        return sorted(self._raw_keys)
+
+    def encrypt(self, data: str) -> bytes:
         if not self.aesgcm: return data # Return plaintext if locked (should not happen in normal flow)
         if not data: return ""
         nonce = os.urandom(12)
         ciphertext = self.aesgcm.encrypt(nonce, data.encode(), None)
-        return "enc:" + base64.b64encode(nonce + ciphertext).decode()
+        return bytes((self.generation,)) + nonce + ciphertext
 
-    @functools.lru_cache(maxsize=1024)
-    def decrypt(self, encrypted_data: str) -> str:
-        if not self.aesgcm: return encrypted_data
+    def decrypt(self, encrypted_data, cache_key=None) -> str:
+        """Decrypts a binary BLOB or a legacy "enc:" string. Other strings are plaintext.
+        If *cache_key* (table, row_id, column) is given, the result is served from and stored in the cache."""
         if not encrypted_data: return ""
-        if not encrypted_data.startswith("enc:"):
-            return encrypted_data
-        try:
-            raw_data = base64.b64decode(encrypted_data[4:])
+        if cache_key is not None and self.aesgcm:
+            tag = _ciphertext_tag(encrypted_data)
+            plaintext = self.cache.get(cache_key, tag)
+            if plaintext is None:
+                plaintext = self._decrypt(encrypted_data)
+                if plaintext != "[Decryption Failed]":
+                    self.cache.put(cache_key, tag, plaintext)
+            return plaintext
+        return self._decrypt(encrypted_data)
+
+    def _decrypt(self, encrypted_data) -> str:
+        aesgcm = self.aesgcm
+        if isinstance(encrypted_data, bytes):
+            if not aesgcm: return "[Encrypted]"
+            aesgcm = self._keyring.get(encrypted_data[0])
+            if aesgcm is None:
+                return "[Decryption Failed]"
+            nonce = encrypted_data[1:13]
+            ciphertext = encrypted_data[13:]
+        else:
+            if not self.aesgcm: return encrypted_data
+            if not encrypted_data.startswith(LEGACY_CIPHERTEXT_PREFIX):
+                return encrypted_data
+            try:
+                raw_data = base64.b64decode(encrypted_data[len(LEGACY_CIPHERTEXT_PREFIX):])
+            except (binascii.Error, ValueError):
+                return "[Decryption Failed]"
+            # Legacy values predate rotation, so they always use the original key
+            aesgcm = self._keyring.get(CIPHERTEXT_VERSION)
+            if aesgcm is None:
+                return "[Decryption Failed]"
             nonce = raw_data[:12]
             ciphertext = raw_data[12:]
-            return self.aesgcm.decrypt(nonce, ciphertext, None).decode()
+        try:
+            return aesgcm.decrypt(nonce, ciphertext, None).decode()
         except Exception:
             return "[Decryption Failed]"
 
+    def _decrypt_batch(self, items) -> Tuple[list, int, float]:
+        start = time.perf_counter()
+        result = [self.decrypt(value, key) for value, key in items]
+        return result, len(items), time.perf_counter() - start
+
+    def _get_decrypt_pool(self) -> ThreadPoolExecutor:
+        with self._decrypt_pool_lock:
+            if self._decrypt_pool is None:
+                workers = max(2, min(4, os.cpu_count() or 1))
+                self._decrypt_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decrypt")
+            return self._decrypt_pool
+
+    def decrypt_many(self, values, keys=None, threshold: int = None) -> List[str]:
+        """Decrypts a sequence of values, preserving order. *keys* optionally gives a cache key per value.
+        Large inputs are split into batches on a small thread pool (AES-GCM releases the GIL).
+        Per-batch timing is recorded in *last_batch_timings*."""
+        values = list(values)
+        items = list(zip(values, keys if keys is not None else [None] * len(values)))
+        threshold = self.PARALLEL_DECRYPT_THRESHOLD if threshold is None else threshold
+        if len(items) < threshold:
+            result, count, elapsed = self._decrypt_batch(items)
+            self.last_batch_timings = [(count, elapsed)]
+            return result
+
+        size = self.DECRYPT_BATCH_SIZE
+        batches = [items[i:i + size] for i in range(0, len(items), size)]
+        decrypted = []
+        timings = []
+        for result, count, elapsed in self._get_decrypt_pool().map(self._decrypt_batch, batches):
+            decrypted.extend(result)
+            timings.append((count, elapsed))
+        self.last_batch_timings = timings
+        return decrypted
+
+    def close(self):
+        with self._decrypt_pool_lock:
+            if self._decrypt_pool is not None:
+                self._decrypt_pool.shutdown(wait=False)
+                self._decrypt_pool = None
+
+    @staticmethod
+    def upgrade_legacy(value):
+        """Converts a legacy "enc:" string to the binary format without decrypting it.
+        Returns None if *value* is not a legacy ciphertext."""
+        if not isinstance(value, str) or not value.startswith(LEGACY_CIPHERTEXT_PREFIX):
+            return None
+        try:
+            raw_data = base64.b64decode(value[len(LEGACY_CIPHERTEXT_PREFIX):], validate=True)
+        except (binascii.Error, ValueError):
+            return None
+        return bytes((CIPHERTEXT_VERSION,)) + raw_data
+
+
+# conversations.peer of the global chat (private chats use the peer IP)
+GLOBAL_CONVERSATION = '*'
+
+
+def _migrate_base_schema(cursor):
+    """v1: the original schema, including the column probes older releases ran on every start."""
+    # Messages table: id, sender, content, timestamp, is_deleted, recipient, expires_at
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            sender TEXT NOT NULL,
+            content TEXT,
+            timestamp REAL NOT NULL,
+            is_deleted BOOLEAN DEFAULT 0,
+            recipient TEXT,
+            expires_at REAL
+        )
+    """)
+    # Migration: add recipient column if it doesn't exist
+    cursor.execute("PRAGMA table_info(messages)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if 'recipient' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN recipient TEXT")
+    if 'expires_at' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN expires_at REAL")
+
+    # Optimized composite index for faster message retrieval by recipient, status, and timestamp
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient_deleted_ts ON messages(recipient, is_deleted, timestamp)")
+    # Index for expiring messages
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_expires_at ON messages(expires_at)")
+
+    # Files table: id, filename, path, size, owner_ip, is_folder, checksum, expires_at
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER,
+            owner_ip TEXT NOT NULL,
+            is_folder BOOLEAN DEFAULT 0,
+            checksum TEXT,
+            expires_at REAL
+        )
+    """)
+
+    # Migration: add columns to files table if they don't exist
+    cursor.execute("PRAGMA table_info(files)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if 'checksum' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN checksum TEXT")
+    if 'expires_at' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN expires_at REAL")
+
+    # Trusted Peers table: ip, username, fingerprint, trust_level, is_blocked, can_chat, can_list_files, can_download_files, last_seen
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trusted_peers (
+            ip TEXT PRIMARY KEY,
+            username TEXT,
+            fingerprint TEXT,
+            trust_level TEXT DEFAULT 'untrusted',
+            is_blocked BOOLEAN DEFAULT 0,
+            can_chat BOOLEAN DEFAULT 1,
+            can_list_files BOOLEAN DEFAULT 1,
+            can_download_files BOOLEAN DEFAULT 1,
+            last_seen REAL,
+            is_verified INTEGER DEFAULT 0
+        )
+    """)
+    # Migration for existing installations
+    cursor.execute("PRAGMA table_info(trusted_peers)")
+    tp_columns = [info[1] for info in cursor.fetchall()]
+    if 'is_verified' not in tp_columns:
+        cursor.execute("ALTER TABLE trusted_peers ADD COLUMN is_verified INTEGER DEFAULT 0")
+    if 'username' not in tp_columns:
+        cursor.execute("ALTER TABLE trusted_peers ADD COLUMN username TEXT")
+    if 'trust_level' not in tp_columns:
+        cursor.execute("ALTER TABLE trusted_peers ADD COLUMN trust_level TEXT DEFAULT 'untrusted'")
+    if 'is_blocked' not in tp_columns:
+        cursor.execute("ALTER TABLE trusted_peers ADD COLUMN is_blocked BOOLEAN DEFAULT 0")
+    if 'can_chat' not in tp_columns:
+        cursor.execute("ALTER TABLE trusted_peers ADD COLUMN can_chat BOOLEAN DEFAULT 1")
+    if 'can_list_files' not in tp_columns:
+        cursor.execute("ALTER TABLE trusted_peers ADD COLUMN can_list_files BOOLEAN DEFAULT 1")
+    if 'can_download_files' not in tp_columns:
+        cursor.execute("ALTER TABLE trusted_peers ADD COLUMN can_download_files BOOLEAN DEFAULT 1")
+
+    # Audit Logs table: id, event_type, details, timestamp, ip_address
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_type TEXT NOT NULL,
+            details TEXT,
+            timestamp REAL NOT NULL,
+            ip_address TEXT
+        )
+    """)
+    # Migration: add ip_address column if it doesn't exist
+    cursor.execute("PRAGMA table_info(audit_logs)")
+    audit_columns = [info[1] for info in cursor.fetchall()]
+    if 'ip_address' not in audit_columns:
+        cursor.execute("ALTER TABLE audit_logs ADD COLUMN ip_address TEXT")
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp ON audit_logs(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_ip ON audit_logs(ip_address)")
+
+    # App Config table: key, value
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS app_config (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+
+def _migrate_binary_ciphertext(db, stop_event, progress):
+    """v2: re-encode legacy "enc:" TEXT ciphertext as BLOBs (runs in the background)."""
+    db.migrate_legacy_ciphertext(stop_event=stop_event, progress_callback=progress)
+
+
+# Ordered schema migrations: (version, description, function, runs_in_background).
+# Foreground steps take a cursor and run inside one transaction at open.
+# Background steps take (db, stop_event, progress) and must be resumable; on a new
+# database they run inline because there is no data to convert.
+# Foreground steps that run while an earlier background step is still pending are
+# recorded in app_config (MIGRATION_STEPS_KEY), so they run once even though
+# user_version cannot move past the pending step yet.
+def _migrate_files_expiry_index(cursor):
+    """v3: index file share expiry so the expiry scheduler can seed from it."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files(expires_at)")
+
+
+def _migrate_message_tombstones(cursor):
+    """v4: record when a message was deleted so tombstones can be purged after a retention window."""
+    cursor.execute("PRAGMA table_info(messages)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if 'deleted_at' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN deleted_at REAL")
+    # Existing tombstones age from their send time and no longer need their ciphertext
+    cursor.execute("UPDATE messages SET deleted_at = timestamp, content = NULL WHERE is_deleted = 1 AND deleted_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_deleted_at ON messages(deleted_at) WHERE is_deleted = 1")
+
+
+def _migrate_audit_stats(cursor):
+    """v5: running audit aggregates (per event type, per IP, per hour) for the security dashboard."""
+    cursor.execute("CREATE TABLE IF NOT EXISTS audit_stats_event (event_type TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audit_stats_ip (
+            ip_address TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            last_seen REAL,
+            PRIMARY KEY (ip_address, event_type)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audit_stats_hourly (
+            hour INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (hour, event_type)
+        )
+    """)
+    # Backfill from the rows still in the table; existing counts (which include archived rows) win
+    cursor.execute("INSERT OR IGNORE INTO audit_stats_event SELECT event_type, COUNT(*) FROM audit_logs GROUP BY event_type")
+    cursor.execute("""
+        INSERT OR IGNORE INTO audit_stats_ip
+        SELECT ip_address, event_type, COUNT(*), MAX(timestamp) FROM audit_logs
+        WHERE ip_address IS NOT NULL GROUP BY ip_address, event_type
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO audit_stats_hourly
+        SELECT CAST(timestamp / 3600 AS INTEGER), event_type, COUNT(*) FROM audit_logs GROUP BY 1, 2
+    """)
+
+
+def _migrate_audit_query_indexes(cursor):
+    """v6: (filter, id) indexes so filtered audit pages are keyset range scans."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_event_id ON audit_logs(event_type, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_ip_id ON audit_logs(ip_address, id)")
+    # Covered by the (ip_address, id) index
+    cursor.execute("DROP INDEX IF EXISTS idx_audit_logs_ip")
+
+
+def _migrate_conversations(cursor):
+    """v7: per-conversation summaries (peer IP, or '*' for the global chat) kept in step with messages."""
+    cursor.execute("PRAGMA table_info(messages)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if 'is_incoming' not in columns:
+        # Received messages count as unread; older rows are treated as read
+        cursor.execute("ALTER TABLE messages ADD COLUMN is_incoming INTEGER DEFAULT 0")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            peer TEXT PRIMARY KEY,
+            last_message_id TEXT,
+            last_timestamp REAL,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_read_at REAL NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_last_ts ON conversations(last_timestamp)")
+    # SQLite takes the bare id column from the row holding MAX(timestamp); an existing
+    # summary keeps its unread state
+    cursor.execute("""
+        INSERT OR IGNORE INTO conversations (peer, last_message_id, last_timestamp, unread_count, message_count, last_read_at)
+        SELECT COALESCE(recipient, ?), id, MAX(timestamp), 0, COUNT(*), ? FROM messages
+        WHERE is_deleted = 0 GROUP BY COALESCE(recipient, ?)
+    """, (GLOBAL_CONVERSATION, time.time(), GLOBAL_CONVERSATION))
+
+
+def _migrate_conversation_bytes(cursor):
+    """v8: stored ciphertext bytes per conversation, for size-based retention."""
+    cursor.execute("PRAGMA table_info(conversations)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if 'byte_count' not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN byte_count INTEGER NOT NULL DEFAULT 0")
+    sizes = cursor.execute("""
+        SELECT COALESCE(recipient, ?), COALESCE(SUM(length(content)), 0) FROM messages
+        WHERE is_deleted = 0 GROUP BY COALESCE(recipient, ?)
+    """, (GLOBAL_CONVERSATION, GLOBAL_CONVERSATION)).fetchall()
+    cursor.executemany("UPDATE conversations SET byte_count = ? WHERE peer = ?", [(size, peer) for peer, size in sizes])
+
+
+def _migrate_file_chunk_hashes(cursor):
+    """v9: per-chunk SHA-256 leaves of shared files and their Merkle root."""
+    cursor.execute("PRAGMA table_info(files)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if 'chunk_hashes' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN chunk_hashes BLOB")
+    if 'chunk_root' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN chunk_root TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_checksum ON files(checksum)")
+
+
+MIGRATIONS = [
+    (1, "base schema", _migrate_base_schema, False),
+    (2, "binary ciphertext", _migrate_binary_ciphertext, True),
+    (3, "file expiry index", _migrate_files_expiry_index, False),
+    (4, "message tombstones", _migrate_message_tombstones, False),
+    (5, "audit statistics", _migrate_audit_stats, False),
+    (6, "audit query indexes", _migrate_audit_query_indexes, False),
+    (7, "conversation summaries", _migrate_conversations, False),
+    (8, "conversation sizes", _migrate_conversation_bytes, False),
+    (9, "file chunk hashes", _migrate_file_chunk_hashes, False),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# app_config key listing foreground steps ("3,4,...") already run past a pending background step
+MIGRATION_STEPS_KEY = 'migration_steps_done'
+
+# app_config key holding the resume point ("table:rowid") of an interrupted key rotation
+REKEY_STATE_KEY = 'rekey_state'
+
+# Audit events counted as intercepted threats on the security dashboard
+THREAT_EVENTS = ('AUTH_FAILURE', 'SECURITY_ALERT', 'UNAUTHORIZED_ACCESS', 'PROTOCOL_VIOLATION', 'IPS_AUTO_BLOCK')
+
+# Field order of the in-memory peer policy tuples
+PEER_POLICY_FIELDS = ('can_chat', 'can_list_files', 'can_download_files', 'is_blocked', 'is_verified', 'trust_level')
+# What an unknown peer resolves to (the trusted_peers column defaults)
+DEFAULT_PEER_POLICY = (True, True, True, False, False, 'untrusted')
+
+
 class Database:
-    def __init__(self, password=None, db_name="lan_messenger.db", key_file=".master.key"):
+    # Seconds between write-behind flushes of peer last_seen updates
+    PEER_TOUCH_FLUSH_INTERVAL = 5
+
+    def __init__(self, password=None, db_name="lan_messenger.db", key_file=".master.key", migration_callback=None,
+                 session_minutes: float = 0):
+        self.db_name = db_name
         self.conn = sqlite3.connect(db_name, check_same_thread=False)
         self.lock = threading.Lock()
-        self.cipher = EncryptionManager(password=password, key_file=key_file)
+        # Held while the set of key generations changes, and by backup_to between pinning
+        # its snapshot and copying the key file, so every backup gets the keys it needs
+        self._keyring_lock = threading.Lock()
+        self.cipher = EncryptionManager(password=password, key_file=key_file, session_minutes=session_minutes)
+        self.migration_callback = migration_callback
+        self.migration_progress = {'step': None, 'done': 0, 'total': 0, 'running': False}
+        self._migration_thread = None
+        self._stop_migrations = threading.Event()
+        self._expiry_listeners = []
+        # Decrypted recent messages per conversation; updated by the message mutators
+        self.history = HistoryCache()
+        # Write-behind last_seen/username updates: ip -> (last_seen, username or None)
+        self._peer_touches = {}
+        self._touch_lock = threading.Lock()
+        self._stop_touch_flush = threading.Event()
+        # ip -> PeerPolicy tuple; replaced whole under self.lock, read without it
+        self._peer_policies = {}
         self._enable_wal_mode()
         self.create_tables()
+        self._load_peer_policies()
+        self._touch_flush_thread = threading.Thread(target=self._peer_touch_flush_loop, daemon=True)
+        self._touch_flush_thread.start()
 
     def is_locked(self) -> bool:
         """Check if the database is currently locked."""
@@ -144,128 +735,116 @@ class Database:
         except Exception:
             return False
 
-    def lock_db(self):
-        self.cipher.lock()
+    def lock_db(self, keep_session: bool = False):
+        self.cipher.lock(keep_session=keep_session)
+        self.history.clear()
+
+    def add_expiry_listener(self, callback):
+        """Registers *callback(expires_at)*, called whenever a row with an expiry is stored."""
+        self._expiry_listeners.append(callback)
+
+    def _notify_expiry(self, expires_at):
+        for callback in self._expiry_listeners:
+            try:
+                callback(expires_at)
+            except Exception as e:
+                print(f"[DEBUG] Expiry listener error: {e}")
 
     def _enable_wal_mode(self):
         """Enable Write-Ahead Logging for better concurrency and performance."""
         with self.lock:
+            # Must precede WAL and table creation to take effect on a new database;
+            # existing databases are converted on request by enable_incremental_vacuum()
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
             # WAL mode allows concurrent reads and writes
             self.conn.execute("PRAGMA journal_mode=WAL")
             # NORMAL synchronous mode is faster and still safe enough with WAL
             self.conn.execute("PRAGMA synchronous=NORMAL")
 
     def create_tables(self):
+        """Brings the schema up to SCHEMA_VERSION. An up-to-date database costs a single PRAGMA read."""
         with self.lock:
-            cursor = self.conn.cursor()
-            # Messages table: id, sender, content, timestamp, is_deleted, recipient, expires_at
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id TEXT PRIMARY KEY,
-                    sender TEXT NOT NULL,
-                    content TEXT,
-                    timestamp REAL NOT NULL,
-                    is_deleted BOOLEAN DEFAULT 0,
-                    recipient TEXT,
-                    expires_at REAL
-                )
-            """)
-            # Migration: add recipient column if it doesn't exist
-            cursor.execute("PRAGMA table_info(messages)")
-            columns = [info[1] for info in cursor.fetchall()]
-            if 'recipient' not in columns:
-                cursor.execute("ALTER TABLE messages ADD COLUMN recipient TEXT")
-            if 'expires_at' not in columns:
-                cursor.execute("ALTER TABLE messages ADD COLUMN expires_at REAL")
-
-            # Optimized composite index for faster message retrieval by recipient, status, and timestamp
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient_deleted_ts ON messages(recipient, is_deleted, timestamp)")
-            # Index for expiring messages
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_expires_at ON messages(expires_at)")
-
-            # Files table: id, filename, path, size, owner_ip, is_folder, checksum, expires_at
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS files (
-                    id TEXT PRIMARY KEY,
-                    filename TEXT NOT NULL,
-                    path TEXT NOT NULL,
-                    size INTEGER,
-                    owner_ip TEXT NOT NULL,
-                    is_folder BOOLEAN DEFAULT 0,
-                    checksum TEXT,
-                    expires_at REAL
-                )
-            """)
-
-            # Migration: add columns to files table if they don't exist
-            cursor.execute("PRAGMA table_info(files)")
-            columns = [info[1] for info in cursor.fetchall()]
-            if 'checksum' not in columns:
-                cursor.execute("ALTER TABLE files ADD COLUMN checksum TEXT")
-            if 'expires_at' not in columns:
-                cursor.execute("ALTER TABLE files ADD COLUMN expires_at REAL")
-
-            # Trusted Peers table: ip, username, fingerprint, trust_level, is_blocked, can_chat, can_list_files, can_download_files, last_seen
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS trusted_peers (
-                    ip TEXT PRIMARY KEY,
-                    username TEXT,
-                    fingerprint TEXT,
-                    trust_level TEXT DEFAULT 'untrusted',
-                    is_blocked BOOLEAN DEFAULT 0,
-                    can_chat BOOLEAN DEFAULT 1,
-                    can_list_files BOOLEAN DEFAULT 1,
-                    can_download_files BOOLEAN DEFAULT 1,
-                    last_seen REAL,
-                    is_verified INTEGER DEFAULT 0
-                )
-            """)
-            # Migration for existing installations
-            cursor.execute("PRAGMA table_info(trusted_peers)")
-            tp_columns = [info[1] for info in cursor.fetchall()]
-            if 'is_verified' not in tp_columns:
-                cursor.execute("ALTER TABLE trusted_peers ADD COLUMN is_verified INTEGER DEFAULT 0")
-            if 'username' not in tp_columns:
-                cursor.execute("ALTER TABLE trusted_peers ADD COLUMN username TEXT")
-            if 'trust_level' not in tp_columns:
-                cursor.execute("ALTER TABLE trusted_peers ADD COLUMN trust_level TEXT DEFAULT 'untrusted'")
-            if 'is_blocked' not in tp_columns:
-                cursor.execute("ALTER TABLE trusted_peers ADD COLUMN is_blocked BOOLEAN DEFAULT 0")
-            if 'can_chat' not in tp_columns:
-                cursor.execute("ALTER TABLE trusted_peers ADD COLUMN can_chat BOOLEAN DEFAULT 1")
-            if 'can_list_files' not in tp_columns:
-                cursor.execute("ALTER TABLE trusted_peers ADD COLUMN can_list_files BOOLEAN DEFAULT 1")
-            if 'can_download_files' not in tp_columns:
-                cursor.execute("ALTER TABLE trusted_peers ADD COLUMN can_download_files BOOLEAN DEFAULT 1")
-
-            # Audit Logs table: id, event_type, details, timestamp, ip_address
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS audit_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    event_type TEXT NOT NULL,
-                    details TEXT,
-                    timestamp REAL NOT NULL,
-                    ip_address TEXT
-                )
-            """)
-            # Migration: add ip_address column if it doesn't exist
-            cursor.execute("PRAGMA table_info(audit_logs)")
-            audit_columns = [info[1] for info in cursor.fetchall()]
-            if 'ip_address' not in audit_columns:
-                cursor.execute("ALTER TABLE audit_logs ADD COLUMN ip_address TEXT")
-
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp ON audit_logs(timestamp)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_ip ON audit_logs(ip_address)")
-
-            # App Config table: key, value
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS app_config (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            """)
-
-            self.conn.commit()
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+            fresh = version == 0 and self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone() is None
+
+            background = []
+            completed = self._deferred_migration_steps() if version else set()
+            for step in MIGRATIONS:
+                step_version, description, migrate, in_background = step
+                if step_version <= version:
+                    continue
+                if in_background and not fresh:
+                    background.append(step)
+                    continue
+                if background and step_version in completed:
+                    continue
+                self._run_migration_step(step, advance=not background, completed=completed)
+
+        if background:
+            self._migration_thread = threading.Thread(target=self._run_background_migrations,
+                                                      args=(background,), daemon=True)
+            self._migration_thread.start()
+
+    def _deferred_migration_steps(self) -> set:
+        """Foreground steps that already ran while an earlier background step was pending."""
+        row = self.conn.execute("SELECT value FROM app_config WHERE key = ?", (MIGRATION_STEPS_KEY,)).fetchone()
+        return {int(v) for v in row[0].split(",")} if row and row[0] else set()
+
+    def _run_migration_step(self, step, advance: bool, completed=None):
+        """Runs one step in its own transaction. Must be called with the lock held.
+        user_version only advances when every earlier step is complete; otherwise the step
+        is added to *completed* and recorded with it."""
+        step_version, description, migrate, in_background = step
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            # Background steps only convert existing data, so a new database just records them
+            if not in_background:
+                migrate(cursor)
+            if advance:
+                cursor.execute(f"PRAGMA user_version = {int(step_version)}")
+            elif not in_background:
+                completed.add(step_version)
+                cursor.execute("INSERT OR REPLACE INTO app_config (key, value) VALUES (?, ?)",
+                               (MIGRATION_STEPS_KEY, ",".join(str(v) for v in sorted(completed))))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def _report_migration_progress(self, description: str, done: int, total: int):
+        self.migration_progress = {'step': description, 'done': done, 'total': total, 'running': True}
+        if self.migration_callback:
+            try:
+                self.migration_callback(description, done, total)
+            except Exception as e:
+                print(f"[DEBUG] Migration progress callback error: {e}")
+
+    def _run_background_migrations(self, steps):
+        """Runs long data migrations without holding the lock between batches.
+        Later foreground steps have already run, so finishing the last one completes the schema."""
+        for index, step in enumerate(steps):
+            step_version, description, migrate, _ = step
+            start = time.perf_counter()
+            try:
+                migrate(self, self._stop_migrations,
+                        lambda done, total, d=description: self._report_migration_progress(d, done, total))
+            except Exception as e:
+                print(f"[DEBUG] Background migration '{description}' failed: {e}")
+                break
+            if self._stop_migrations.is_set():
+                break
+            reached = steps[index + 1][0] - 1 if index + 1 < len(steps) else SCHEMA_VERSION
+            with self.lock:
+                with self.conn:
+                    self.conn.execute(f"PRAGMA user_version = {int(reached)}")
+                    if reached == SCHEMA_VERSION:
+                        self.conn.execute("DELETE FROM app_config WHERE key = ?", (MIGRATION_STEPS_KEY,))
+            print(f"[DEBUG] Migration '{description}' finished in {time.perf_counter() - start:.2f}s")
+        self.migration_progress = dict(self.migration_progress, running=False)
 
     def set_config(self, key: str, value: str, encrypt: bool = False):
         if encrypt and value:
@@ -273,6 +852,7 @@ class Database:
         with self.lock:
             with self.conn:
                 self.conn.execute("INSERT OR REPLACE INTO app_config (key, value) VALUES (?, ?)", (key, value))
+            self.cipher.cache.invalidate('app_config', key)
 
     def get_config(self, key: str, decrypt: bool = False) -> str:
         with self.lock:
@@ -282,7 +862,7 @@ class Database:
                 return None
             value = row[0]
             if decrypt and value:
-                return self.cipher.decrypt(value)
+                return self.cipher.decrypt(value, ('app_config', key, 'value'))
             return value
 
     def add_message(self, sender: str, content: str, recipient: str = None, ttl: int = None) -> str:
@@ -294,18 +874,33 @@ class Database:
             with self.conn:
                 self.conn.execute("INSERT INTO messages (id, sender, content, timestamp, recipient, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
                                  (msg_id, sender, encrypted_content, timestamp, recipient, expires_at))
+                self._conversation_added(recipient, msg_id, timestamp, len(encrypted_content), incoming=False)
+            self.history.add(MessageRecord(msg_id, sender, content, timestamp, recipient, expires_at))
+        if expires_at:
+            self._notify_expiry(expires_at)
         return msg_id
 
     def add_received_message(self, msg_id: str, sender: str, content: str, timestamp: float, recipient: str = None, expires_at: float = None):
         encrypted_content = self.cipher.encrypt(content)
         with self.lock:
             with self.conn:
-                self.conn.execute("INSERT OR IGNORE INTO messages (id, sender, content, timestamp, recipient, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
-                                 (msg_id, sender, encrypted_content, timestamp, recipient, expires_at))
+                cursor = self.conn.execute("INSERT OR IGNORE INTO messages (id, sender, content, timestamp, recipient, expires_at, is_incoming) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                                           (msg_id, sender, encrypted_content, timestamp, recipient, expires_at))
+                if cursor.rowcount:
+                    self._conversation_added(recipient, msg_id, timestamp, len(encrypted_content), incoming=True)
+            if cursor.rowcount:
+                self.history.add(MessageRecord(msg_id, sender, content, timestamp, recipient, expires_at))
+        if expires_at and cursor.rowcount:
+            self._notify_expiry(expires_at)
 
     def get_messages(self, limit=50, peer_ip: str = None) -> List[Tuple]:
+        # Private chats are keyed by recipient: stored senders are usernames, never IPs
         now = time.time()
+        cached = self.history.get(peer_ip, limit, now)
+        if cached is not None:
+            return cached
         with self.lock:
+            generation = self.history.generation
             if peer_ip:
                 cursor = self.conn.execute("""
                     SELECT id, sender, content, timestamp, is_deleted, recipient, expires_at
@@ -326,57 +921,88 @@ class Database:
 
             rows = cursor.fetchall()
 
-        decrypted_rows = []
-        for row in rows:
-            decrypted_content = self.cipher.decrypt(row[2])
-            decrypted_rows.append((row[0], row[1], decrypted_content, row[3], row[4], row[5], row[6]))
-        return decrypted_rows[::-1]
+        contents = self.cipher.decrypt_many([row[2] for row in rows],
+                                            [('messages', row[0], 'content') for row in rows])
+        decrypted_rows = [(row[0], row[1], content, row[3], row[4], row[5], row[6])
+                          for row, content in zip(rows, contents)][::-1]
+        if not self.is_locked():
+            self.history.fill(peer_ip, decrypted_rows, generation, limit)
+        return decrypted_rows
 
     def delete_message(self, msg_id: str):
         with self.lock:
             with self.conn:
-                self.conn.execute("UPDATE messages SET is_deleted = 1 WHERE id = ?", (msg_id,))
+                row = self.conn.execute("SELECT id, recipient, timestamp, is_incoming, COALESCE(length(content), 0) FROM messages WHERE id = ? AND is_deleted = 0",
+                                        (msg_id,)).fetchone()
+                # Keep the tombstone (so a re-delivered copy stays deleted) but drop the ciphertext
+                self.conn.execute("UPDATE messages SET is_deleted = 1, deleted_at = ?, content = NULL WHERE id = ? AND is_deleted = 0",
+                                  (time.time(), msg_id))
+                if row:
+                    self._conversation_removed([row])
+            self.cipher.cache.invalidate('messages', msg_id)
+            self.history.remove([msg_id])
 
     def edit_message(self, msg_id: str, new_content: str):
         encrypted_content = self.cipher.encrypt(new_content)
         with self.lock:
             with self.conn:
-                self.conn.execute("UPDATE messages SET content = ? WHERE id = ?", (encrypted_content, msg_id))
+                row = self.conn.execute("SELECT recipient, COALESCE(length(content), 0) FROM messages WHERE id = ? AND is_deleted = 0",
+                                        (msg_id,)).fetchone()
+                self.conn.execute("UPDATE messages SET content = ? WHERE id = ? AND is_deleted = 0", (encrypted_content, msg_id))
+                if row:
+                    self.conn.execute("UPDATE conversations SET byte_count = MAX(byte_count + ?, 0) WHERE peer = ?",
+                                      (len(encrypted_content) - row[1], row[0] or GLOBAL_CONVERSATION))
+            self.cipher.cache.invalidate('messages', msg_id)
+            self.history.edit(msg_id, new_content)
 
-    def add_file(self, filename: str, path: str, size: int, owner_ip: str, is_folder: bool = False, checksum: str = None, ttl: int = None) -> str:
+    def add_file(self, filename: str, path: str, size: int, owner_ip: str, is_folder: bool = False, checksum: str = None, ttl: int = None,
+                 chunk_hashes: bytes = None) -> str:
+        """*chunk_hashes* are the leaves from chunk_hashes.hash_file; their Merkle root is stored alongside."""
         file_id = str(uuid.uuid4())
         expires_at = time.time() + ttl if ttl else None
         encrypted_filename = self.cipher.encrypt(filename)
         encrypted_path = self.cipher.encrypt(path)
+        chunk_root = merkle_root(chunk_hashes) if chunk_hashes is not None else None
         with self.lock:
             with self.conn:
-                self.conn.execute("INSERT INTO files (id, filename, path, size, owner_ip, is_folder, checksum, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                                 (file_id, encrypted_filename, encrypted_path, size, owner_ip, is_folder, checksum, expires_at))
+                self.conn.execute("INSERT INTO files (id, filename, path, size, owner_ip, is_folder, checksum, expires_at, chunk_hashes, chunk_root) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (file_id, encrypted_filename, encrypted_path, size, owner_ip, is_folder, checksum, expires_at,
+                                  chunk_hashes, chunk_root))
+        if expires_at:
+            self._notify_expiry(expires_at)
         return file_id
 
     def get_files(self) -> List[Tuple]:
         now = time.time()
         with self.lock:
-            cursor = self.conn.execute("SELECT id, filename, path, size, owner_ip, is_folder, checksum, expires_at FROM files WHERE expires_at IS NULL OR expires_at > ?", (now,))
+            cursor = self.conn.execute("SELECT id, filename, path, size, owner_ip, is_folder, checksum, expires_at, chunk_root FROM files WHERE expires_at IS NULL OR expires_at > ?", (now,))
             rows = cursor.fetchall()
 
-        decrypted_rows = []
-        for row in rows:
-            decrypted_filename = self.cipher.decrypt(row[1])
-            decrypted_path = self.cipher.decrypt(row[2])
-            decrypted_rows.append((row[0], decrypted_filename, decrypted_path, row[3], row[4], row[5], row[6], row[7]))
+        # Decrypt filenames and paths in one batch: [name0, path0, name1, path1, ...]
+        plain = self.cipher.decrypt_many([value for row in rows for value in (row[1], row[2])],
+                                         [('files', row[0], column) for row in rows for column in ('filename', 'path')])
+        decrypted_rows = [(row[0], plain[2 * i], plain[2 * i + 1], row[3], row[4], row[5], row[6], row[7], row[8])
+                          for i, row in enumerate(rows)]
         return decrypted_rows
 
+    def get_chunk_hashes(self, checksum: str):
+        """The chunk leaves stored for a live share whose SHA-256 is *checksum*, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT chunk_hashes FROM files WHERE checksum = ? AND chunk_hashes IS NOT NULL "
+                                    "AND (expires_at IS NULL OR expires_at > ?) LIMIT 1", (checksum, time.time())).fetchone()
+        return bytes(row[0]) if row else None
+
     def is_file_shared(self, path: str) -> bool:
         now = time.time()
         with self.lock:
-            cursor = self.conn.execute("SELECT path, is_folder FROM files WHERE expires_at IS NULL OR expires_at > ?", (now,))
+            cursor = self.conn.execute("SELECT id, path, is_folder FROM files WHERE expires_at IS NULL OR expires_at > ?", (now,))
             rows = cursor.fetchall()
 
         norm_path = os.path.normpath(path)
         for row in rows:
-            decrypted_shared_path = self.cipher.decrypt(row[0])
-            is_folder = row[1]
+            decrypted_shared_path = self.cipher.decrypt(row[1], ('files', row[0], 'path'))
+            is_folder = row[2]
             norm_shared = os.path.normpath(decrypted_shared_path)
 
             if is_folder:
@@ -395,14 +1021,110 @@ class Database:
                 return cursor.rowcount
 
     def delete_expired_messages(self) -> int:
-        now = time.time()
+        # LIMIT -1 means no limit
+        return len(self.delete_expired_messages_batch(time.time(), -1))
+
+    def get_next_expiries(self, limit: int) -> List[float]:
+        """Returns up to *limit* of the earliest pending expiry deadlines (messages and files), sorted."""
+        with self.lock:
+            messages = self.conn.execute("SELECT expires_at FROM messages WHERE expires_at IS NOT NULL ORDER BY expires_at LIMIT ?", (limit,)).fetchall()
+            files = self.conn.execute("SELECT expires_at FROM files WHERE expires_at IS NOT NULL ORDER BY expires_at LIMIT ?", (limit,)).fetchall()
+        return sorted(row[0] for row in messages + files)[:limit]
+
+    def delete_expired_messages_batch(self, now: float, limit: int) -> List[Tuple]:
+        """Deletes up to *limit* messages expired at *now*. Returns the deleted (id, recipient) pairs."""
         with self.lock:
             with self.conn:
-                cursor = self.conn.execute("DELETE FROM messages WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
-                return cursor.rowcount
+                rows = self.conn.execute("""
+                    SELECT id, recipient, timestamp, is_incoming, COALESCE(length(content), 0), is_deleted FROM messages
+                    WHERE expires_at IS NOT NULL AND expires_at <= ? ORDER BY expires_at LIMIT ?
+                """, (now, limit)).fetchall()
+                if rows:
+                    placeholders = ",".join(["?"] * len(rows))
+                    self.conn.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", [row[0] for row in rows])
+                    # Tombstones were already taken out of their summary when deleted
+                    self._conversation_removed([row[:5] for row in rows if not row[5]])
+            for row in rows:
+                self.cipher.cache.invalidate('messages', row[0])
+            self.history.remove([row[0] for row in rows])
+        return [row[:2] for row in rows]
+
+    def _conversation_added(self, recipient, msg_id: str, timestamp: float, size: int, incoming: bool):
+        """Counts a new message (*size* ciphertext bytes) in its conversation summary.
+        Runs inside the inserting transaction."""
+        self.conn.execute("""
+            INSERT INTO conversations (peer, last_message_id, last_timestamp, unread_count, message_count, byte_count)
+            VALUES (?, ?, ?, ?, 1, ?)
+            ON CONFLICT(peer) DO UPDATE SET
+                message_count = message_count + 1,
+                byte_count = byte_count + excluded.byte_count,
+                unread_count = unread_count + excluded.unread_count,
+                last_message_id = CASE WHEN last_timestamp IS NULL OR excluded.last_timestamp >= last_timestamp
+                                       THEN excluded.last_message_id ELSE last_message_id END,
+                last_timestamp = MAX(COALESCE(last_timestamp, 0), excluded.last_timestamp)
+        """, (recipient or GLOBAL_CONVERSATION, msg_id, timestamp, 1 if incoming else 0, size))
+
+    def _conversation_removed(self, rows):
+        """Takes (id, recipient, timestamp, is_incoming, size) rows out of their summaries.
+        Runs inside the deleting transaction, after the rows are gone or tombstoned."""
+        for row in rows:
+            peer = row[1] or GLOBAL_CONVERSATION
+            self.conn.execute("""
+                UPDATE conversations SET
+                    message_count = MAX(message_count - 1, 0),
+                    byte_count = MAX(byte_count - ?, 0),
+                    unread_count = CASE WHEN ? AND ? > last_read_at THEN MAX(unread_count - 1, 0) ELSE unread_count END
+                WHERE peer = ?
+            """, (row[4], row[3], row[2], peer))
+        # A conversation that lost its newest message takes the next one (one indexed lookup)
+        for peer in {row[1] or GLOBAL_CONVERSATION for row in rows}:
+            ids = {row[0] for row in rows if (row[1] or GLOBAL_CONVERSATION) == peer}
+            current = self.conn.execute("SELECT last_message_id FROM conversations WHERE peer = ?", (peer,)).fetchone()
+            if not current or current[0] not in ids:
+                continue
+            if peer == GLOBAL_CONVERSATION:
+                latest = self.conn.execute("SELECT id, timestamp FROM messages WHERE recipient IS NULL AND is_deleted = 0 ORDER BY timestamp DESC LIMIT 1").fetchone()
+            else:
+                latest = self.conn.execute("SELECT id, timestamp FROM messages WHERE recipient = ? AND is_deleted = 0 ORDER BY timestamp DESC LIMIT 1",
+                                           (peer,)).fetchone()
+            self.conn.execute("UPDATE conversations SET last_message_id = ?, last_timestamp = ? WHERE peer = ?",
+                              (latest[0] if latest else None, latest[1] if latest else None, peer))
+
+    def mark_conversation_read(self, peer_ip: str = None):
+        """Clears the unread count of a private chat, or of the global chat when *peer_ip* is None."""
+        with self.lock:
+            with self.conn:
+                # Only writes when something was unread, so calling it on every render is cheap
+                self.conn.execute("UPDATE conversations SET unread_count = 0, last_read_at = ? WHERE peer = ? AND unread_count > 0",
+                                  (time.time(), peer_ip or GLOBAL_CONVERSATION))
+
+    def get_conversations(self) -> List[Tuple]:
+        """(peer_ip or None for global, last_message_id, last_timestamp, unread_count, message_count, byte_count),
+        most recent first."""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT peer, last_message_id, last_timestamp, unread_count, message_count, byte_count
+                FROM conversations ORDER BY last_timestamp DESC
+            """).fetchall()
+        return [(None if row[0] == GLOBAL_CONVERSATION else row[0],) + row[1:] for row in rows]
+
+    def delete_expired_files_batch(self, now: float, limit: int) -> int:
+        """Deletes up to *limit* file shares expired at *now*. Returns the number deleted."""
+        with self.lock:
+            with self.conn:
+                rows = self.conn.execute("SELECT id FROM files WHERE expires_at IS NOT NULL AND expires_at <= ? ORDER BY expires_at LIMIT ?",
+                                         (now, limit)).fetchall()
+                if rows:
+                    placeholders = ",".join(["?"] * len(rows))
+                    self.conn.execute(f"DELETE FROM files WHERE id IN ({placeholders})", [row[0] for row in rows])
+            for row in rows:
+                self.cipher.cache.invalidate('files', row[0])
+        return len(rows)
 
     def add_trusted_peer(self, ip: str, username: str, fingerprint: str, trust_level: str = None):
         now = time.time()
+        with self._touch_lock:
+            self._peer_touches.pop(ip, None)  # Superseded by this write
         with self.lock:
             with self.conn:
                 cursor = self.conn.execute("SELECT trust_level FROM trusted_peers WHERE ip = ?", (ip,))
@@ -420,8 +1142,31 @@ class Database:
                         INSERT INTO trusted_peers (ip, username, fingerprint, trust_level, last_seen)
                         VALUES (?, ?, ?, ?, ?)
                     """, (ip, username, fingerprint, final_trust, now))
-            # Invalidate the permissions cache within the lock
-            self._get_peer_permissions_internal.cache_clear()
+            self._set_peer_policy(ip, trust_level=final_trust)
+
+    def touch_peer(self, ip: str, username: str = None):
+        """Records that a known peer was seen. Coalesced in memory and written by the flush thread."""
+        with self._touch_lock:
+            self._peer_touches[ip] = (time.time(), username)
+
+    def flush_peer_touches(self) -> int:
+        """Writes pending last_seen/username updates in one transaction. Returns the number written."""
+        with self._touch_lock:
+            pending, self._peer_touches = self._peer_touches, {}
+        if not pending:
+            return 0
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("UPDATE trusted_peers SET last_seen = ?, username = COALESCE(?, username) WHERE ip = ?",
+                                      [(last_seen, username, ip) for ip, (last_seen, username) in pending.items()])
+        return len(pending)
+
+    def _peer_touch_flush_loop(self):
+        while not self._stop_touch_flush.wait(self.PEER_TOUCH_FLUSH_INTERVAL):
+            try:
+                self.flush_peer_touches()
+            except Exception as e:
+                print(f"[DEBUG] Peer touch flush error: {e}")
 
     def get_trusted_peer(self, ip: str) -> Tuple:
         with self.lock:
@@ -429,32 +1174,48 @@ class Database:
                 SELECT ip, username, fingerprint, trust_level, is_blocked, can_chat, can_list_files, can_download_files, last_seen, is_verified
                 FROM trusted_peers WHERE ip = ?
             """, (ip,))
-            return cursor.fetchone()
+            row = cursor.fetchone()
+        with self._touch_lock:
+            touch = self._peer_touches.get(ip)
+        if row and touch:
+            # Overlay the not-yet-flushed values
+            last_seen, username = touch
+            row = (row[0], username or row[1]) + row[2:8] + (last_seen, row[9])
+        return row
 
-    @functools.lru_cache(maxsize=128)
-    def _get_peer_permissions_internal(self, ip: str) -> tuple:
-        """Internal cached helper for permission lookups. Returns an immutable tuple."""
+    def _load_peer_policies(self):
+        """Loads every peer's permissions and trust level into memory."""
         with self.lock:
-            cursor = self.conn.execute("""
-                SELECT can_chat, can_list_files, can_download_files, is_blocked, is_verified
-                FROM trusted_peers WHERE ip = ?
-            """, (ip,))
-            row = cursor.fetchone()
-            # Default permissions if peer is unknown
-            return row if row else (1, 1, 1, 0, 0)
+            rows = self.conn.execute("""
+                SELECT ip, can_chat, can_list_files, can_download_files, is_blocked, is_verified, trust_level
+                FROM trusted_peers
+            """).fetchall()
+            self._peer_policies = {row[0]: (bool(row[1]), bool(row[2]), bool(row[3]), bool(row[4]), bool(row[5]), row[6])
+                                   for row in rows}
 
-    def get_peer_permissions(self, ip: str) -> dict:
-        """Fetch peer permissions using a cache and returning a dictionary."""
-        # Using a cached internal helper that returns a tuple (immutable)
-        p = self._get_peer_permissions_internal(ip)
+    def _set_peer_policy(self, ip: str, **changes):
+        """Write-through update of one peer's in-memory policy. Must be called with the lock held,
+        after the matching database write has committed."""
+        policy = list(self._peer_policies.get(ip, DEFAULT_PEER_POLICY))
+        for field, value in changes.items():
+            index = PEER_POLICY_FIELDS.index(field)
+            policy[index] = value if field == 'trust_level' else bool(value)
+        # Swapping in a new tuple keeps lock-free readers consistent
+        self._peer_policies[ip] = tuple(policy)
+
+    def _permissions_dict(self, policy: tuple) -> dict:
         return {
-            'can_chat': bool(p[0]),
-            'can_list_files': bool(p[1]),
-            'can_download_files': bool(p[2]),
-            'is_blocked': bool(p[3]),
-            'is_verified': bool(p[4])
+            'can_chat': policy[0],
+            'can_list_files': policy[1],
+            'can_download_files': policy[2],
+            'is_blocked': policy[3],
+            'is_verified': policy[4]
         }
 
+    def get_peer_permissions(self, ip: str) -> dict:
+        """Returns peer permissions from the in-memory policy table (no lock, no query)."""
+        return self._permissions_dict(self._peer_policies.get(ip, DEFAULT_PEER_POLICY))
+
     def update_peer_permissions(self, ip: str, permissions: dict):
         with self.lock:
             with self.conn:
@@ -472,8 +1233,12 @@ class Database:
                     int(permissions.get('is_verified', 0)),
                     ip
                 ))
-            # Invalidate the permissions cache within the lock
-            self._get_peer_permissions_internal.cache_clear()
+            self._set_peer_policy(ip,
+                                  is_blocked=permissions.get('is_blocked', 0),
+                                  can_chat=permissions.get('can_chat', 1),
+                                  can_list_files=permissions.get('can_list_files', 1),
+                                  can_download_files=permissions.get('can_download_files', 1),
+                                  is_verified=permissions.get('is_verified', 0))
 
     def get_blocked_peers(self) -> List[Tuple]:
         with self.lock:
@@ -483,41 +1248,26 @@ class Database:
     def unblock_peer(self, ip: str):
         with self.lock:
             with self.conn:
-                self.conn.execute("UPDATE trusted_peers SET is_blocked = 0 WHERE ip = ?", (ip,))
-            self._get_peer_permissions_internal.cache_clear()
+                cursor = self.conn.execute("UPDATE trusted_peers SET is_blocked = 0 WHERE ip = ?", (ip,))
+            if cursor.rowcount:
+                self._set_peer_policy(ip, is_blocked=False)
 
     def get_peer_trust_levels(self, ips: List[str]) -> dict:
-        if not ips: return {}
-        ips_list = list(ips)
-        placeholders = ",".join(["?"] * len(ips_list))
-        with self.lock:
-            cursor = self.conn.execute(f"SELECT ip, trust_level FROM trusted_peers WHERE ip IN ({placeholders})", ips_list)
-            return {row[0]: row[1] for row in cursor.fetchall()}
+        """Trust levels of the known peers among *ips*."""
+        policies = self._peer_policies
+        return {ip: policies[ip][5] for ip in ips if ip in policies}
 
     def get_peers_permissions(self, ips: List[str]) -> dict:
-        if not ips: return {}
-        ips_list = list(ips)
-        placeholders = ",".join(["?"] * len(ips_list))
-        with self.lock:
-            cursor = self.conn.execute(f"""
-                SELECT ip, can_chat, can_list_files, can_download_files, is_blocked, is_verified
-                FROM trusted_peers WHERE ip IN ({placeholders})
-            """, ips_list)
-            results = {}
-            for row in cursor.fetchall():
-                results[row[0]] = {
-                    'can_chat': bool(row[1]),
-                    'can_list_files': bool(row[2]),
-                    'can_download_files': bool(row[3]),
-                    'is_blocked': bool(row[4]),
-                    'is_verified': bool(row[5])
-                }
-            return results
+        """Permissions of the known peers among *ips*."""
+        policies = self._peer_policies
+        return {ip: self._permissions_dict(policies[ip]) for ip in ips if ip in policies}
 
     def update_peer_trust(self, ip: str, trust_level: str):
         with self.lock:
             with self.conn:
-                self.conn.execute("UPDATE trusted_peers SET trust_level = ? WHERE ip = ?", (trust_level, ip))
+                cursor = self.conn.execute("UPDATE trusted_peers SET trust_level = ? WHERE ip = ?", (trust_level, ip))
+            if cursor.rowcount:
+                self._set_peer_policy(ip, trust_level=trust_level)
 
     def add_audit_log(self, event_type: str, details: str, ip_address: str = None):
         timestamp = time.time()
@@ -526,14 +1276,146 @@ class Database:
                 with self.conn:
                     self.conn.execute("INSERT INTO audit_logs (event_type, details, timestamp, ip_address) VALUES (?, ?, ?, ?)",
                                      (event_type, details, timestamp, ip_address))
+                    # Keep the aggregates in the same transaction so they never drift from the log
+                    self.conn.execute("""
+                        INSERT INTO audit_stats_event (event_type, count) VALUES (?, 1)
+                        ON CONFLICT(event_type) DO UPDATE SET count = count + 1
+                    """, (event_type,))
+                    self.conn.execute("""
+                        INSERT INTO audit_stats_hourly (hour, event_type, count) VALUES (?, ?, 1)
+                        ON CONFLICT(hour, event_type) DO UPDATE SET count = count + 1
+                    """, (int(timestamp // 3600), event_type))
+                    if ip_address:
+                        self.conn.execute("""
+                            INSERT INTO audit_stats_ip (ip_address, event_type, count, last_seen) VALUES (?, ?, 1, ?)
+                            ON CONFLICT(ip_address, event_type) DO UPDATE SET count = count + 1, last_seen = excluded.last_seen
+                        """, (ip_address, event_type, timestamp))
             except Exception as e:
                 print(f"[DEBUG] Failed to add audit log to DB: {e}")
 
     def get_audit_logs(self, limit=100) -> List[Tuple]:
+        return self.query_audit_logs(limit=limit)
+
+    @staticmethod
+    def _audit_filter(event_type=None, ip_address=None, since=None, until=None):
+        """WHERE clauses and parameters shared by the audit queries."""
+        clauses, params = [], []
+        if event_type:
+            clauses.append("event_type = ?")
+            params.append(event_type)
+        if ip_address:
+            clauses.append("ip_address = ?")
+            params.append(ip_address)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+        return clauses, params
+
+    def query_audit_logs(self, event_type: str = None, ip_address: str = None, since: float = None, until: float = None,
+                         before_id: int = None, limit: int = 100) -> List[Tuple]:
+        """One page of audit rows, newest first. Pass the last id of a page as *before_id* to get the next one."""
+        clauses, params = self._audit_filter(event_type, ip_address, since, until)
+        if before_id is not None:
+            clauses.append("id < ?")
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
         with self.lock:
-            cursor = self.conn.execute("SELECT id, event_type, details, timestamp, ip_address FROM audit_logs ORDER BY timestamp DESC LIMIT ?", (limit,))
+            cursor = self.conn.execute(f"SELECT id, event_type, details, timestamp, ip_address FROM audit_logs {where} ORDER BY id DESC LIMIT ?",
+                                       params + [limit])
             return cursor.fetchall()
 
+    def get_event_counts(self, event_types=None) -> dict:
+        """All-time audit event totals, optionally limited to *event_types*."""
+        with self.lock:
+            if event_types:
+                placeholders = ",".join(["?"] * len(event_types))
+                rows = self.conn.execute(f"SELECT event_type, count FROM audit_stats_event WHERE event_type IN ({placeholders})",
+                                         tuple(event_types)).fetchall()
+            else:
+                rows = self.conn.execute("SELECT event_type, count FROM audit_stats_event").fetchall()
+        return dict(rows)
+
+    def get_hourly_trend(self, event_types, hours: int = 24) -> List[int]:
+        """Per-hour totals of *event_types* for the last *hours* hours, oldest first."""
+        current = int(time.time() // 3600)
+        first = current - hours + 1
+        placeholders = ",".join(["?"] * len(event_types))
+        with self.lock:
+            rows = self.conn.execute(f"""
+                SELECT hour, SUM(count) FROM audit_stats_hourly
+                WHERE hour >= ? AND event_type IN ({placeholders}) GROUP BY hour
+            """, (first,) + tuple(event_types)).fetchall()
+        counts = dict(rows)
+        return [counts.get(hour, 0) for hour in range(first, current + 1)]
+
+    def get_top_ips(self, event_types, limit: int = 5) -> List[Tuple]:
+        """(ip_address, total) pairs with the most *event_types* events."""
+        placeholders = ",".join(["?"] * len(event_types))
+        with self.lock:
+            return self.conn.execute(f"""
+                SELECT ip_address, SUM(count) AS total FROM audit_stats_ip
+                WHERE event_type IN ({placeholders}) GROUP BY ip_address ORDER BY total DESC LIMIT ?
+            """, tuple(event_types) + (limit,)).fetchall()
+
+    def iter_audit_logs(self, event_type: str = None, ip_address: str = None, since: float = None, until: float = None,
+                        batch_size: int = 1000):
+        """Streams matching audit rows oldest first, one short lock hold per batch."""
+        clauses, params = self._audit_filter(event_type, ip_address, since, until)
+        query = f"SELECT id, event_type, details, timestamp, ip_address FROM audit_logs WHERE {' AND '.join(clauses + ['id > ?'])} ORDER BY id LIMIT ?"
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(query, params + [last_id, batch_size]).fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+
+    def rollover_audit_logs(self, archive, max_age: float = None, max_rows: int = None, segment_size: int = 5000,
+                            should_continue=None) -> int:
+        """Moves audit rows older than *max_age* seconds, or beyond the newest *max_rows*,
+        into *archive* segments. Stops between segments when *should_continue()* returns False.
+        Returns the number of rows archived."""
+        with self.lock:
+            # An interrupted rollover can leave the rows of the last segment in both places.
+            # The archive may predate this database (ids restart), so they are only deleted
+            # if they are exactly the rows the segment describes.
+            segment = archive.segments[-1] if archive.segments else None
+            if segment:
+                row = self.conn.execute("SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM audit_logs WHERE id BETWEEN ? AND ?",
+                                        (segment['first_id'], segment['last_id'])).fetchone()
+                if row == (segment['count'], segment['first_ts'], segment['last_ts']):
+                    with self.conn:
+                        self.conn.execute("DELETE FROM audit_logs WHERE id BETWEEN ? AND ?",
+                                          (segment['first_id'], segment['last_id']))
+            cutoff = 0
+            if max_age:
+                row = self.conn.execute("SELECT MAX(id) FROM audit_logs WHERE timestamp < ?", (time.time() - max_age,)).fetchone()
+                cutoff = max(cutoff, row[0] or 0)
+            if max_rows:
+                row = self.conn.execute("SELECT id FROM audit_logs ORDER BY id DESC LIMIT 1 OFFSET ?", (max_rows,)).fetchone()
+                cutoff = max(cutoff, row[0] if row else 0)
+
+        archived = 0
+        last_id = 0
+        while last_id < cutoff and (should_continue is None or should_continue()):
+            with self.lock:
+                rows = self.conn.execute("SELECT id, event_type, details, timestamp, ip_address FROM audit_logs WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                                         (last_id, cutoff, segment_size)).fetchall()
+            if not rows:
+                break
+            # Written before the delete, so a crash can only leave rows in both places
+            archive.write_segment(rows)
+            last_id = rows[-1][0]
+            with self.lock:
+                with self.conn:
+                    self.conn.execute("DELETE FROM audit_logs WHERE id <= ?", (last_id,))
+            archived += len(rows)
+        return archived
+
     def get_incident_count(self, ip: str, timeframe_seconds: int) -> int:
         since = time.time() - timeframe_seconds
         # Suspicious events that contribute to auto-blocking
@@ -548,5 +1430,439 @@ class Database:
     def reap_expired_messages(self) -> int:
         return self.delete_expired_messages()
 
+    def migrate_legacy_ciphertext(self, batch_size: int = 500, pause: float = 0.01, stop_event=None,
+                                  progress_callback=None) -> int:
+        """Rewrites legacy "enc:" TEXT values as binary BLOBs in small batches.
+        The lock is released between batches so chat traffic is not blocked.
+        *progress_callback(done, total)* is called after each batch with row counts.
+        Returns the number of values converted."""
+        conditions = {}
+        for table, columns in ENCRYPTED_COLUMNS.items():
+            conditions[table] = " OR ".join(f"(typeof({c}) = 'text' AND substr({c}, 1, 4) = 'enc:')" for c in columns)
+        total = 0
+        if progress_callback:
+            with self.lock:
+                for table, legacy in conditions.items():
+                    total += self.conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {legacy}").fetchone()[0]
+        done = 0
+        converted = 0
+        for table, columns in ENCRYPTED_COLUMNS.items():
+            legacy = conditions[table]
+            select = f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? AND ({legacy}) ORDER BY rowid LIMIT ?"
+            last_rowid = 0
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    return converted
+                with self.lock:
+                    rows = self.conn.execute(select, (last_rowid, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+
+                # Conversion is a pure re-encoding (no key needed), done outside the lock
+                updates = {c: [] for c in columns}
+                for row in rows:
+                    for column, value in zip(columns, row[1:]):
+                        blob = EncryptionManager.upgrade_legacy(value)
+                        if blob is not None:
+                            updates[column].append((blob, row[0], value))
+
+                with self.lock:
+                    with self.conn:
+                        for column, params in updates.items():
+                            if not params:
+                                continue
+                            # Compare-and-set: skip rows that were rewritten since we read them
+                            cursor = self.conn.executemany(
+                                f"UPDATE {table} SET {column} = ? WHERE rowid = ? AND {column} = ?", params)
+                            converted += cursor.rowcount
+                done += len(rows)
+                if progress_callback:
+                    progress_callback(done, total)
+                if pause:
+                    time.sleep(pause)
+        return converted
+
+    def purge_tombstones(self, older_than: float, batch_size: int = 500, should_continue=None) -> int:
+        """Hard-deletes messages soft-deleted before *older_than*, one batch per lock hold.
+        Stops early when *should_continue()* returns False. Returns the number of rows purged."""
+        purged = 0
+        while should_continue is None or should_continue():
+            with self.lock:
+                with self.conn:
+                    cursor = self.conn.execute("""
+                        DELETE FROM messages WHERE rowid IN (
+                            SELECT rowid FROM messages WHERE is_deleted = 1 AND deleted_at < ? LIMIT ?)
+                    """, (older_than, batch_size))
+            purged += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                break
+        return purged
+
+    def _prune_messages(self, where: str, params, now: float, limit: int, byte_target: int = None) -> List[Tuple]:
+        """Hard-deletes up to *limit* of the oldest live messages matching *where* (messages past
+        their TTL first), stopping once *byte_target* bytes are covered. Keeps the summaries and
+        caches in step. Returns the deleted (id, recipient, timestamp, is_incoming, size) rows."""
+        with self.lock:
+            with self.conn:
+                rows = self.conn.execute(f"""
+                    SELECT id, recipient, timestamp, is_incoming, COALESCE(length(content), 0) FROM messages
+                    WHERE is_deleted = 0 AND {where}
+                    ORDER BY (expires_at IS NOT NULL AND expires_at <= ?) DESC, timestamp LIMIT ?
+                """, (*params, now, limit)).fetchall()
+                if byte_target is not None:
+                    covered = 0
+                    for i, row in enumerate(rows):
+                        covered += row[4]
+                        if covered >= byte_target:
+                            rows = rows[:i + 1]
+                            break
+                if rows:
+                    placeholders = ",".join(["?"] * len(rows))
+                    self.conn.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", [row[0] for row in rows])
+                    self._conversation_removed(rows)
+            for row in rows:
+                self.cipher.cache.invalidate('messages', row[0])
+            self.history.remove([row[0] for row in rows])
+        return rows
+
+    def _prune_until(self, where: str, params, now: float, rows_wanted: int = None, bytes_wanted: int = None,
+                     batch_size: int = 500, should_continue=None) -> List[Tuple]:
+        """Runs _prune_messages one batch per lock hold until *rows_wanted* rows or
+        *bytes_wanted* bytes are gone (everything matching when neither is given)."""
+        pruned = []
+        freed = 0
+        while should_continue is None or should_continue():
+            limit = batch_size if rows_wanted is None else min(batch_size, rows_wanted - len(pruned))
+            target = None if bytes_wanted is None else bytes_wanted - freed
+            if limit <= 0 or (target is not None and target <= 0):
+                break
+            rows = self._prune_messages(where, params, now, limit, target)
+            pruned += rows
+            freed += sum(row[4] for row in rows)
+            if not rows or (target is None and len(rows) < limit):
+                break
+        return pruned
+
+    def _stored_message_bytes(self, peer: str = None, everything: bool = False) -> int:
+        """Recounts live ciphertext bytes, for a conversation (by conversations.peer) or overall.
+        Also corrects the summary, which drifts while legacy values are still being converted."""
+        with self.lock:
+            with self.conn:
+                if everything:
+                    return self.conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM messages WHERE is_deleted = 0").fetchone()[0]
+                if peer == GLOBAL_CONVERSATION:
+                    size = self.conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM messages WHERE recipient IS NULL AND is_deleted = 0").fetchone()[0]
+                else:
+                    size = self.conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM messages WHERE recipient = ? AND is_deleted = 0",
+                                             (peer,)).fetchone()[0]
+                self.conn.execute("UPDATE conversations SET byte_count = ? WHERE peer = ?", (size, peer))
+        return size
+
+    def enforce_retention(self, policy: dict, overrides: dict = None, max_total_bytes: int = 0,
+                          batch_size: int = 500, should_continue=None) -> dict:
+        """Hard-deletes the oldest messages beyond a retention policy, a dict of 'max_messages',
+        'max_age' (seconds) and 'max_bytes' (0 or missing = no limit).
+
+        *policy* applies to every conversation without an entry in *overrides* (keyed by peer IP,
+        None for the global chat); *max_total_bytes* caps all conversations together. Messages
+        already past their TTL go first, and tombstones are left to purge_tombstones. Stops early
+        when *should_continue()* returns False. Returns the rows pruned per rule and the affected
+        conversations."""
+        now = time.time()
+        overrides = overrides or {}
+        result = {'age': 0, 'count': 0, 'bytes': 0, 'conversations': set()}
+        with self.lock:
+            summaries = self.conn.execute("SELECT peer, message_count, byte_count FROM conversations").fetchall()
+
+        for peer, message_count, byte_count in summaries:
+            rules = overrides.get(None if peer == GLOBAL_CONVERSATION else peer, policy)
+            if peer == GLOBAL_CONVERSATION:
+                scope, params = "recipient IS NULL", ()
+            else:
+                scope, params = "recipient = ?", (peer,)
+            pruned = []
+            if rules.get('max_age'):
+                rows = self._prune_until(f"{scope} AND timestamp < ?", params + (now - rules['max_age'],), now,
+                                         batch_size=batch_size, should_continue=should_continue)
+                result['age'] += len(rows)
+                pruned += rows
+            if rules.get('max_messages') and message_count - len(pruned) > rules['max_messages']:
+                rows = self._prune_until(scope, params, now, rows_wanted=message_count - len(pruned) - rules['max_messages'],
+                                         batch_size=batch_size, should_continue=should_continue)
+                result['count'] += len(rows)
+                pruned += rows
+            if rules.get('max_bytes') and byte_count - sum(row[4] for row in pruned) > rules['max_bytes']:
+                excess = self._stored_message_bytes(peer) - rules['max_bytes']
+                if excess > 0:
+                    rows = self._prune_until(scope, params, now, bytes_wanted=excess,
+                                             batch_size=batch_size, should_continue=should_continue)
+                    result['bytes'] += len(rows)
+                    pruned += rows
+            result['conversations'].update(row[1] for row in pruned)
+
+        if max_total_bytes and (should_continue is None or should_continue()):
+            with self.lock:
+                total = self.conn.execute("SELECT COALESCE(SUM(byte_count), 0) FROM conversations").fetchone()[0]
+            if total > max_total_bytes:
+                excess = self._stored_message_bytes(everything=True) - max_total_bytes
+                if excess > 0:
+                    rows = self._prune_until("1", (), now, bytes_wanted=excess,
+                                             batch_size=batch_size, should_continue=should_continue)
+                    result['bytes'] += len(rows)
+                    result['conversations'].update(row[1] for row in rows)
+        return result
+
+    def needs_vacuum_conversion(self) -> bool:
+        """True for a database created before auto_vacuum was set (see enable_incremental_vacuum)."""
+        with self.lock:
+            return self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+
+    def enable_incremental_vacuum(self) -> bool:
+        """Switches a database created before auto_vacuum was set to incremental mode.
+        This needs a full VACUUM that blocks every other database user while it rewrites
+        the file, so it only runs when the user asks for it. Returns True if it ran."""
+        with self.lock:
+            if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return False
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.conn.execute("VACUUM")
+        return True
+
+    def incremental_vacuum(self, time_budget: float = 0.5, pages_per_step: int = 256, should_continue=None) -> int:
+        """Returns free pages to the filesystem in small steps until none are left or
+        *time_budget* seconds have passed. Returns the number of pages released."""
+        deadline = time.perf_counter() + time_budget
+        released = 0
+        while time.perf_counter() < deadline and (should_continue is None or should_continue()):
+            with self.lock:
+                free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free:
+                    break
+                # The pragma only releases pages as its result rows are stepped
+                self.conn.execute(f"PRAGMA incremental_vacuum({int(pages_per_step)})").fetchall()
+                released += free - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return released
+
+    def checkpoint_wal(self):
+        """Copies the WAL into the database and truncates it. Returns (busy, log_frames, checkpointed)."""
+        with self.lock:
+            return self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+
+    def storage_size(self) -> int:
+        """Bytes used on disk by the database and its WAL."""
+        total = 0
+        for path in (self.db_name, self.db_name + "-wal"):
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def run_maintenance(self, tombstone_retention: float, time_budget: float = 2.0, should_continue=None) -> dict:
+        """Purges tombstones older than *tombstone_retention* seconds, vacuums free pages
+        within *time_budget* and checkpoints the WAL. Returns what was reclaimed."""
+        size_before = self.storage_size()
+        purged = self.purge_tombstones(time.time() - tombstone_retention, should_continue=should_continue)
+        pages = self.incremental_vacuum(time_budget, should_continue=should_continue)
+        self.checkpoint_wal()
+        return {
+            'tombstones_purged': purged,
+            'pages_released': pages,
+            'bytes_reclaimed': max(0, size_before - self.storage_size()),
+        }
+
+    def key_rotation_pending(self) -> bool:
+        """True while data encrypted under a retired key may remain (a rotation is in progress)."""
+        return len(self.cipher.key_generations()) > 1
+
+    def _load_rekey_state(self):
+        """Returns the (table, rowid) a re-encryption pass stopped after, or None."""
+        value = self.get_config(REKEY_STATE_KEY)
+        if not value:
+            return None
+        table, rowid = value.rsplit(":", 1)
+        return table, int(rowid)
+
+    def _count_stale_ciphertext(self, table: str) -> int:
+        """Rows of *table* holding values not encrypted under the active key."""
+        conditions = " OR ".join(f"(typeof({c}) = 'blob' AND substr({c}, 1, 1) != ?) OR (typeof({c}) = 'text' AND substr({c}, 1, 4) = 'enc:')"
+                                 for c in ENCRYPTED_COLUMNS[table])
+        active = bytes((self.cipher.generation,))
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {conditions}",
+                                     [active] * len(ENCRYPTED_COLUMNS[table])).fetchone()[0]
+
+    def rekey(self, batch_size: int = 200, pause: float = 0.01, stop_event=None, progress_callback=None) -> int:
+        """Rotates the data key and re-encrypts every stored value under the new one.
+
+        Tables are walked in rowid batches; each batch commits together with its resume
+        point in app_config, so the lock is only held briefly and an interrupted run
+        (crash or *stop_event*) continues where it stopped on the next call. Old keys
+        stay in the keyring until nothing needs them. *progress_callback(done, total)*
+        receives row counts. Returns the number of values re-encrypted."""
+        if not self.key_rotation_pending():
+            with self._keyring_lock:
+                self.cipher.rotate_key()
+            with self.lock:
+                with self.conn:
+                    self.conn.execute("DELETE FROM app_config WHERE key = ?", (REKEY_STATE_KEY,))
+        tables = list(ENCRYPTED_COLUMNS)
+        state = self._load_rekey_state()
+        start_table, last_rowid = state if state else (tables[0], 0)
+        start_index = tables.index(start_table)
+
+        total = done = 0
+        with self.lock:
+            for index, table in enumerate(tables):
+                count = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                total += count
+                if index < start_index:
+                    done += count
+                elif index == start_index:
+                    done += self.conn.execute(f"SELECT COUNT(*) FROM {table} WHERE rowid <= ?", (last_rowid,)).fetchone()[0]
+
+        # Decrypting through self.cipher after a lock would yield "[Encrypted]" placeholders
+        # (and encrypt() passes plaintext through), so the run works from its own copy and
+        # stops at the next batch once the app is locked
+        keys = self.cipher.snapshot()
+        try:
+            return self._rekey_tables(keys, tables[start_index:], start_table, last_rowid, done, total,
+                                      batch_size, pause, stop_event, progress_callback)
+        finally:
+            keys.lock()
+
+    def _rekey_tables(self, keys, tables, start_table, last_rowid, done, total,
+                      batch_size, pause, stop_event, progress_callback) -> int:
+        rekeyed = 0
+        failed = 0
+        for table in tables:
+            columns = ENCRYPTED_COLUMNS[table]
+            select = f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+            if table != start_table:
+                last_rowid = 0
+            while True:
+                if (stop_event is not None and stop_event.is_set()) or self.cipher.is_locked():
+                    return rekeyed
+                with self.lock:
+                    rows = self.conn.execute(select, (last_rowid, batch_size)).fetchall()
+                if not rows:
+                    break
+
+                # Crypto runs without the lock; writes are compare-and-set against the value read
+                updates = []
+                for row in rows:
+                    for column, value in zip(columns, row[1:]):
+                        if isinstance(value, bytes):
+                            stale = value[0] != keys.generation
+                        else:
+                            stale = isinstance(value, str) and value.startswith(LEGACY_CIPHERTEXT_PREFIX)
+                        if not stale:
+                            continue
+                        plaintext = keys.decrypt(value)
+                        if plaintext == "[Encrypted]":
+                            return rekeyed
+                        if plaintext == "[Decryption Failed]":
+                            failed += 1
+                            continue
+                        updates.append((column, keys.encrypt(plaintext), row[0], value))
+
+                last_rowid = rows[-1][0]
+                with self.lock:
+                    if self.cipher.is_locked():
+                        # Locked while this batch was being converted; the next run redoes it
+                        return rekeyed
+                    with self.conn:
+                        for column, new_value, rowid, old_value in updates:
+                            cursor = self.conn.execute(f"UPDATE {table} SET {column} = ? WHERE rowid = ? AND {column} = ?",
+                                                       (new_value, rowid, old_value))
+                            rekeyed += cursor.rowcount
+                        # An upsert keeps the row's rowid (REPLACE would move it ahead of the walk)
+                        self.conn.execute("""
+                            INSERT INTO app_config (key, value) VALUES (?, ?)
+                            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                        """, (REKEY_STATE_KEY, f"{table}:{last_rowid}"))
+                done += len(rows)
+                if progress_callback:
+                    progress_callback(min(done, total), total)
+                if pause:
+                    time.sleep(pause)
+
+        with self.lock:
+            if self.cipher.is_locked():
+                return rekeyed
+            with self.conn:
+                self.conn.execute("DELETE FROM app_config WHERE key = ?", (REKEY_STATE_KEY,))
+        with self._keyring_lock:
+            if any(self._count_stale_ciphertext(table) for table in ENCRYPTED_COLUMNS):
+                # Unreadable values, or rows written with an old key mid-pass; the next run retries
+                print(f"[DEBUG] Key rotation left stale values ({failed} could not be decrypted); old keys kept.")
+            else:
+                self.cipher.retire_keys()
+        return rekeyed
+
+    def backup_to(self, dest_path: str, pages: int = 256, sleep: float = 0.005, progress_callback=None) -> dict:
+        """Writes a consistent snapshot of the live database to *dest_path* with the SQLite backup API.
+
+        The copy runs on its own connection inside a read transaction, so it sees one snapshot
+        and never restarts, while the app keeps writing through the WAL. Pages are copied in
+        batches with a pause in between. The result is integrity-checked before it replaces
+        *dest_path*. The key file, with every key generation the snapshot uses, is copied to
+        *dest_path* + ".key", so the backup stays restorable after a key rotation retires them.
+        *progress_callback(done, total)* is called with page counts."""
+        start = time.perf_counter()
+        tmp_path = dest_path + ".tmp"
+        key_path = dest_path + ".key"
+        for path in (tmp_path, key_path + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+        source = sqlite3.connect(self.db_name, isolation_level=None)
+        dest = sqlite3.connect(tmp_path)
+        try:
+            with self._keyring_lock:
+                source.execute("BEGIN")
+                source.execute("SELECT 1 FROM sqlite_master LIMIT 1")  # Pins the read snapshot
+                if os.path.exists(self.cipher.key_file):
+                    shutil.copyfile(self.cipher.key_file, key_path + ".tmp")
+            total = [0]
+
+            def report(status, remaining, page_count):
+                total[0] = page_count
+                if progress_callback:
+                    progress_callback(page_count - remaining, page_count)
+            source.backup(dest, pages=pages, progress=report, sleep=sleep)
+            source.execute("COMMIT")
+
+            result = dest.execute("PRAGMA integrity_check").fetchone()[0]
+            if result != "ok":
+                raise sqlite3.DatabaseError(f"Backup integrity check failed: {result}")
+            # A standalone file: no -wal/-shm companions needed to restore it
+            dest.execute("PRAGMA journal_mode=DELETE")
+        except Exception:
+            dest.close()
+            for path in (tmp_path, key_path + ".tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        finally:
+            source.close()
+        dest.close()
+        if os.path.exists(key_path + ".tmp"):
+            os.replace(key_path + ".tmp", key_path)
+        os.replace(tmp_path, dest_path)
+        return {
+            'path': dest_path,
+            'pages': total[0],
+            'bytes': os.path.getsize(dest_path),
+            'seconds': time.perf_counter() - start,
+        }
+
     def close(self):
+        self._stop_touch_flush.set()
+        try:
+            self.flush_peer_touches()
+        except Exception as e:
+            print(f"[DEBUG] Peer touch flush error: {e}")
+        self._stop_migrations.set()
+        if self._migration_thread is not None:
+            self._migration_thread.join(timeout=5)
+        self.cipher.close()
         self.conn.close()
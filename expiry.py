@@ -0,0 +1,113 @@
+import heapq
+import threading
+import time
+import audit
+
+
+class ExpiryScheduler:
+    """Deletes expired messages and file shares when they expire instead of polling.
+
+    Upcoming expires_at deadlines are kept in a min-heap seeded from the expires_at
+    indexes and fed by new inserts (via Database.add_expiry_listener). The worker sleeps
+    until the earliest deadline, deletes in bounded batches and reports which
+    conversations were affected.
+    """
+    SEED_LIMIT = 512
+    BATCH_SIZE = 200
+    # Upper bound on a single sleep so wall-clock changes are picked up eventually
+    MAX_SLEEP = 300
+
+    def __init__(self, db, on_expired=None):
+        """*on_expired(conversations, file_count)* receives the set of affected conversations
+        (a peer IP, or None for the global chat) and the number of file shares removed."""
+        self.db = db
+        self.on_expired = on_expired
+        self._heap = []
+        self._horizon = None  # Last seeded deadline when the seed was truncated
+        self._cond = threading.Condition()
+        self.running = False
+        self._thread = None
+        db.add_expiry_listener(self.schedule)
+
+    def start(self):
+        self.running = True
+        self._reseed()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+
+    def schedule(self, deadline: float):
+        """Adds a deadline; wakes the worker if it is now the earliest one."""
+        with self._cond:
+            if self._horizon is not None and deadline > self._horizon:
+                return  # Loaded by the next reseed
+            heapq.heappush(self._heap, deadline)
+            if self._heap[0] == deadline:
+                self._cond.notify()
+
+    def _reseed(self):
+        deadlines = self.db.get_next_expiries(self.SEED_LIMIT)
+        with self._cond:
+            self._heap = deadlines  # Sorted, so already a valid heap
+            self._horizon = deadlines[-1] if len(deadlines) >= self.SEED_LIMIT else None
+
+    def _wait_for_deadline(self) -> bool:
+        """Blocks until the earliest deadline passes. Returns False when stopped."""
+        with self._cond:
+            while self.running:
+                if not self._heap:
+                    if self._horizon is not None:
+                        return True  # Seed exhausted; reap and reload
+                    self._cond.wait(self.MAX_SLEEP)
+                    continue
+                delay = self._heap[0] - time.time()
+                if delay <= 0:
+                    return True
+                self._cond.wait(min(delay, self.MAX_SLEEP))
+            return False
+
+    def _run(self):
+        while self._wait_for_deadline():
+            now = time.time()
+            with self._cond:
+                while self._heap and self._heap[0] <= now:
+                    heapq.heappop(self._heap)
+                needs_reseed = not self._heap and self._horizon is not None
+            try:
+                self._reap(now)
+                if needs_reseed:
+                    self._reseed()
+            except Exception as e:
+                print(f"[DEBUG] Expiry scheduler error: {e}")
+                time.sleep(1)
+
+    def _reap(self, now: float):
+        conversations = set()
+        msg_count = 0
+        while True:
+            rows = self.db.delete_expired_messages_batch(now, self.BATCH_SIZE)
+            msg_count += len(rows)
+            conversations.update(row[1] for row in rows)
+            if len(rows) < self.BATCH_SIZE:
+                break
+
+        file_count = 0
+        while True:
+            deleted = self.db.delete_expired_files_batch(now, self.BATCH_SIZE)
+            file_count += deleted
+            if deleted < self.BATCH_SIZE:
+                break
+
+        logger = audit.get_logger()
+        if logger:
+            if msg_count:
+                logger.log("DATA_RETENTION", f"Automatically reaped {msg_count} expired messages.")
+            if file_count:
+                logger.log("DATA_RETENTION", f"Automatically reaped {file_count} expired file shares.")
+
+        if (msg_count or file_count) and self.on_expired:
+            self.on_expired(conversations, file_count)
@@ -3,40 +3,109 @@ import threading
 import os
 import json
 import time
+import struct
 import hashlib
-import functools
+from collections import deque
 import security_engine
 from pathlib import Path
 from ssl_utils import wrap_socket, get_peer_fingerprint
+from chunked_download import ChunkedDownloader, RangeNotSupported
+from hash_index import HashIndex, RunningHash
+import chunk_hashes
+from chunk_hashes import ChunkMismatch, ChunkVerifier
 import audit
 
-@functools.lru_cache(maxsize=1024)
-def _calculate_sha256_cached(filepath, mtime, size):
-    """Internal cached hash calculation. Uses mtime and size to invalidate cache."""
-    sha256_hash = hashlib.sha256()
-    try:
-        with open(filepath, "rb") as f:
-            # Read and update hash string value in blocks of 64K
-            for byte_block in iter(lambda: f.read(65536), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
-    except Exception as e:
-        print(f"[DEBUG] Error calculating hash for {filepath}: {e}")
+# Shared by every manager: shares, listings and verified downloads
+_HASH_INDEX = HashIndex()
+
+
+class TransferRefused(Exception):
+    """The peer answered a request with an error; retrying will not help."""
+
+
+class SessionUnsupported(Exception):
+    """The peer predates SESSION connections and PULL_FOLDER_STREAM."""
+
+
+# SESSION frames: a 4-byte big-endian length, then that many bytes of JSON
+_FRAME_HEADER = struct.Struct('>I')
+MAX_REQUEST_FRAME = 64 * 1024
+MAX_RESPONSE_FRAME = 256 * 1024 * 1024  # A folder listing can run to megabytes
+
+
+def _send_frame(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(_FRAME_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    """Receives exactly *size* bytes, or returns None if the peer closed before sending any."""
+    chunks = []
+    received = 0
+    while received < size:
+        chunk = sock.recv(min(65536, size - received))
+        if not chunk:
+            if not received:
+                return None
+            raise ConnectionError("Connection closed mid-frame")
+        chunks.append(chunk)
+        received += len(chunk)
+    return b"".join(chunks)
+
+
+class _StreamReader:
+    """recv() through a buffered file of a socket, so small frames do not cost a read each."""
+    def __init__(self, sock, buffering=256 * 1024):
+        self._file = sock.makefile('rb', buffering=buffering)
+
+    def recv(self, size):
+        return self._file.read1(size)
+
+    def close(self):
+        self._file.close()
+
+
+def _recv_frame(sock, limit):
+    """Reads one frame and returns its decoded JSON, or None if the peer closed the connection."""
+    header = _recv_exact(sock, _FRAME_HEADER.size)
+    if header is None:
         return None
+    (size,) = _FRAME_HEADER.unpack(header)
+    if size > limit:
+        raise ValueError(f"Frame of {size} bytes exceeds {limit}")
+    data = _recv_exact(sock, size) if size else b""
+    if data is None:
+        raise ConnectionError("Connection closed mid-frame")
+    return json.loads(data)
+
 
 class FileTransferManager:
+    # Reconnect attempts after a dropped download; reset whenever an attempt makes progress
+    RESUME_ATTEMPTS = 5
+    RESUME_BACKOFF = 1.0  # Seconds before the first reconnect, doubled each time
+    # Bytes received between updates of the .part.json progress sidecar
+    PROGRESS_SAVE_BYTES = 4 * 1024 * 1024
+    # Pull requests a SESSION keeps outstanding, so small files are not paced by round trips
+    SESSION_WINDOW = 16
+    SESSION_IDLE_TIMEOUT = 60  # Seconds a server waits for the next request of a session
+    STREAM_FLUSH_BYTES = 256 * 1024  # Folder stream data is sent in writes of about this size
+
     @staticmethod
     def calculate_sha256(filepath):
-        """Calculate the SHA-256 hash of a file with metadata-based caching."""
-        try:
-            stat = os.stat(filepath)
-            # Use path, modification time, and size as cache key
-            return _calculate_sha256_cached(filepath, stat.st_mtime, stat.st_size)
-        except Exception as e:
-            # Fallback if stat fails, though unlikely if file exists
-            return None
+        """Calculate the SHA-256 hash of a file, answered from the hash index while the
+        file's mtime and size are unchanged."""
+        return _HASH_INDEX.hash_file(filepath)
 
-    def __init__(self, db, port, save_dir="downloads", bind_ip="0.0.0.0", auth_token=None, allowed_ips=None):
+    @staticmethod
+    def hash_for_sharing(filepath):
+        """Reads a file once for sharing. Returns (sha256, chunk leaves) for Database.add_file;
+        the checksum also goes into the hash index."""
+        checksum, leaves = chunk_hashes.hash_file(filepath)
+        _HASH_INDEX.put(filepath, checksum)
+        return checksum, leaves
+
+    def __init__(self, db, port, save_dir="downloads", bind_ip="0.0.0.0", auth_token=None, allowed_ips=None,
+                 download_streams=4):
         """Initialize the file transfer manager.
         Parameters:
             db: Database instance (can be None for now).
@@ -45,6 +114,7 @@ class FileTransferManager:
             bind_ip: IP address or interface to bind the server socket to.
             auth_token: Optional shared secret token for simple authentication.
             allowed_ips: Optional list of client IPs allowed to connect.
+            download_streams: Most parallel connections used for one large download.
         """
         self.db = db
         # Ensure audit logger is initialized for this database
@@ -55,6 +125,8 @@ class FileTransferManager:
         self.bind_ip = bind_ip
         self.auth_token = auth_token
         self.allowed_ips = allowed_ips
+        self.download_streams = download_streams
+        self.last_download_stats = None  # Throughput of the latest parallel download
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -98,15 +170,14 @@ class FileTransferManager:
         logger = audit.get_logger()
         existing = self.db.get_trusted_peer(ip)
         if existing:
-            # existing: (ip, username, fingerprint, trust_level, last_seen)
-            stored_username = existing[1]
+            # existing: (ip, username, fingerprint, trust_level, ...)
             old_fingerprint = existing[2]
             if old_fingerprint != fingerprint:
                 msg = f"SECURITY ALERT: Certificate fingerprint mismatch for {ip} during file transfer!"
                 print(f"[DEBUG] {msg}")
                 if logger: logger.log("SECURITY_ALERT", msg)
             else:
-                self.db.add_trusted_peer(ip, stored_username or "Unknown", fingerprint)
+                self.db.touch_peer(ip)
         else:
             self.db.add_trusted_peer(ip, "Unknown", fingerprint)
 
@@ -182,42 +253,30 @@ class FileTransferManager:
                 self.receive_stream(client, filename, size)
 
             elif cmd == 'PULL_FILE':
-                if not perms.get('can_download_files'):
-                    if logger: logger.log("SECURITY_ALERT", f"Blocked PULL_FILE from peer {addr[0]}: Download disabled.")
-                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Download disabled'}).encode())
-                    return
-
                 path = req.get('path')
                 if not isinstance(path, str):
                     if logger: logger.log("SECURITY_ALERT", f"Malformed PULL_FILE request from {addr[0]}: path must be a string.")
                     return
-
-                # Security: Check if file is shared and not expired
-                if not self.db.is_file_shared(path):
-                    if logger: logger.log("SECURITY_ALERT", f"Blocked unauthorized PULL_FILE request from {addr[0]}: {path}")
-                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Access denied'}).encode())
+                error = self._check_pull(path, addr, perms)
+                if error:
+                    client.sendall(json.dumps({'status': 'ERR', 'msg': error}).encode())
                     return
 
-                # Sanitize path to prevent directory traversal (Defense in Depth)
-                if ".." in path:
-                    if logger: logger.log("SECURITY_ALERT", f"Blocked potential directory traversal attempt from {addr[0]}: {path}")
-                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Access denied'}).encode())
+                size = os.path.getsize(path)
+                # Optional byte range, used to resume interrupted downloads
+                requested = self._parse_range(req, size)
+                if requested is None:
+                    if engine and not self._past_end(req, size): engine.report_incident(addr[0], "PROTOCOL_VIOLATION", f"Invalid PULL_FILE range from {addr[0]}: {req.get('offset')}+{req.get('length')}")
+                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Invalid range'}).encode())
                     return
-
-                if os.path.exists(path) and os.path.isfile(path):
-                    if logger: logger.log("FILE_TRANSFER", f"Sending file '{path}' to {addr[0]}.")
-                    size = os.path.getsize(path)
-                    client.sendall(json.dumps({'status': 'OK', 'size': size}).encode())
-                    ack = client.recv(1024)
-                    with open(path, 'rb') as f:
-                        while True:
-                            # Use 64KB buffer for faster disk I/O and network sends
-                            data = f.read(65536)
-                            if not data: break
-                            client.sendall(data)
+                offset, length = requested
+                if offset or length < size:
+                    if logger: logger.log("FILE_TRANSFER", f"Sending bytes {offset}-{offset + length} of '{path}' to {addr[0]}.")
                 else:
-                    if logger: logger.log("SECURITY_ALERT", f"Requested file '{path}' not found or expired for {addr[0]}.")
-                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'File not found or expired'}).encode())
+                    if logger: logger.log("FILE_TRANSFER", f"Sending file '{path}' to {addr[0]}.")
+                client.sendall(json.dumps({'status': 'OK', 'size': size, 'offset': offset, 'length': length}).encode())
+                ack = client.recv(1024)
+                self._send_range(client, path, offset, length)
 
             elif cmd == 'LIST_SHARED':
                 if not perms.get('can_list_files'):
@@ -234,60 +293,278 @@ class FileTransferManager:
                         'size': f[3],
                         'is_folder': f[5],
                         'owner': f[4],
-                        'checksum': f[6] if len(f) > 6 else None
+                        'checksum': f[6] if len(f) > 6 else None,
+                        'chunk_root': f[8] if len(f) > 8 else None
                     })
                 data_encoded = json.dumps(file_list).encode()
                 client.sendall(json.dumps({'status': 'OK', 'size': len(data_encoded)}).encode())
                 ack = client.recv(1024)
                 client.sendall(data_encoded)
 
-            elif cmd == 'LIST_FOLDER':
-                if not perms.get('can_list_files'):
-                    if logger: logger.log("SECURITY_ALERT", f"Blocked LIST_FOLDER from peer {addr[0]}: Listing disabled.")
-                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Listing disabled'}).encode())
+            elif cmd == 'GET_CHUNK_HASHES':
+                checksum = req.get('checksum')
+                if not isinstance(checksum, str):
+                    if logger: logger.log("SECURITY_ALERT", f"Malformed GET_CHUNK_HASHES request from {addr[0]}: checksum must be a string.")
                     return
-                # Use pathlib for OS‑independent path handling and include directories in the listing
+                if not perms.get('can_download_files'):
+                    if logger: logger.log("SECURITY_ALERT", f"Blocked GET_CHUNK_HASHES from peer {addr[0]}: Download disabled.")
+                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Download disabled'}).encode())
+                    return
+                leaves = self.db.get_chunk_hashes(checksum)
+                if leaves is None:
+                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'No chunk hashes'}).encode())
+                    return
+                client.sendall(json.dumps({'status': 'OK', 'chunk_size': chunk_hashes.CHUNK_SIZE, 'size': len(leaves)}).encode())
+                ack = client.recv(1024)
+                client.sendall(leaves)
+
+            elif cmd == 'LIST_FOLDER':
                 path_str = req.get('path')
                 if not isinstance(path_str, str):
                     if logger: logger.log("SECURITY_ALERT", f"Malformed LIST_FOLDER request from {addr[0]}: path must be a string.")
                     return
-
-                # Security: Check if folder is actually shared
-                if not self.db.is_file_shared(path_str):
-                    if logger: logger.log("SECURITY_ALERT", f"Blocked unauthorized LIST_FOLDER request from {addr[0]}: {path_str}")
-                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Access denied'}).encode())
+                error = self._check_list(path_str, addr, perms)
+                if error:
+                    client.sendall(json.dumps({'status': 'ERR', 'msg': error}).encode())
                     return
+                data_encoded = json.dumps(self._folder_entries(path_str)).encode()
+                client.sendall(json.dumps({'status': 'OK', 'size': len(data_encoded)}).encode())
+                ack = client.recv(1024)
+                client.sendall(data_encoded)
 
-                base_path = Path(path_str)
-                if base_path.exists() and base_path.is_dir():
-                    entries = []
-                    for entry in base_path.rglob('*'):
-                        rel_path = entry.relative_to(base_path).as_posix()
-                        if entry.is_file():
-                            entries.append({
-                                'type': 'file',
-                                'rel_path': rel_path,
-                                'size': entry.stat().st_size,
-                                'checksum': self.calculate_sha256(str(entry))
-                            })
-                        elif entry.is_dir():
-                            entries.append({
-                                'type': 'dir',
-                                'rel_path': rel_path,
-                                'size': 0
-                            })
-                    data_encoded = json.dumps(entries).encode()
-                    client.sendall(json.dumps({'status': 'OK', 'size': len(data_encoded)}).encode())
-                    ack = client.recv(1024)
-                    client.sendall(data_encoded)
+            elif cmd == 'PULL_FOLDER_STREAM':
+                path_str = req.get('path')
+                max_size = req.get('max_size')
+                if not isinstance(path_str, str) or (max_size is not None and not isinstance(max_size, int)):
+                    if logger: logger.log("SECURITY_ALERT", f"Malformed PULL_FOLDER_STREAM request from {addr[0]}.")
+                    return
+                if not perms.get('can_download_files'):
+                    if logger: logger.log("SECURITY_ALERT", f"Blocked PULL_FOLDER_STREAM from peer {addr[0]}: Download disabled.")
+                    error = 'Download disabled'
                 else:
-                    client.sendall(json.dumps({'status': 'ERR', 'msg': 'Folder not found'}).encode())
+                    error = self._check_list(path_str, addr, perms)
+                if error:
+                    client.sendall(json.dumps({'status': 'ERR', 'msg': error}).encode())
+                    return
+                entries = self._stream_entries(path_str)
+                client.sendall(json.dumps({'status': 'OK', 'files': sum(1 for _, is_file in entries if is_file)}).encode())
+                ack = client.recv(1024)
+                files, sent = self._send_folder_stream(client, path_str, entries, max_size)
+                if logger: logger.log("FILE_TRANSFER", f"Streamed {files} files ({sent} bytes) of '{path_str}' to {addr[0]}.")
+
+            elif cmd == 'SESSION':
+                # Authenticated once above; everything else on this connection is framed
+                client.sendall(json.dumps({'status': 'OK'}).encode())
+                self._serve_session(client, addr, perms)
 
         except Exception as e:
             print(f"[DEBUG] Error handling file client: {e}")
         finally:
             client.close()
 
+    def _check_pull(self, path, addr, perms):
+        """Checks that *addr* may download *path*. Returns the error to send, or None."""
+        logger = audit.get_logger()
+        if not perms.get('can_download_files'):
+            if logger: logger.log("SECURITY_ALERT", f"Blocked PULL_FILE from peer {addr[0]}: Download disabled.")
+            return 'Download disabled'
+
+        # Security: Check if file is shared and not expired
+        if not self.db.is_file_shared(path):
+            if logger: logger.log("SECURITY_ALERT", f"Blocked unauthorized PULL_FILE request from {addr[0]}: {path}")
+            return 'Access denied'
+
+        # Sanitize path to prevent directory traversal (Defense in Depth)
+        if ".." in path:
+            if logger: logger.log("SECURITY_ALERT", f"Blocked potential directory traversal attempt from {addr[0]}: {path}")
+            return 'Access denied'
+
+        if not (os.path.exists(path) and os.path.isfile(path)):
+            if logger: logger.log("SECURITY_ALERT", f"Requested file '{path}' not found or expired for {addr[0]}.")
+            return 'File not found or expired'
+        return None
+
+    @staticmethod
+    def _parse_range(req, size):
+        """The (offset, length) that a pull request asks for within a *size*-byte file, or None if invalid."""
+        offset = req.get('offset', 0)
+        length = req.get('length')
+        if not isinstance(offset, int) or not 0 <= offset <= size or \
+                (length is not None and (not isinstance(length, int) or length < 0)):
+            return None
+        return offset, size - offset if length is None else min(length, size - offset)
+
+    @staticmethod
+    def _past_end(req, size):
+        """True if a pull asks to resume past the end of a *size*-byte file: an honest client
+        whose partial predates the file shrinking, refused without counting an incident."""
+        offset = req.get('offset', 0)
+        return isinstance(offset, int) and offset > size
+
+    def _check_list(self, path_str, addr, perms):
+        """Checks that *addr* may list the shared folder *path_str*. Returns the error to send, or None."""
+        logger = audit.get_logger()
+        if not perms.get('can_list_files'):
+            if logger: logger.log("SECURITY_ALERT", f"Blocked LIST_FOLDER from peer {addr[0]}: Listing disabled.")
+            return 'Listing disabled'
+
+        # Security: Check if folder is actually shared
+        if not self.db.is_file_shared(path_str):
+            if logger: logger.log("SECURITY_ALERT", f"Blocked unauthorized LIST_FOLDER request from {addr[0]}: {path_str}")
+            return 'Access denied'
+
+        if not os.path.isdir(path_str):
+            return 'Folder not found'
+        return None
+
+    def _folder_entries(self, path_str):
+        # Use pathlib for OS‑independent path handling and include directories in the listing
+        base_path = Path(path_str)
+        entries = []
+        for entry in base_path.rglob('*'):
+            rel_path = entry.relative_to(base_path).as_posix()
+            if entry.is_file():
+                entries.append({
+                    'type': 'file',
+                    'rel_path': rel_path,
+                    'size': entry.stat().st_size,
+                    'checksum': self.calculate_sha256(str(entry))
+                })
+            elif entry.is_dir():
+                entries.append({
+                    'type': 'dir',
+                    'rel_path': rel_path,
+                    'size': 0
+                })
+        return entries
+
+    @staticmethod
+    def _stream_entries(path_str):
+        """(rel_path, is_file) for everything under a folder, parents before children."""
+        base_path = Path(path_str)
+        entries = []
+        for entry in sorted(base_path.rglob('*')):
+            if entry.is_file():
+                entries.append((entry.relative_to(base_path).as_posix(), True))
+            elif entry.is_dir():
+                entries.append((entry.relative_to(base_path).as_posix(), False))
+        return entries
+
+    def _send_folder_stream(self, client, path_str, entries, max_size=None):
+        """Sends a folder as one framed archive: per entry a header frame ({'type': 'dir'},
+        {'type': 'file'} followed by its bytes and a {'sha256'} trailer, or {'type': 'skip'} for
+        files over *max_size*, which the peer fetches separately), then an {'type': 'end'} frame.
+        Small entries are coalesced into large writes. Returns (files sent, bytes sent)."""
+        out = bytearray()
+        files = sent = 0
+
+        def frame(message):
+            data = json.dumps(message).encode()
+            out.extend(_FRAME_HEADER.pack(len(data)))
+            out.extend(data)
+
+        for rel_path, is_file in entries:
+            local_path = os.path.join(path_str, rel_path)
+            if not is_file:
+                frame({'type': 'dir', 'rel_path': rel_path})
+                continue
+            try:
+                f = open(local_path, 'rb')
+            except OSError as e:
+                # Removed or unreadable since the walk; the peer's listing never promised it
+                print(f"[DEBUG] Skipping {local_path} in folder stream: {e}")
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if max_size is not None and size > max_size:
+                    frame({'type': 'skip', 'rel_path': rel_path, 'size': size, 'checksum': self.calculate_sha256(local_path)})
+                    continue
+                frame({'type': 'file', 'rel_path': rel_path, 'size': size})
+                digest = hashlib.sha256()
+                remaining = size
+                while remaining > 0:
+                    data = f.read(min(65536, remaining))
+                    if not data:
+                        raise OSError(f"{local_path} shrank while streaming")
+                    digest.update(data)
+                    out.extend(data)
+                    remaining -= len(data)
+                    if len(out) >= self.STREAM_FLUSH_BYTES:
+                        client.sendall(out)
+                        out.clear()
+                frame({'sha256': digest.hexdigest()})
+            files += 1
+            sent += size
+            if len(out) >= self.STREAM_FLUSH_BYTES:
+                client.sendall(out)
+                out.clear()
+        frame({'type': 'end'})
+        client.sendall(out)
+        return files, sent
+
+    def _serve_session(self, client, addr, perms):
+        """Answers the requests of a SESSION connection until the peer closes it.
+
+        Requests are frames (see _send_frame): {'op': 'PULL', 'id', 'path', 'offset', 'length'},
+        {'op': 'LIST_FOLDER', 'id', 'path'} or {'op': 'CLOSE'}. Each is answered in order by a
+        frame carrying the same id; an OK PULL frame is followed directly by the file bytes,
+        with no ACK, so the peer can keep several requests in flight.
+        """
+        logger = audit.get_logger()
+        engine = security_engine.get_engine()
+        client.settimeout(self.SESSION_IDLE_TIMEOUT)
+        files_sent = bytes_sent = 0
+        try:
+            while True:
+                req = _recv_frame(client, MAX_REQUEST_FRAME)
+                if req is None:
+                    break
+                op = req.get('op') if isinstance(req, dict) else None
+                if op == 'CLOSE':
+                    break
+                if op not in ('PULL', 'LIST_FOLDER') or not isinstance(req.get('path'), str):
+                    if engine: engine.report_incident(addr[0], "PROTOCOL_VIOLATION", f"Malformed session request from {addr[0]}.")
+                    break
+
+                path = req['path']
+                if op == 'LIST_FOLDER':
+                    error = self._check_list(path, addr, perms)
+                    if error:
+                        _send_frame(client, {'id': req.get('id'), 'status': 'ERR', 'msg': error})
+                    else:
+                        _send_frame(client, {'id': req.get('id'), 'status': 'OK', 'entries': self._folder_entries(path)})
+                    continue
+
+                error = self._check_pull(path, addr, perms)
+                requested = None if error else self._parse_range(req, os.path.getsize(path))
+                if requested is None:
+                    if not error:
+                        error = 'Invalid range'
+                        if engine and not self._past_end(req, os.path.getsize(path)): engine.report_incident(addr[0], "PROTOCOL_VIOLATION", f"Invalid PULL range from {addr[0]}: {req.get('offset')}+{req.get('length')}")
+                    _send_frame(client, {'id': req.get('id'), 'status': 'ERR', 'msg': error})
+                    continue
+                offset, length = requested
+                _send_frame(client, {'id': req.get('id'), 'status': 'OK', 'size': os.path.getsize(path),
+                                     'offset': offset, 'length': length})
+                self._send_range(client, path, offset, length)
+                files_sent += 1
+                bytes_sent += length
+        finally:
+            # One entry per session; a folder of thousands of files would flood the log otherwise
+            if files_sent and logger:
+                logger.log("FILE_TRANSFER", f"Sent {files_sent} files ({bytes_sent} bytes) to {addr[0]} over one session.")
+
+    def _send_range(self, sock, path, offset, length):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                # Use 64KB buffer for faster disk I/O and network sends
+                data = f.read(min(65536, remaining))
+                if not data: break
+                sock.sendall(data)
+                remaining -= len(data)
+
     def receive_stream(self, sock, filename, size, subfolder=""):
         final_dir = os.path.join(self.save_dir, subfolder)
         if not os.path.exists(final_dir):
@@ -305,51 +582,317 @@ class FileTransferManager:
                 received += len(data)
         print(f"[DEBUG] Received {filename}")
 
-    def download_file(self, target_ip, remote_path, expected_checksum=None, target_port=None):
-        filename = os.path.basename(remote_path)
+    def _connect(self, target_ip, port=None, timeout=10):
+        """Opens a TLS connection to a peer's file server and checks its fingerprint (TOFU)."""
+        raw = socket.create_connection((target_ip, port or self.port), timeout=timeout)
+        s = wrap_socket(raw)
+        fingerprint = get_peer_fingerprint(s)
+        if fingerprint:
+            self._check_tofu(target_ip, fingerprint)
+        return s
+
+    def _open_pull(self, s, remote_path, offset=0, length=None):
+        """Sends a PULL_FILE request and acknowledges the header. Returns the response header;
+        the requested bytes follow on *s*."""
+        payload = {'cmd': 'PULL_FILE', 'path': remote_path}
+        if offset:
+            payload['offset'] = offset
+        if length is not None:
+            payload['length'] = length
+        if self.auth_token is not None:
+            payload['token'] = self.auth_token
+        s.sendall(json.dumps(payload).encode())
+        resp_raw = s.recv(4096).decode()
+        if not resp_raw:
+            raise ConnectionError("Connection closed before response")
+        resp = json.loads(resp_raw)
+        if resp.get('status') != 'OK':
+            raise TransferRefused(resp.get('msg'))
+        s.sendall(b'ACK')
+        return resp
+
+    @staticmethod
+    def _load_partial(local_path, remote_path, expected_checksum):
+        """Returns the progress recorded for an interrupted download of *remote_path*, or None."""
         try:
-            port = target_port if target_port else self.port
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as raw:
-                raw.settimeout(10)
-                raw.connect((target_ip, port))
-                s = wrap_socket(raw)
+            with open(local_path + ".part.json") as f:
+                state = json.load(f)
+            # Content with a known checksum may resume from any peer sharing it
+            if expected_checksum:
+                if state.get('checksum') != expected_checksum:
+                    return None
+            elif state.get('path') != remote_path or state.get('checksum'):
+                return None
+            # Never trust the sidecar beyond what actually reached the disk
+            state['received'] = min(state.get('received', 0), os.path.getsize(local_path + ".part"))
+            return state
+        except (OSError, ValueError):
+            return None
 
-                # TOFU: check peer fingerprint
-                fingerprint = get_peer_fingerprint(s)
-                if fingerprint:
-                    self._check_tofu(target_ip, fingerprint)
+    @staticmethod
+    def _save_partial(local_path, state):
+        try:
+            with open(local_path + ".part.json", 'w') as f:
+                json.dump(state, f)
+        except OSError as e:
+            print(f"[DEBUG] Could not save download progress for {local_path}: {e}")
+
+    @staticmethod
+    def _discard_partial(local_path):
+        for path in (local_path + ".part", local_path + ".part.json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _fetch_file(self, target_ip, remote_path, local_path, expected_checksum=None, port=None, progress=None,
+                    chunks=None):
+        """Downloads *remote_path* into *local_path* through a .part file.
 
-                payload = {'cmd': 'PULL_FILE', 'path': remote_path}
+        Progress is recorded in a .part.json sidecar, so a dropped connection is resumed
+        with a ranged PULL_FILE, here or in a later call after a restart. The finished
+        file is checked against *expected_checksum* (the listing checksum) before it is
+        renamed into place. With *chunks* ((chunk_size, leaves) from get_chunk_hashes) each
+        chunk is verified as it arrives; a bad one ends the transfer there and only it is
+        fetched again. *progress(received, size)* is called as data arrives.
+        Returns True on success.
+        """
+        local_path = str(local_path)
+        part_path = local_path + ".part"
+        state = self._load_partial(local_path, remote_path, expected_checksum)
+        state = {'peer': target_ip, 'path': remote_path, 'checksum': expected_checksum,
+                 'size': state.get('size') if state else None, 'received': state['received'] if state else 0}
+        if chunks:
+            # Resume from a chunk boundary so every new chunk can be verified
+            state['received'] -= state['received'] % chunks[0]
+        digest = RunningHash()
+        attempts = 0
+        backoff = self.RESUME_BACKOFF
+        while True:
+            start_offset = state['received']
+            try:
+                with self._connect(target_ip, port) as s:
+                    resp = self._open_pull(s, remote_path, state['received'])
+                    size = resp.get('size')
+                    if state['received'] and state['size'] is not None and size != state['size']:
+                        # The remote file changed since the partial was saved; never splice old and new bytes
+                        print(f"[DEBUG] {remote_path} changed size ({state['size']} -> {size}); restarting download")
+                        state.update(received=0, size=size)
+                        continue
+                    if resp.get('offset', 0) != state['received']:
+                        # The peer ignored the range (older version) and sends the whole file
+                        state['received'] = 0
+                    state['size'] = size
+                    verifier = ChunkVerifier(chunks[1], chunks[0], size, state['received']) if chunks else None
+                    self._receive_part(s, local_path, state, size - state['received'], progress, digest, verifier)
+                break
+            except TransferRefused as e:
+                if str(e) == 'Invalid range' and state['received']:
+                    # The remote file shrank below the saved offset; start over
+                    print(f"[DEBUG] {remote_path} is shorter than the partial download; restarting")
+                    self._discard_partial(local_path)
+                    state.update(received=0, size=None)
+                    continue
+                print(f"[DEBUG] Download of {remote_path} refused: {e}")
+                return False
+            except (OSError, ValueError) as e:
+                # OSError covers resets, timeouts and TLS errors; ValueError a garbled header or bad chunk
+                if isinstance(e, ChunkMismatch):
+                    self._report_bad_chunk(os.path.basename(local_path), target_ip, e)
+                received = state['received']
+                if os.path.exists(part_path):
+                    self._save_partial(local_path, state)
+                if received > start_offset:
+                    attempts, backoff = 0, self.RESUME_BACKOFF
+                attempts += 1
+                if attempts > self.RESUME_ATTEMPTS:
+                    print(f"[DEBUG] Download of {remote_path} failed at {received} bytes ({e}); kept for a later resume")
+                    return False
+                print(f"[DEBUG] Download of {remote_path} interrupted at {received} bytes ({e}); resuming")
+                time.sleep(backoff)
+                backoff *= 2
+
+        return self._finish_download(local_path, expected_checksum, digest.hexdigest())
+
+    def _receive_part(self, s, local_path, state, length, progress=None, digest=None, verifier=None):
+        """Writes the next *length* bytes from *s* into <local_path>.part at state['received'],
+        keeping state['received'] current and saving the sidecar every PROGRESS_SAVE_BYTES.
+        *digest* (a RunningHash) is brought to the same offset and fed the data as it is
+        written. With a ChunkVerifier, only verified chunks are written and a bad one raises
+        ChunkMismatch. *progress(received, size)* is called as data arrives."""
+        part_path = local_path + ".part"
+        received = state['received']
+        remaining = length
+        if digest:
+            digest.sync(part_path, received)
+        with open(part_path, 'r+b' if received and os.path.exists(part_path) else 'wb') as f:
+            f.seek(received)
+            f.truncate()
+            saved = received
+            while remaining > 0:
+                # Use 64KB buffer for faster network receives and disk writes
+                data = s.recv(min(65536, remaining))
+                if not data:
+                    raise ConnectionError("Connection closed prematurely")
+                remaining -= len(data)
+                if verifier:
+                    data = verifier.feed(data)
+                    if not remaining:
+                        data += verifier.flush()
+                    if not data:
+                        continue
+                f.write(data)
+                if digest:
+                    digest.update(data)
+                received += len(data)
+                state['received'] = received
+                if received - saved >= self.PROGRESS_SAVE_BYTES:
+                    f.flush()
+                    saved = received
+                    self._save_partial(local_path, state)
+                if progress:
+                    try:
+                        progress(received, state['size'])
+                    except Exception as e:
+                        print(f"[DEBUG] Progress callback error for {os.path.basename(local_path)}: {e}")
+
+    @staticmethod
+    def _report_bad_chunk(label, source_ip, error):
+        msg = f"File: {label}, chunk {error.index} from {source_ip} failed verification; re-fetching from offset {error.offset}"
+        print(f"[DEBUG] {msg}")
+        logger = audit.get_logger()
+        if logger: logger.log("FILE_INTEGRITY_FAILURE", msg)
+
+    def get_chunk_hashes(self, target_ip, checksum, chunk_root=None, port=None):
+        """Asks a peer for the chunk leaves of the file whose SHA-256 is *checksum*.
+        Returns (chunk_size, leaves), or None if the peer has none or they do not match
+        *chunk_root* from its listing."""
+        try:
+            with self._connect(target_ip, port, timeout=5) as s:
+                payload = {'cmd': 'GET_CHUNK_HASHES', 'checksum': checksum}
                 if self.auth_token is not None:
                     payload['token'] = self.auth_token
                 s.sendall(json.dumps(payload).encode())
                 resp_raw = s.recv(4096).decode()
+                if not resp_raw:
+                    return None
                 resp = json.loads(resp_raw)
-                if resp.get('status') == 'OK':
-                    size = resp.get('size')
-                    s.sendall(b'ACK')
-                    self.receive_stream(s, filename, size)
-
-                    # Verify integrity
-                    local_path = os.path.join(self.save_dir, filename)
-                    if expected_checksum:
-                        actual_checksum = self.calculate_sha256(local_path)
-                        logger = audit.get_logger()
-                        if actual_checksum == expected_checksum:
-                            print(f"[DEBUG] Integrity verified for {filename}")
-                            if logger: logger.log("FILE_INTEGRITY_SUCCESS", f"File: {filename}, Hash: {actual_checksum}")
-                        else:
-                            print(f"[DEBUG] Integrity FAILURE for {filename}")
-                            if logger: logger.log("FILE_INTEGRITY_FAILURE", f"File: {filename}, Expected: {expected_checksum}, Got: {actual_checksum}")
-                            try:
-                                os.remove(local_path)
-                                print(f"[DEBUG] Deleted corrupted file: {filename}")
-                            except Exception as delete_err:
-                                print(f"[DEBUG] Failed to delete corrupted file {filename}: {delete_err}")
-                else:
-                    print(f"[DEBUG] Download failed: {resp.get('msg')}")
+                if resp.get('status') != 'OK':
+                    return None
+                chunk_size, size = resp.get('chunk_size'), resp.get('size')
+                if not isinstance(chunk_size, int) or chunk_size <= 0 or not isinstance(size, int) or size % chunk_hashes.LEAF_SIZE:
+                    return None
+                s.sendall(b'ACK')
+                leaves = self._recv_all(s, size)
+        except Exception as e:
+            print(f"[DEBUG] Get chunk hashes error: {e}")
+            return None
+        if chunk_root and chunk_hashes.merkle_root(leaves) != chunk_root:
+            print(f"[DEBUG] Chunk hashes from {target_ip} do not match the listed root; ignoring them")
+            return None
+        return chunk_size, leaves
+
+    def _finish_download(self, local_path, expected_checksum=None, actual_checksum=None):
+        """Checks a completed <local_path>.part against *expected_checksum* and renames it into
+        place. *actual_checksum* is the digest computed while receiving; without it the file
+        is read back. The verified digest goes into the hash index. A corrupt file is deleted
+        along with its sidecar. Returns True on success."""
+        label = os.path.basename(local_path)
+        part_path = local_path + ".part"
+        print(f"[DEBUG] Downloaded {label}")
+        # Verify integrity
+        if expected_checksum:
+            if not actual_checksum:
+                actual_checksum = self.calculate_sha256(part_path)
+                _HASH_INDEX.discard(part_path)
+            logger = audit.get_logger()
+            if actual_checksum != expected_checksum:
+                print(f"[DEBUG] Integrity FAILURE for {label}")
+                if logger: logger.log("FILE_INTEGRITY_FAILURE", f"File: {label}, Expected: {expected_checksum}, Got: {actual_checksum}")
+                self._discard_partial(local_path)
+                print(f"[DEBUG] Deleted corrupted file: {label}")
+                return False
+            print(f"[DEBUG] Integrity verified for {label}")
+            if logger: logger.log("FILE_INTEGRITY_SUCCESS", f"File: {label}, Hash: {actual_checksum}")
+        os.replace(part_path, local_path)
+        if actual_checksum:
+            _HASH_INDEX.put(local_path, actual_checksum)
+        self._discard_partial(local_path)
+        return True
+
+    def find_sources(self, checksum, peers, port=None):
+        """Asks each peer in *peers* for its shares (in parallel) and returns the
+        (peer_ip, path) of every shared file whose SHA-256 is *checksum*."""
+        sources = []
+        lock = threading.Lock()
+
+        def query(ip):
+            for item in self.get_shared_files(ip, port):
+                if item.get('checksum') == checksum and not item.get('is_folder'):
+                    with lock:
+                        sources.append((ip, item['path']))
+                    return
+
+        threads = [threading.Thread(target=query, args=(ip,), daemon=True) for ip in peers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sources
+
+    def _download(self, target_ip, remote_path, local_path, expected_checksum=None, size=None, port=None, progress=None,
+                  swarm_peers=None, chunk_root=None):
+        """Downloads over parallel range streams when *size* (from the listing) makes it
+        worthwhile, otherwise over one resumable stream. With *swarm_peers* and a checksum,
+        every one of those peers sharing the same content is used as an extra source.
+        With the listing's *chunk_root*, chunks are verified as they arrive."""
+        chunks = None
+        if chunk_root and expected_checksum and size and size > chunk_hashes.CHUNK_SIZE:
+            chunks = self.get_chunk_hashes(target_ip, expected_checksum, chunk_root, port)
+            if chunks and len(chunks[1]) != chunk_hashes.LEAF_SIZE * chunk_hashes.leaf_count(size, chunks[0]):
+                chunks = None
+        if size and size >= ChunkedDownloader.MIN_SIZE and self.download_streams > 1:
+            sources = [(target_ip, remote_path)]
+            if swarm_peers and expected_checksum:
+                sources += [source for source in self.find_sources(expected_checksum, swarm_peers, port)
+                            if source[0] != target_ip]
+                if len(sources) > 1:
+                    print(f"[DEBUG] Swarm download of {remote_path} from {len(sources)} peers")
+            downloader = ChunkedDownloader(self, sources, local_path, size, expected_checksum,
+                                           max_streams=max(self.download_streams, len(sources)), port=port, progress=progress,
+                                           chunks=chunks)
+            try:
+                return downloader.run()
+            except RangeNotSupported:
+                print(f"[DEBUG] {target_ip} cannot serve ranges; downloading {remote_path} over one stream")
+            finally:
+                self.last_download_stats = downloader.stats
+        return self._fetch_file(target_ip, remote_path, local_path, expected_checksum, port=port, progress=progress,
+                                chunks=chunks)
+
+    def download_file(self, target_ip, remote_path, expected_checksum=None, target_port=None, progress=None, size=None,
+                      swarm_peers=None, chunk_root=None):
+        """Downloads a shared file into save_dir, resuming if an earlier attempt was interrupted.
+        Large files are also fetched from any of *swarm_peers* sharing the same checksum, and
+        verified chunk by chunk when the listing carries a *chunk_root*."""
+        filename = os.path.basename(remote_path)
+        try:
+            return self._download(target_ip, remote_path, os.path.join(self.save_dir, filename),
+                                  expected_checksum, size=size, port=target_port, progress=progress,
+                                  swarm_peers=swarm_peers, chunk_root=chunk_root)
         except Exception as e:
             print(f"[DEBUG] Download error: {e}")
+            return False
+
+    def download_files(self, target_ip, files, progress_callback=None, swarm_peers=None):
+        """Downloads several shared files (LIST_SHARED entries) into save_dir over one session.
+        *progress_callback* is called as for download_folder, with each file's name.
+        Returns one success flag per entry of *files*."""
+        jobs = [{'path': f['path'], 'local_path': os.path.join(self.save_dir, os.path.basename(f['path'])),
+                 'checksum': f.get('checksum'), 'size': f.get('size'), 'chunk_root': f.get('chunk_root'),
+                 'label': f.get('filename') or os.path.basename(f['path'])} for f in files]
+        self._download_batch(target_ip, jobs, progress_callback=progress_callback, swarm_peers=swarm_peers)
+        return [job['result'] for job in jobs]
 
     def download_folder(self, target_ip, remote_path, progress_callback=None):
         """Download an entire folder with rich progress reporting.
@@ -357,129 +900,368 @@ class FileTransferManager:
             (rel_path: str, status: str, file_ratio: float, overall_ratio: float)
         *status* can be "START", "PROGRESS", "DONE" or "ERROR".
         "file_ratio" is the per‑file progress (0‑1). "overall_ratio" is the overall folder progress (0‑1).
+        The folder arrives as one PULL_FOLDER_STREAM when the peer supports it; otherwise, or
+        for whatever an interrupted stream left, the listing and files share one SESSION.
         """
         folder_name = os.path.basename(remote_path)
+        base = os.path.abspath(os.path.join(self.save_dir, folder_name))
+        done = set()
+        # Shared by the stream and the follow-up batch, so overall_ratio runs 0 -> 1 once
+        overall = {'finished': 0, 'total': 1}
         try:
-            # 1️⃣ Get folder listing
-            file_list = []
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as raw:
-                raw.settimeout(10)
-                raw.connect((target_ip, self.port))
-                s = wrap_socket(raw)
-
-                # TOFU: check peer fingerprint
-                fingerprint = get_peer_fingerprint(s)
-                if fingerprint:
-                    self._check_tofu(target_ip, fingerprint)
+            large = self._stream_folder(target_ip, remote_path, base, progress_callback, done, overall)
+            if large is None:
+                return
+            jobs = []
+            for item in large:
+                jobs.append({'path': os.path.join(remote_path, item['rel_path']),
+                             'local_path': self._safe_local_path(base, item['rel_path']),
+                             'checksum': item.get('checksum'), 'size': item.get('size'), 'label': item['rel_path']})
+            self._download_batch(target_ip, jobs, use_session=False, progress_callback=progress_callback,
+                                 overall=overall)
+            return
+        except SessionUnsupported:
+            print(f"[DEBUG] {target_ip} has no folder streams; downloading {remote_path} file by file")
+        except Exception as e:
+            print(f"[DEBUG] Folder stream of {remote_path} interrupted ({e}); fetching the rest file by file")
 
-                payload = {'cmd': 'LIST_FOLDER', 'path': remote_path}
-                if self.auth_token is not None:
-                    payload['token'] = self.auth_token
-                s.sendall(json.dumps(payload).encode())
-                resp_raw = s.recv(4096).decode()
-                resp = json.loads(resp_raw)
+        session = None
+        try:
+            # 1️⃣ Get folder listing
+            try:
+                session = self._open_session(target_ip)
+                _send_frame(session, {'op': 'LIST_FOLDER', 'id': 'list', 'path': remote_path})
+                resp = _recv_frame(session, MAX_RESPONSE_FRAME)
+                if resp is None:
+                    raise ConnectionError("Session closed before the folder listing")
                 if resp.get('status') != 'OK':
                     print(f"[DEBUG] Folder list failed: {resp.get('msg')}")
+                    session.close()
                     return
-                size = resp.get('size')
-                s.sendall(b'ACK')
-                data = self._recv_all(s, size)
-                file_list = json.loads(data)
-
-            # Filter only files
-            files = [f for f in file_list if f.get('type') == 'file']
-            total_files = len(files)
-            for idx, item in enumerate(files, start=1):
-                rel_path = item['rel_path']
-                expected_checksum = item.get('checksum')
-                full_remote_path = os.path.join(remote_path, rel_path)
-                # Notify start
-                if progress_callback:
-                    try:
-                        progress_callback(rel_path, "START", 0.0, (idx - 1) / total_files)
-                    except Exception as e:
-                        print(f"[DEBUG] Progress callback error (START) for {rel_path}: {e}")
-                # Download with per‑file progress reporting
-                success = self._download_file_direct(target_ip, full_remote_path, folder_name, rel_path,
-                                                    per_file_cb=progress_callback,
-                                                    overall_index=idx,
-                                                    overall_total=total_files,
-                                                    expected_checksum=expected_checksum)
-                # Notify end
-                if progress_callback:
-                    try:
-                        status = "DONE" if success else "ERROR"
-                        progress_callback(rel_path, status, 1.0, idx / total_files)
-                    except Exception as e:
-                        print(f"[DEBUG] Progress callback error (END) for {rel_path}: {e}")
+                file_list = resp.get('entries', [])
+            except SessionUnsupported:
+                file_list = self._list_folder(target_ip, remote_path)
+                if file_list is None:
+                    return
+
+            # Filter only files, leaving out any the stream already delivered
+            jobs = []
+            for item in file_list:
+                if item.get('type') != 'file' or item.get('rel_path') in done:
+                    continue
+                local_path = self._safe_local_path(base, item.get('rel_path'))
+                if local_path is None:
+                    self._reject_path(target_ip, item.get('rel_path'))
+                    continue
+                jobs.append({'path': os.path.join(remote_path, item['rel_path']), 'local_path': local_path,
+                             'checksum': item.get('checksum'), 'size': item.get('size'), 'label': item['rel_path']})
+            for parent in {os.path.dirname(job['local_path']) for job in jobs}:
+                os.makedirs(parent, exist_ok=True)
+            # Files the stream delivered stay counted; ones it failed are fetched again
+            overall.update(finished=len(done), total=len(done) + len(jobs) or 1)
+            self._download_batch(target_ip, jobs, session=session, use_session=session is not None,
+                                 progress_callback=progress_callback, overall=overall)
         except Exception as e:
+            if session:
+                session.close()
             print(f"[DEBUG] Folder download error: {e}")
 
-    def _download_file_direct(self, target_ip, remote_path, folder_name, rel_path,
-                            per_file_cb=None, overall_index=0, overall_total=1, expected_checksum=None):
-        """Download a single file with optional per‑file progress callback.
-        Returns *True* on success, *False* on any error.
-        Uses pathlib for cross‑platform path handling and includes auth token if set.
-        """
+    @staticmethod
+    def _safe_local_path(base, rel_path):
+        """Maps a peer-supplied relative path to a path inside *base*, or None if it would escape."""
+        if not isinstance(rel_path, str) or '\0' in rel_path:
+            return None
+        parts = rel_path.split('/')
+        if any(part in ('', '.', '..') for part in parts) or os.path.isabs(rel_path):
+            return None
+        local_path = os.path.normpath(os.path.join(base, *parts))
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as raw:
-                raw.settimeout(10)
-                raw.connect((target_ip, self.port))
-                s = wrap_socket(raw)
-                payload = {'cmd': 'PULL_FILE', 'path': remote_path}
-                if self.auth_token is not None:
-                    payload['token'] = self.auth_token
-                s.sendall(json.dumps(payload).encode())
-                resp_raw = s.recv(4096).decode()
-                resp = json.loads(resp_raw)
-                if resp.get('status') == 'OK':
-                    size = resp.get('size')
-                    s.sendall(b'ACK')
-                    local_path = Path(self.save_dir) / folder_name / rel_path
-                    local_path.parent.mkdir(parents=True, exist_ok=True)
+            if os.path.commonpath([base, local_path]) != base or local_path == base:
+                return None
+        except ValueError:
+            # Different drives on Windows
+            return None
+        return local_path
+
+    @staticmethod
+    def _reject_path(target_ip, rel_path):
+        msg = f"Rejected unsafe path {rel_path!r} in folder from {target_ip}."
+        print(f"[DEBUG] {msg}")
+        logger = audit.get_logger()
+        if logger: logger.log("SECURITY_ALERT", msg)
+
+    def _stream_folder(self, target_ip, remote_path, base, progress_callback=None, done=None, overall=None):
+        """Receives a folder sent as one PULL_FOLDER_STREAM archive into *base*, checking each
+        file against its trailing SHA-256 as it is written. Files too large for the stream
+        (see _download_batch) are left out and returned as listing entries for the caller;
+        returns None if the peer refuses. The rel_path of every verified file is added to
+        *done*. *overall* ({'finished', 'total'}) counts files across the whole folder,
+        including the left-out ones. Raises SessionUnsupported when the peer predates stream mode."""
+        done = set() if done is None else done
+        overall = {'finished': 0, 'total': 1} if overall is None else overall
+        large = []
+        with self._connect(target_ip) as s:
+            payload = {'cmd': 'PULL_FOLDER_STREAM', 'path': remote_path}
+            if self.download_streams > 1:
+                payload['max_size'] = ChunkedDownloader.MIN_SIZE - 1
+            if self.auth_token is not None:
+                payload['token'] = self.auth_token
+            s.sendall(json.dumps(payload).encode())
+            resp_raw = s.recv(4096).decode()
+            if not resp_raw:
+                raise SessionUnsupported(target_ip)
+            resp = json.loads(resp_raw)
+            if resp.get('status') != 'OK':
+                print(f"[DEBUG] Folder stream failed: {resp.get('msg')}")
+                return None
+            s.sendall(b'ACK')
+            overall['total'] = resp.get('files') or 1
+            logger = audit.get_logger()
+
+            def report(rel_path, status, file_ratio):
+                if progress_callback:
+                    try:
+                        progress_callback(rel_path, status, file_ratio, overall['finished'] / overall['total'])
+                    except Exception as e:
+                        print(f"[DEBUG] Progress callback error ({status}) for {rel_path}: {e}")
+
+            reader = _StreamReader(s)
+            try:
+                while True:
+                    header = _recv_frame(reader, MAX_REQUEST_FRAME)
+                    if header is None:
+                        raise ConnectionError("Folder stream ended early")
+                    kind = header.get('type')
+                    if kind == 'end':
+                        break
+                    rel_path = header.get('rel_path')
+                    local_path = self._safe_local_path(base, rel_path)
+                    if local_path is None:
+                        self._reject_path(target_ip, rel_path)
+                        raise ValueError("Unsafe path in folder stream")
+                    if kind == 'dir':
+                        os.makedirs(local_path, exist_ok=True)
+                        continue
+                    if kind == 'skip':
+                        large.append(header)
+                        continue
+                    size = header.get('size')
+                    if kind != 'file' or not isinstance(size, int) or size < 0:
+                        raise ValueError(f"Malformed folder stream entry: {header}")
+
+                    report(rel_path, "START", 0.0)
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    digest = hashlib.sha256()
                     received = 0
-                    with open(local_path, 'wb') as f:
+                    with open(local_path + ".part", 'wb') as f:
                         while received < size:
-                            # Use 64KB buffer
-                            chunk = s.recv(min(65536, size - received))
-                            if not chunk:
+                            data = reader.recv(min(65536, size - received))
+                            if not data:
                                 raise ConnectionError("Connection closed prematurely")
-                            f.write(chunk)
-                            received += len(chunk)
-                            # per‑file progress update
-                            if per_file_cb:
-                                try:
-                                    file_ratio = received / size if size else 0.0
-                                    overall_ratio = overall_index / overall_total
-                                    per_file_cb(rel_path, "PROGRESS", file_ratio, overall_ratio)
-                                except Exception as e:
-                                    print(f"[DEBUG] Progress callback error (PROGRESS) for {rel_path}: {e}")
-                    print(f"[DEBUG] Downloaded {rel_path}")
-
-                    # Verify integrity
-                    if expected_checksum:
-                        actual_checksum = self.calculate_sha256(str(local_path))
-                        logger = audit.get_logger()
-                        if actual_checksum == expected_checksum:
-                            print(f"[DEBUG] Integrity verified for {rel_path}")
-                            if logger: logger.log("FILE_INTEGRITY_SUCCESS", f"File: {rel_path}, Hash: {actual_checksum}")
-                        else:
-                            print(f"[DEBUG] Integrity FAILURE for {rel_path}")
-                            if logger: logger.log("FILE_INTEGRITY_FAILURE", f"File: {rel_path}, Expected: {expected_checksum}, Got: {actual_checksum}")
-                            try:
-                                local_path.unlink(missing_ok=True)
-                                print(f"[DEBUG] Deleted corrupted file: {rel_path}")
-                            except Exception as delete_err:
-                                print(f"[DEBUG] Failed to delete corrupted file {rel_path}: {delete_err}")
-                            return False # Consider integrity failure a download failure
-
-                    return True
-                else:
-                    print(f"[DEBUG] File {rel_path} download error: {resp.get('msg')}")
-                    return False
-        except Exception as e:
-            print(f"[DEBUG] File {rel_path} download error: {e}")
-            return False
+                            f.write(data)
+                            digest.update(data)
+                            received += len(data)
+                            report(rel_path, "PROGRESS", received / size)
+                    trailer = _recv_frame(reader, MAX_REQUEST_FRAME)
+                    if trailer is None:
+                        raise ConnectionError("Folder stream ended early")
+                    success = trailer.get('sha256') == digest.hexdigest()
+                    if success:
+                        os.replace(local_path + ".part", local_path)
+                        _HASH_INDEX.put(local_path, digest.hexdigest())
+                        done.add(rel_path)
+                    else:
+                        os.remove(local_path + ".part")
+                        print(f"[DEBUG] Integrity FAILURE for {rel_path}")
+                        if logger: logger.log("FILE_INTEGRITY_FAILURE", f"File: {rel_path}, Expected: {trailer.get('sha256')}, Got: {digest.hexdigest()}")
+                    overall['finished'] += 1
+                    report(rel_path, "DONE" if success else "ERROR", 1.0)
+            finally:
+                reader.close()
+        print(f"[DEBUG] Streamed {len(done)} files of {remote_path}")
+        return large
+
+    def _list_folder(self, target_ip, remote_path):
+        """Lists a shared folder with a LIST_FOLDER request, for peers without sessions."""
+        with self._connect(target_ip) as s:
+            payload = {'cmd': 'LIST_FOLDER', 'path': remote_path}
+            if self.auth_token is not None:
+                payload['token'] = self.auth_token
+            s.sendall(json.dumps(payload).encode())
+            resp_raw = s.recv(4096).decode()
+            resp = json.loads(resp_raw)
+            if resp.get('status') != 'OK':
+                print(f"[DEBUG] Folder list failed: {resp.get('msg')}")
+                return None
+            size = resp.get('size')
+            s.sendall(b'ACK')
+            return json.loads(self._recv_all(s, size))
+
+    def _download_batch(self, target_ip, jobs, session=None, use_session=True, progress_callback=None, swarm_peers=None,
+                        overall=None):
+        """Downloads *jobs* (dicts with 'path', 'local_path', 'checksum', 'size' and 'label'),
+        setting each one's 'result'. Files too small for parallel streams are pulled over one
+        pipelined session (*session* if already open); large ones, and everything when the
+        peer has no sessions, go through _download one at a time. *overall* ({'finished',
+        'total'}) continues the file count of an earlier phase of the same download."""
+        overall = {'finished': 0, 'total': len(jobs) or 1} if overall is None else overall
+
+        def report(job, status, file_ratio):
+            if progress_callback:
+                try:
+                    progress_callback(job['label'], status, file_ratio, overall['finished'] / overall['total'])
+                except Exception as e:
+                    print(f"[DEBUG] Progress callback error ({status}) for {job['label']}: {e}")
+
+        def finish(job, success):
+            job['result'] = success
+            overall['finished'] += 1
+            report(job, "DONE" if success else "ERROR", 1.0)
+
+        for job in jobs:
+            job['result'] = None
+        small = [job for job in jobs
+                 if not (job.get('size') and job['size'] >= ChunkedDownloader.MIN_SIZE and self.download_streams > 1)]
+        if small and use_session:
+            try:
+                self._pull_over_session(target_ip, small, session, report, finish)
+            except SessionUnsupported:
+                print(f"[DEBUG] {target_ip} does not support sessions; downloading files one by one")
+        elif session:
+            session.close()
+
+        for job in jobs:
+            if job['result'] is not None:
+                continue
+            report(job, "START", 0.0)
+            try:
+                success = self._download(target_ip, job['path'], job['local_path'], job['checksum'], size=job.get('size'),
+                                         progress=lambda received, size, job=job: report(job, "PROGRESS", received / size if size else 0.0),
+                                         swarm_peers=swarm_peers, chunk_root=job.get('chunk_root'))
+            except Exception as e:
+                print(f"[DEBUG] File {job['label']} download error: {e}")
+                success = False
+            finish(job, success)
+
+    def _open_session(self, target_ip, port=None):
+        """Connects and authenticates a SESSION connection. Raises SessionUnsupported when the
+        peer closes on the unknown command, TransferRefused when it rejects us."""
+        s = self._connect(target_ip, port)
+        try:
+            payload = {'cmd': 'SESSION'}
+            if self.auth_token is not None:
+                payload['token'] = self.auth_token
+            s.sendall(json.dumps(payload).encode())
+            resp_raw = s.recv(4096).decode()
+            if not resp_raw:
+                raise SessionUnsupported(target_ip)
+            resp = json.loads(resp_raw)
+            if resp.get('status') != 'OK':
+                raise TransferRefused(resp.get('msg'))
+            return s
+        except BaseException:
+            s.close()
+            raise
+
+    def _pull_over_session(self, target_ip, jobs, session, report, finish, port=None):
+        """Pulls *jobs* in order over a SESSION connection with up to SESSION_WINDOW requests in
+        flight. Files go through .part files and sidecars as in _fetch_file, and a dropped
+        session is reopened to resume from the first unfinished file. *report* and *finish*
+        are the _download_batch callbacks."""
+        pending = deque(jobs)
+        for index, job in enumerate(jobs):
+            partial = self._load_partial(job['local_path'], job['path'], job['checksum'])
+            if partial and job.get('size') is not None and partial.get('size') not in (None, job['size']):
+                partial = None  # The file changed size since the partial was saved; start over
+            job['id'] = index
+            job['state'] = {'peer': target_ip, 'path': job['path'], 'checksum': job['checksum'],
+                            'size': partial.get('size', job.get('size')) if partial else job.get('size'),
+                            'received': partial['received'] if partial else 0}
+            job['digest'] = RunningHash()
+        attempts = 0
+        backoff = self.RESUME_BACKOFF
+        while pending:
+            current = None
+            progressed = False
+            try:
+                s = session or self._open_session(target_ip, port)
+                session = None
+                with s:
+                    waiting = deque(pending)
+                    in_flight = deque()
+                    while waiting or in_flight:
+                        while waiting and len(in_flight) < self.SESSION_WINDOW:
+                            job = waiting.popleft()
+                            _send_frame(s, {'op': 'PULL', 'id': job['id'], 'path': job['path'],
+                                            'offset': job['state']['received']})
+                            in_flight.append(job)
+                        # Responses come back in request order, so this one belongs to pending[0]
+                        job = in_flight.popleft()
+                        resp = _recv_frame(s, MAX_RESPONSE_FRAME)
+                        if resp is None:
+                            raise ConnectionError("Session closed by peer")
+                        if resp.get('id') != job['id']:
+                            raise ValueError(f"Response {resp.get('id')} does not match request {job['id']}")
+                        if resp.get('status') != 'OK':
+                            print(f"[DEBUG] Download of {job['path']} refused: {resp.get('msg')}")
+                            if resp.get('msg') == 'Invalid range':
+                                # Resumed past the end of a file that shrank; the next attempt starts over
+                                self._discard_partial(job['local_path'])
+                            pending.popleft()
+                            finish(job, False)
+                            continue
+                        state = job['state']
+                        size, length = resp.get('size'), resp.get('length')
+                        if not isinstance(size, int) or not isinstance(length, int):
+                            raise ValueError("Malformed PULL response")
+                        if state['received'] and state['size'] is not None and size != state['size']:
+                            # Changed since the partial was saved, as in _fetch_file: skip this reply
+                            # and ask for the whole file again at the back of the pipeline
+                            print(f"[DEBUG] {job['path']} changed size ({state['size']} -> {size}); restarting download")
+                            remaining = length
+                            while remaining:
+                                data = s.recv(min(65536, remaining))
+                                if not data:
+                                    raise ConnectionError("Session closed by peer")
+                                remaining -= len(data)
+                            state.update(received=0, size=size)
+                            pending.popleft()
+                            pending.append(job)
+                            waiting.append(job)
+                            continue
+                        state['size'] = size
+                        if not job.get('started'):
+                            job['started'] = True
+                            report(job, "START", 0.0)
+                        current, start_offset = job, state['received']
+                        self._receive_part(s, job['local_path'], state, length,
+                                           lambda received, size, job=job: report(job, "PROGRESS", received / size if size else 0.0),
+                                           job['digest'])
+                        current = None
+                        progressed = True
+                        pending.popleft()
+                        finish(job, self._finish_download(job['local_path'], job['checksum'], job['digest'].hexdigest()))
+                    _send_frame(s, {'op': 'CLOSE'})
+            except TransferRefused as e:
+                print(f"[DEBUG] Session with {target_ip} refused: {e}")
+                break
+            except (OSError, ValueError) as e:
+                # As in _fetch_file; the file being received keeps its progress
+                if current:
+                    if os.path.exists(current['local_path'] + ".part"):
+                        self._save_partial(current['local_path'], current['state'])
+                    progressed = progressed or current['state']['received'] > start_offset
+                if progressed:
+                    attempts, backoff = 0, self.RESUME_BACKOFF
+                attempts += 1
+                if attempts > self.RESUME_ATTEMPTS:
+                    print(f"[DEBUG] Session with {target_ip} failed with {len(pending)} files left ({e})")
+                    break
+                print(f"[DEBUG] Session with {target_ip} interrupted ({e}); resuming")
+                time.sleep(backoff)
+                backoff *= 2
+        for job in pending:
+            finish(job, False)
 
     def _recv_all(self, sock, size):
         """Efficiently receive exactly *size* bytes from a socket using b''.join()."""
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+class HashIndex:
+    """SHA-256 digests of files by path, trusted while the file's mtime and size are unchanged.
+
+    Entries come from hashing a file (hash_file) or from a digest computed while the file
+    was being written (put), so a freshly downloaded file is known without reading it
+    back. Holds at most *capacity* entries, dropping the least recently used.
+    """
+    CAPACITY = 1024
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, capacity: int = CAPACITY):
+        self.capacity = capacity
+        self._entries = OrderedDict()  # path -> (mtime_ns, size, sha256)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """The indexed digest of *path*, or None if it is unknown or the file has changed."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+                return None
+            self._entries.move_to_end(path)
+            return entry[2]
+
+    def put(self, path, digest: str, stat=None):
+        """Records *digest* for *path* as it is now (or as of *stat*, taken before hashing)."""
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._entries[path] = (stat.st_mtime_ns, stat.st_size, digest)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def discard(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def hash_file(self, path):
+        """The SHA-256 of *path*, read from disk only if the index cannot answer."""
+        digest = self.get(path)
+        if digest:
+            return digest
+        try:
+            # A file modified while it is read gets a newer mtime, so this entry is never served
+            stat = os.stat(path)
+            sha256_hash = hashlib.sha256()
+            with open(path, "rb") as f:
+                for byte_block in iter(lambda: f.read(self.BLOCK_SIZE), b""):
+                    sha256_hash.update(byte_block)
+        except Exception as e:
+            print(f"[DEBUG] Error calculating hash for {path}: {e}")
+            return None
+        digest = sha256_hash.hexdigest()
+        self.put(path, digest, stat)
+        return digest
+
+
+class RunningHash:
+    """SHA-256 of a file written front to back, fed the bytes as they are written."""
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self.length = 0  # Bytes hashed so far
+
+    def update(self, data):
+        self._digest.update(data)
+        self.length += len(data)
+
+    def sync(self, path, length: int):
+        """Makes this the hash of the first *length* bytes of *path*, reading them back only
+        when the hash does not already cover exactly that prefix (a resumed download)."""
+        if length == self.length:
+            return
+        self._digest = hashlib.sha256()
+        self.length = 0
+        if not length:
+            return
+        with open(path, "rb") as f:
+            while self.length < length:
+                data = f.read(min(HashIndex.BLOCK_SIZE, length - self.length))
+                if not data:
+                    raise OSError(f"{path} is shorter than {length} bytes")
+                self.update(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
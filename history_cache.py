@@ -0,0 +1,128 @@
+import bisect
+import threading
+import time
+from collections import deque
+
+
+class MessageRecord:
+    """One decrypted chat message, as held by HistoryCache."""
+    __slots__ = ('id', 'sender', 'content', 'timestamp', 'recipient', 'expires_at')
+
+    def __init__(self, msg_id, sender, content, timestamp, recipient=None, expires_at=None):
+        self.id = msg_id
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp
+        self.recipient = recipient
+        self.expires_at = expires_at
+
+    def as_row(self):
+        """The tuple shape returned by Database.get_messages."""
+        return (self.id, self.sender, self.content, self.timestamp, 0, self.recipient, self.expires_at)
+
+
+class _Window:
+    __slots__ = ('records', 'complete')
+
+    def __init__(self, records, capacity, complete):
+        self.records = deque(records, maxlen=capacity)
+        # True when the window holds every live message of the conversation
+        self.complete = complete
+
+
+class HistoryCache:
+    """The newest messages of each conversation (a peer IP, or None for the global chat),
+    oldest first in a bounded deque.
+
+    A conversation is filled once from the database and then kept current by the
+    Database mutators, so chat views re-render without a query or any decryption.
+    Every mutation bumps *generation*; a fill is dropped if one happened since its
+    query ran. Holds plaintext, so it is cleared whenever the database locks.
+    """
+    CAPACITY = 200
+
+    def __init__(self, capacity: int = CAPACITY):
+        self.capacity = capacity
+        self.generation = 0
+        self._windows = {}
+        self._records = {}  # msg_id -> MessageRecord, for edits and deletes
+        self._lock = threading.Lock()
+
+    def get(self, conversation, limit: int, now: float = None):
+        """Up to *limit* live rows, oldest first, or None when the cache cannot answer."""
+        if limit > self.capacity:
+            return None
+        now = now or time.time()
+        with self._lock:
+            window = self._windows.get(conversation)
+            if window is None:
+                return None
+            live = [record for record in window.records if record.expires_at is None or record.expires_at > now]
+            if len(live) < limit and not window.complete:
+                # Deletes or expiry shrank a truncated window below what was asked for
+                return None
+            return [record.as_row() for record in live[-limit:]]
+
+    def fill(self, conversation, rows, generation: int, limit: int):
+        """Stores rows loaded by Database.get_messages (oldest first, *limit* requested)."""
+        with self._lock:
+            if generation != self.generation:
+                return
+            old = self._windows.get(conversation)
+            if old:
+                for record in old.records:
+                    self._records.pop(record.id, None)
+            records = [MessageRecord(row[0], row[1], row[2], row[3], row[5], row[6]) for row in rows[-self.capacity:]]
+            self._windows[conversation] = _Window(records, self.capacity, complete=len(rows) < limit)
+            for record in records:
+                self._records[record.id] = record
+
+    def add(self, record: MessageRecord):
+        """Puts a new message in its conversation's window, if that conversation is loaded."""
+        with self._lock:
+            self.generation += 1
+            window = self._windows.get(record.recipient)
+            if window is None or record.id in self._records:
+                return
+            records = window.records
+            if records and record.timestamp < records[-1].timestamp:
+                # Received out of order; keep the window sorted by timestamp
+                if len(records) == self.capacity and record.timestamp < records[0].timestamp:
+                    return
+                ordered = list(records)
+                ordered.insert(bisect.bisect_right([r.timestamp for r in ordered], record.timestamp), record)
+                records.clear()
+                records.extend(ordered[-self.capacity:])
+                if len(ordered) > self.capacity:
+                    self._records.pop(ordered[0].id, None)
+                    window.complete = False
+            else:
+                if len(records) == self.capacity:
+                    self._records.pop(records[0].id, None)
+                    window.complete = False
+                records.append(record)
+            self._records[record.id] = record
+
+    def edit(self, msg_id: str, content: str):
+        with self._lock:
+            self.generation += 1
+            record = self._records.get(msg_id)
+            if record:
+                record.content = content
+
+    def remove(self, msg_ids):
+        """Drops deleted or expired messages."""
+        with self._lock:
+            self.generation += 1
+            for msg_id in msg_ids:
+                record = self._records.pop(msg_id, None)
+                if record:
+                    window = self._windows.get(record.recipient)
+                    if window:
+                        window.records.remove(record)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._windows = {}
+            self._records = {}
@@ -0,0 +1,101 @@
+import threading
+import time
+import audit
+from db import GLOBAL_CONVERSATION
+
+
+def _retention_policy(values: dict) -> dict:
+    return {
+        'max_messages': int(values.get("max_messages", 0) or 0),
+        'max_age': float(values.get("max_age_days", 0) or 0) * 86400,
+        'max_bytes': int(float(values.get("max_mb", 0) or 0) * 1024 * 1024),
+    }
+
+
+def retention_from_settings(settings: dict):
+    """Builds Database.enforce_retention arguments from the retention_* settings,
+    or None when no limit is configured."""
+    policy = _retention_policy({key[len("retention_"):]: value for key, value in settings.items()
+                                if key.startswith("retention_")})
+    # Overrides are keyed by peer IP, with "*" for the global chat
+    overrides = {None if peer == GLOBAL_CONVERSATION else peer: _retention_policy(values)
+                 for peer, values in (settings.get("retention_overrides") or {}).items()}
+    max_total_bytes = int(float(settings.get("retention_total_mb", 0) or 0) * 1024 * 1024)
+    if not any(policy.values()) and not max_total_bytes and not any(any(o.values()) for o in overrides.values()):
+        return None
+    return {'policy': policy, 'overrides': overrides, 'max_total_bytes': max_total_bytes}
+
+
+class MaintenanceScheduler:
+    """Runs database housekeeping (history retention, tombstone purge, incremental vacuum,
+    WAL checkpoint) in the background, but only while the app is idle."""
+    CHECK_INTERVAL = 60  # Seconds between idle checks
+    RUN_INTERVAL = 3600  # Minimum seconds between completed runs
+    TIME_BUDGET = 2.0  # Seconds of incremental vacuum per run
+
+    def __init__(self, db, is_idle, tombstone_retention_days: float = 7, audit_archive=None,
+                 audit_retention_days: float = 90, audit_max_rows: int = 50000, retention=None, on_pruned=None):
+        """*is_idle()* is polled before and during a run; work stops as soon as it returns False.
+        Audit rows past either retention limit are rolled into *audit_archive* (0 disables a limit).
+        *retention* (see retention_from_settings) prunes message history; *on_pruned(conversations)*
+        then receives the affected conversations (a peer IP, or None for the global chat)."""
+        self.db = db
+        self.is_idle = is_idle
+        self.tombstone_retention = tombstone_retention_days * 86400
+        self.audit_archive = audit_archive
+        self.audit_retention = audit_retention_days * 86400
+        self.audit_max_rows = audit_max_rows
+        self.retention = retention
+        self.on_pruned = on_pruned
+        self.last_run = 0
+        self.last_result = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.CHECK_INTERVAL):
+            if time.time() - self.last_run < self.RUN_INTERVAL or not self.is_idle():
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[DEBUG] Maintenance error: {e}")
+
+    def run_once(self) -> dict:
+        start = time.perf_counter()
+        should_continue = lambda: not self._stop.is_set() and self.is_idle()
+        pruned = None
+        if self.retention:
+            # Before the vacuum so the freed pages are reclaimed in the same run
+            pruned = self.db.enforce_retention(should_continue=should_continue, **self.retention)
+        archived = 0
+        if self.audit_archive is not None:
+            # Before the vacuum so the freed pages are reclaimed in the same run
+            archived = self.db.rollover_audit_logs(self.audit_archive, self.audit_retention, self.audit_max_rows,
+                                                   should_continue=should_continue)
+        result = self.db.run_maintenance(self.tombstone_retention, self.TIME_BUDGET, should_continue=should_continue)
+        result['audit_archived'] = archived
+        result['retention_pruned'] = sum(pruned[rule] for rule in ('age', 'count', 'bytes')) if pruned else 0
+        self.last_run = time.time()
+        self.last_result = result
+        print(f"[DEBUG] Maintenance finished in {time.perf_counter() - start:.2f}s: {result}")
+
+        logger = audit.get_logger()
+        if logger and result['retention_pruned']:
+            logger.log("DATA_RETENTION", f"Retention policy pruned {result['retention_pruned']} messages from "
+                                         f"{len(pruned['conversations'])} conversations "
+                                         f"(age {pruned['age']}, count {pruned['count']}, size {pruned['bytes']}).")
+        if result['retention_pruned'] and self.on_pruned:
+            self.on_pruned(pruned['conversations'])
+        if logger and (result['tombstones_purged'] or result['bytes_reclaimed'] or archived):
+            logger.log("DB_MAINTENANCE", f"Purged {result['tombstones_purged']} deleted messages, "
+                                         f"archived {archived} audit records, "
+                                         f"reclaimed {result['bytes_reclaimed'] / 1024:.1f} KB.")
+        return result
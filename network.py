@@ -265,7 +265,6 @@ class NetworkManager:
         logger = audit.get_logger()
         existing = self.db.get_trusted_peer(ip)
         if existing:
-            stored_username = existing[1]
             old_fingerprint = existing[2]
             if old_fingerprint != fingerprint:
                 msg = f"SECURITY ALERT: Certificate fingerprint mismatch for {ip}! Possible Man-in-the-Middle attack."
@@ -274,8 +273,8 @@ class NetworkManager:
                 if self.callback: self.callback('SECURITY_ALERT', msg)
                 return False
             else:
-                # Update last seen
-                self.db.add_trusted_peer(ip, stored_username or "Unknown", fingerprint)
+                # Update last seen (write-behind, no transaction per connection)
+                self.db.touch_peer(ip)
         else:
             # Trust on first use
             self.db.add_trusted_peer(ip, "Unknown", fingerprint)
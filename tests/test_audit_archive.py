@@ -0,0 +1,87 @@
+import os
+import shutil
+import unittest
+from db import Database
+from audit import AuditArchive
+
+
+class TestAuditArchive(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_audit_archive.db"
+        self.key_file = ".test_audit_archive.key"
+        self.archive_dir = "test_audit_archive"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        self._cleanup_db()
+        if os.path.exists(self.key_file): os.remove(self.key_file)
+        shutil.rmtree(self.archive_dir, ignore_errors=True)
+
+    def _cleanup_db(self):
+        for f in (self.db_name, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def test_rollover_by_row_count(self):
+        for i in range(25):
+            self.db.add_audit_log("CONNECTION", f"event {i}", ip_address="10.0.0.2")
+        archive = AuditArchive(self.archive_dir)
+        archived = self.db.rollover_audit_logs(archive, max_rows=10, segment_size=4)
+
+        self.assertEqual(archived, 15)
+        self.assertEqual(len(self.db.get_audit_logs(100)), 10)
+        self.assertEqual(len(archive.segments), 4)
+
+        # Archive plus live table still hold every record, in order, and survive a reload
+        archive = AuditArchive(self.archive_dir)
+        details = [r[2] for r in archive.iter_records()] + [r[2] for r in self.db.iter_audit_logs()]
+        self.assertEqual(details, [f"event {i}" for i in range(25)])
+
+    def test_interrupted_rollover_leftovers_are_removed(self):
+        for i in range(6):
+            self.db.add_audit_log("CONNECTION", f"event {i}")
+        archive = AuditArchive(self.archive_dir)
+        # As if the app stopped between writing the segment and deleting its rows
+        archive.write_segment(self.db.conn.execute(
+            "SELECT id, event_type, details, timestamp, ip_address FROM audit_logs WHERE id <= 3").fetchall())
+        self.assertEqual(self.db.rollover_audit_logs(archive), 0)
+        self.assertEqual([r[2] for r in self.db.iter_audit_logs()], [f"event {i}" for i in range(3, 6)])
+
+    def test_recreated_database_keeps_unarchived_rows(self):
+        for i in range(6):
+            self.db.add_audit_log("CONNECTION", f"old {i}")
+        archive = AuditArchive(self.archive_dir)
+        self.assertEqual(self.db.rollover_audit_logs(archive, max_rows=1), 5)
+
+        # A new database restarts ids at 1 while the archive directory stays
+        self.db.close()
+        self._cleanup_db()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        for i in range(4):
+            self.db.add_audit_log("CONNECTION", f"new {i}")
+        self.assertEqual(self.db.rollover_audit_logs(archive, max_rows=2), 2)
+        self.assertEqual([r[2] for r in self.db.iter_audit_logs()], ["new 2", "new 3"])
+        details = [r[2] for r in AuditArchive(self.archive_dir).iter_records()]
+        self.assertEqual(details, [f"old {i}" for i in range(5)] + ["new 0", "new 1"])
+
+    def test_rollover_by_age_and_corruption(self):
+        self.db.add_audit_log("CONNECTION", "old")
+        self.db.add_audit_log("CONNECTION", "new")
+        self.db.conn.execute("UPDATE audit_logs SET timestamp = 1 WHERE details = 'old'")
+        self.db.conn.commit()
+        archive = AuditArchive(self.archive_dir)
+        self.assertEqual(self.db.rollover_audit_logs(archive, max_age=3600), 1)
+        self.assertEqual(list(archive.iter_records(event_type="CONNECTION"))[0][2], "old")
+
+        with open(os.path.join(self.archive_dir, archive.segments[0]['file']), "ab") as f:
+            f.write(b"tampered")
+        with self.assertRaises(ValueError):
+            list(archive.iter_records())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import unittest
+from db import Database
+
+
+class TestAuditQuery(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_audit_query.db"
+        self.key_file = ".test_audit_query.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        for i in range(30):
+            event = "SECURITY_ALERT" if i % 3 == 0 else "CONNECTION"
+            self.db.add_audit_log(event, f"event {i}", ip_address=f"10.0.0.{i % 2}")
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def test_keyset_pages_cover_filtered_log(self):
+        seen = []
+        before_id = None
+        while True:
+            page = self.db.query_audit_logs(event_type="SECURITY_ALERT", before_id=before_id, limit=4)
+            seen.extend(row[2] for row in page)
+            if len(page) < 4:
+                break
+            before_id = page[-1][0]
+        self.assertEqual(seen, [f"event {i}" for i in range(27, -1, -3)])
+
+    def test_iterator_filters_and_order(self):
+        rows = list(self.db.iter_audit_logs(ip_address="10.0.0.1", batch_size=4))
+        self.assertEqual([row[2] for row in rows], [f"event {i}" for i in range(1, 30, 2)])
+        self.assertEqual(list(self.db.iter_audit_logs(since=0, until=1)), [])
+
+    def test_filtered_page_uses_index(self):
+        plan = self.db.conn.execute("EXPLAIN QUERY PLAN SELECT id FROM audit_logs WHERE event_type = ? AND id < ? ORDER BY id DESC LIMIT 10",
+                                    ("CONNECTION", 100)).fetchall()
+        self.assertIn("idx_audit_logs_event_id", " ".join(str(row[-1]) for row in plan))
+
+
+if __name__ == "__main__":
+    unittest.main()
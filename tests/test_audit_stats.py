@@ -0,0 +1,46 @@
+import os
+import unittest
+from db import Database, THREAT_EVENTS, _migrate_audit_stats
+
+
+class TestAuditStats(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_audit_stats.db"
+        self.key_file = ".test_audit_stats.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def test_aggregates_follow_inserts(self):
+        for _ in range(3):
+            self.db.add_audit_log("SECURITY_ALERT", "x", ip_address="10.0.0.7")
+        self.db.add_audit_log("AUTH_FAILURE", "y", ip_address="10.0.0.8")
+        self.db.add_audit_log("CONNECTION", "z", ip_address="10.0.0.8")
+
+        self.assertEqual(sum(self.db.get_event_counts(THREAT_EVENTS).values()), 4)
+        self.assertEqual(self.db.get_event_counts()["CONNECTION"], 1)
+        trend = self.db.get_hourly_trend(THREAT_EVENTS, hours=24)
+        self.assertEqual(len(trend), 24)
+        self.assertEqual(trend[-1], 4)
+        self.assertEqual(self.db.get_top_ips(THREAT_EVENTS), [("10.0.0.7", 3), ("10.0.0.8", 1)])
+
+    def test_backfill_matches_incremental(self):
+        for event in ("SECURITY_ALERT", "SECURITY_ALERT", "CONNECTION"):
+            self.db.add_audit_log(event, "x", ip_address="10.0.0.9")
+        before = self.db.get_event_counts()
+        cursor = self.db.conn.cursor()
+        _migrate_audit_stats(cursor)
+        self.db.conn.commit()
+        self.assertEqual(self.db.get_event_counts(), before)
+        self.assertEqual(self.db.get_top_ips(["SECURITY_ALERT"]), [("10.0.0.9", 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import sqlite3
+import threading
+import unittest
+from db import Database
+from backup import BackupScheduler
+
+
+class TestOnlineBackup(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_backup.db"
+        self.key_file = ".test_backup.key"
+        self.backup_dir = "test_backups"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+
+    def test_snapshot_while_writing(self):
+        for i in range(500):
+            self.db.add_message("alice", f"message {i} " + "x" * 200)
+        stop = threading.Event()
+
+        def writer():
+            while not stop.is_set():
+                self.db.add_message("bob", "during backup")
+        thread = threading.Thread(target=writer)
+        thread.start()
+        progress = []
+        try:
+            os.makedirs(self.backup_dir)
+            result = self.db.backup_to(os.path.join(self.backup_dir, "snap.db"), pages=8,
+                                       progress_callback=lambda done, total: progress.append((done, total)))
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        conn = sqlite3.connect(result['path'])
+        self.assertEqual(conn.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+        self.assertGreaterEqual(conn.execute("SELECT COUNT(*) FROM messages WHERE sender = 'alice'").fetchone()[0], 500)
+        conn.close()
+
+    def test_backup_restorable_after_key_rotation(self):
+        for i in range(20):
+            self.db.add_message("alice", f"message {i}")
+        os.makedirs(self.backup_dir)
+        path = os.path.join(self.backup_dir, "snap.db")
+        self.db.backup_to(path)
+        self.assertTrue(os.path.exists(path + ".key"))
+        self.db.rekey(pause=0)
+        self.assertEqual(self.db.cipher.key_generations(), [2])
+
+        restored = Database("pw", db_name=path, key_file=path + ".key")
+        try:
+            self.assertEqual([m[2] for m in restored.get_messages(limit=50)], [f"message {i}" for i in range(20)])
+        finally:
+            restored.close()
+
+    def test_rotation_keeps_newest(self):
+        scheduler = BackupScheduler(self.db, self.backup_dir, keep=2)
+        os.makedirs(self.backup_dir)
+        for stamp in ("20240101-000000", "20240102-000000", "20240103-000000"):
+            open(os.path.join(self.backup_dir, f"lan_messenger-{stamp}.db"), "wb").close()
+            open(os.path.join(self.backup_dir, f"lan_messenger-{stamp}.db.key"), "wb").close()
+        scheduler.run_backup()
+        names = [os.path.basename(p) for p in scheduler.list_backups()]
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0], "lan_messenger-20240103-000000.db")
+        self.assertEqual(sorted(n for n in os.listdir(self.backup_dir) if n.endswith(".key")),
+                         [n + ".key" for n in names])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from chunk_hashes import ChunkMismatch, ChunkVerifier, hash_file, leaf_count, merkle_root
+
+
+class TestChunkHashes(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(10 * 1000 + 7)
+        self.leaves = b"".join(hashlib.sha256(self.data[i:i + 1000]).digest() for i in range(0, len(self.data), 1000))
+
+    def test_hash_file_in_one_pass(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.data)
+            checksum, leaves = hash_file(path, chunk_size=1000)
+        finally:
+            os.remove(path)
+        self.assertEqual(checksum, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(leaves, self.leaves)
+        self.assertEqual(len(leaves) // 32, leaf_count(len(self.data), 1000))
+
+    def test_merkle_root(self):
+        a, b, c = (hashlib.sha256(x).digest() for x in (b"a", b"b", b"c"))
+        self.assertEqual(merkle_root(a), a.hex())
+        self.assertEqual(merkle_root(a + b + c), hashlib.sha256(hashlib.sha256(a + b).digest() + c).hexdigest())
+        self.assertNotEqual(merkle_root(a + b + c), merkle_root(a + c + b))
+        self.assertEqual(merkle_root(b""), hashlib.sha256(b"").hexdigest())
+
+    def test_verifier_releases_only_verified_chunks(self):
+        verifier = ChunkVerifier(self.leaves, 1000, len(self.data))
+        self.assertEqual(verifier.feed(self.data[:1500]), self.data[:1000])
+        self.assertEqual(verifier.feed(self.data[1500:]), self.data[1000:])
+
+    def test_verifier_reports_bad_chunk(self):
+        corrupt = bytearray(self.data)
+        corrupt[2500] ^= 1
+        verifier = ChunkVerifier(self.leaves, 1000, len(self.data))
+        self.assertEqual(verifier.feed(corrupt[:2000]), self.data[:2000])
+        with self.assertRaises(ChunkMismatch) as caught:
+            verifier.feed(corrupt[2000:4000])
+        self.assertEqual((caught.exception.index, caught.exception.offset), (2, 2000))
+
+    def test_unaligned_range(self):
+        # A range starting and ending mid-chunk passes the partial chunks through unchecked
+        verifier = ChunkVerifier(self.leaves, 1000, len(self.data), offset=500)
+        self.assertEqual(verifier.feed(self.data[500:1200]), self.data[500:1000])
+        self.assertEqual(verifier.flush(), self.data[1000:1200])
+
+
+if __name__ == '__main__':
+    unittest.main()
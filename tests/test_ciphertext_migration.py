@@ -0,0 +1,49 @@
+import os
+import base64
+import unittest
+from db import Database
+
+
+class TestCiphertextMigration(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_ciphertext_migration.db"
+        self.key_file = ".test_ciphertext_migration.key"
+        for f in (self.db_name, self.key_file):
+            if os.path.exists(f): os.remove(f)
+        self.db = Database("password", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        for f in (self.db_name, self.key_file):
+            if os.path.exists(f): os.remove(f)
+
+    def _legacy(self, text):
+        return "enc:" + base64.b64encode(self.db.cipher.encrypt(text)[1:]).decode()
+
+    def test_legacy_rows_are_converted(self):
+        with self.db.conn:
+            for i in range(25):
+                self.db.conn.execute("INSERT INTO messages (id, sender, content, timestamp) VALUES (?, ?, ?, ?)",
+                                     (f"m{i}", "alice", self._legacy(f"hello {i}"), float(i)))
+            self.db.conn.execute("INSERT INTO files (id, filename, path, size, owner_ip) VALUES (?, ?, ?, ?, ?)",
+                                 ("f1", self._legacy("a.txt"), self._legacy("/tmp/a.txt"), 1, "127.0.0.1"))
+            self.db.conn.execute("INSERT INTO app_config (key, value) VALUES (?, ?)", ("mfa_enabled", "1"))
+
+        converted = self.db.migrate_legacy_ciphertext(batch_size=10, pause=0)
+        self.assertEqual(converted, 27)
+
+        types = self.db.conn.execute("SELECT DISTINCT typeof(content) FROM messages").fetchall()
+        self.assertEqual(types, [("blob",)])
+        self.assertEqual(self.db.get_config("mfa_enabled"), "1")
+
+        messages = self.db.get_messages(100)
+        self.assertEqual([m[2] for m in messages], [f"hello {i}" for i in range(25)])
+        files = self.db.get_files()
+        self.assertEqual((files[0][1], files[0][2]), ("a.txt", "/tmp/a.txt"))
+
+        # Second pass finds nothing left to convert
+        self.assertEqual(self.db.migrate_legacy_ciphertext(pause=0), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
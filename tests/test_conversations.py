@@ -0,0 +1,81 @@
+import os
+import time
+import unittest
+from db import Database
+
+
+class TestConversations(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_conversations.db"
+        self.key_file = ".test_conversations.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def _summary(self, peer):
+        for conv in self.db.get_conversations():
+            if conv[0] == peer:
+                return conv
+        return None
+
+    def test_counts_and_unread(self):
+        now = time.time()
+        self.db.add_message("me", "hi all")
+        self.db.add_received_message("m1", "bob", "hello", now + 1, recipient="10.0.0.2")
+        self.db.add_received_message("m2", "bob", "again", now + 2, recipient="10.0.0.2")
+        # Re-delivered copies are not counted twice
+        self.db.add_received_message("m2", "bob", "again", now + 2, recipient="10.0.0.2")
+
+        bob = self._summary("10.0.0.2")
+        self.assertEqual((bob[1], bob[3], bob[4]), ("m2", 2, 2))
+        self.assertEqual(self._summary(None)[3:5], (0, 1))
+        # Most recent conversation first
+        self.assertEqual(self.db.get_conversations()[0][0], "10.0.0.2")
+
+        self.db.mark_conversation_read("10.0.0.2")
+        self.assertEqual(self._summary("10.0.0.2")[3], 0)
+        self.db.add_received_message("m3", "bob", "new", now + 3, recipient="10.0.0.2")
+        self.assertEqual(self._summary("10.0.0.2")[3], 1)
+
+    def test_delete_updates_summary(self):
+        now = time.time()
+        self.db.add_received_message("m1", "bob", "one", now + 1, recipient="10.0.0.2")
+        self.db.add_received_message("m2", "bob", "two", now + 2, recipient="10.0.0.2")
+        self.db.delete_message("m2")
+        self.db.delete_message("m2")
+
+        bob = self._summary("10.0.0.2")
+        self.assertEqual((bob[1], bob[3], bob[4]), ("m1", 1, 1))
+
+    def test_expiry_updates_summary(self):
+        now = time.time()
+        self.db.add_received_message("m1", "bob", "stays", now, recipient="10.0.0.2")
+        self.db.add_received_message("m2", "bob", "goes", now + 1, recipient="10.0.0.2", expires_at=now - 1)
+        self.db.add_received_message("m3", "bob", "tombstoned", now + 2, recipient="10.0.0.2", expires_at=now - 1)
+        self.db.delete_message("m3")
+
+        self.assertEqual(self.db.delete_expired_messages(), 2)
+        bob = self._summary("10.0.0.2")
+        self.assertEqual((bob[1], bob[3], bob[4]), ("m1", 1, 1))
+
+    def test_migration_backfills_summaries(self):
+        self.db.add_message("me", "one", recipient="10.0.0.2")
+        self.db.add_message("me", "two", recipient="10.0.0.2")
+        with self.db.conn:
+            self.db.conn.execute("DROP TABLE conversations")
+            self.db.conn.execute("PRAGMA user_version = 6")
+        self.db.close()
+
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        self.assertEqual(self._summary("10.0.0.2")[3:5], (0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
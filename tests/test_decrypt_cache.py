@@ -0,0 +1,75 @@
+import os
+import time
+import unittest
+from db import Database, DecryptCache
+
+
+class TestDecryptCache(unittest.TestCase):
+    def test_byte_budget_evicts_lru(self):
+        cache = DecryptCache(max_bytes=3 * (100 + DecryptCache.ENTRY_OVERHEAD))
+        for i in range(3):
+            cache.put(('messages', str(i), 'content'), b"tag", "x" * 100)
+        cache.get(('messages', '0', 'content'), b"tag")  # touch 0 so 1 is least recent
+        cache.put(('messages', '3', 'content'), b"tag", "y" * 100)
+
+        self.assertIsNone(cache.get(('messages', '1', 'content'), b"tag"))
+        self.assertEqual(cache.get(('messages', '0', 'content'), b"tag"), "x" * 100)
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertLessEqual(stats['bytes'], stats['max_bytes'])
+
+    def test_ttl_and_tag_mismatch(self):
+        cache = DecryptCache(ttl=0.05)
+        key = ('messages', 'a', 'content')
+        cache.put(key, b"old", "hello")
+        self.assertIsNone(cache.get(key, b"new"))
+        cache.put(key, b"old", "hello")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(key, b"old"))
+
+    def test_invalidate_and_wipe(self):
+        cache = DecryptCache()
+        cache.put(('files', 'f', 'filename'), b"t", "a.txt")
+        cache.put(('files', 'f', 'path'), b"t", "/tmp/a.txt")
+        entry_buf = cache._entries[('files', 'f', 'path')][1]
+        cache.invalidate('files', 'f')
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(bytes(entry_buf), bytes(len(entry_buf)))
+
+        cache.put(('messages', 'm', 'content'), b"t", "secret")
+        buf = cache._entries[('messages', 'm', 'content')][1]
+        cache.wipe()
+        self.assertEqual(bytes(buf), b"\0" * 6)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+
+class TestDatabaseCacheInvalidation(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_decrypt_cache.db"
+        self.key_file = ".test_decrypt_cache.key"
+        for f in (self.db_name, self.key_file):
+            if os.path.exists(f): os.remove(f)
+        self.db = Database("password", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        for f in (self.db_name, self.key_file):
+            if os.path.exists(f): os.remove(f)
+
+    def test_edit_and_lock(self):
+        msg_id = self.db.add_message("alice", "first")
+        self.assertEqual(self.db.get_messages()[0][2], "first")
+        # Go past the history cache so the read reaches SQLite and the decrypt cache
+        self.db.history.clear()
+        self.db.get_messages()
+        self.assertGreaterEqual(self.db.cipher.cache.stats()['hits'], 1)
+
+        self.db.edit_message(msg_id, "second")
+        self.assertEqual(self.db.get_messages()[0][2], "second")
+
+        self.db.lock_db()
+        self.assertEqual(self.db.cipher.cache.stats()['entries'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
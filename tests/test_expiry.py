@@ -0,0 +1,63 @@
+import os
+import time
+import threading
+import unittest
+from db import Database
+from expiry import ExpiryScheduler
+
+
+class TestExpiryScheduler(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_expiry.db"
+        self.key_file = ".test_expiry.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        self.expired = []
+        self.event = threading.Event()
+        self.scheduler = ExpiryScheduler(self.db, on_expired=self._on_expired)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def _on_expired(self, conversations, file_count):
+        self.expired.append((conversations, file_count))
+        self.event.set()
+
+    def _count(self, table):
+        return self.db.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def test_expires_on_deadline(self):
+        self.scheduler.start()
+        self.db.add_message("alice", "keep me")
+        self.db.add_message("alice", "global", ttl=1)
+        self.db.add_received_message("m2", "10.0.0.5", "private", time.time(), recipient="10.0.0.5",
+                                     expires_at=time.time() + 1)
+        self.db.add_file("doc.txt", "/tmp/doc.txt", 10, "10.0.0.5", ttl=1)
+
+        deadline = time.time() + 5
+        while sum(f for _, f in self.expired) < 1 or len(set().union(*(c for c, _ in self.expired))) < 2:
+            if time.time() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self._count("messages"), 1)
+        self.assertEqual(self._count("files"), 0)
+        # Deadlines are a few microseconds apart, so they may be reaped in one pass or several
+        self.assertEqual(set().union(*(c for c, _ in self.expired)), {None, "10.0.0.5"})
+        self.assertEqual(sum(f for _, f in self.expired), 1)
+
+    def test_reaps_rows_stored_before_start(self):
+        self.db.add_message("alice", "old", ttl=1)
+        time.sleep(1.1)
+        self.scheduler.start()
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(self._count("messages"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,400 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+import chunk_hashes
+from chunked_download import ChunkedDownloader
+from db import Database
+import file_transfer
+from file_transfer import FileTransferManager, SessionUnsupported
+
+
+class _DroppingSocket:
+    """Wraps a client socket and resets the connection after *limit* bytes have been received."""
+    def __init__(self, sock, limit):
+        self.sock = sock
+        self.limit = limit
+
+    def recv(self, n):
+        if self.limit <= 0:
+            raise ConnectionResetError("link dropped")
+        data = self.sock.recv(min(n, self.limit))
+        self.limit -= len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.sock.close()
+
+
+class TestFileTransfer(unittest.TestCase):
+    PORT = 12490
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.db_name = os.path.join(cls.tmp, "test_file_transfer.db")
+        cls.db = Database("pw", db_name=cls.db_name, key_file=os.path.join(cls.tmp, ".key"))
+        cls.server = FileTransferManager(cls.db, cls.PORT, save_dir=os.path.join(cls.tmp, "served"))
+        cls.client = FileTransferManager(cls.db, cls.PORT + 1, save_dir=os.path.join(cls.tmp, "downloads"))
+        cls.client.port = cls.PORT
+        cls.client.RESUME_BACKOFF = 0.01
+
+        cls.content = os.urandom(3 * 1024 * 1024 + 123)
+        cls.checksum = hashlib.sha256(cls.content).hexdigest()
+        cls.source = os.path.join(cls.tmp, "shared.bin")
+        with open(cls.source, 'wb') as f:
+            f.write(cls.content)
+        cls.leaves = chunk_hashes.hash_file(cls.source)[1]
+        cls.chunk_root = chunk_hashes.merkle_root(cls.leaves)
+        cls.db.add_file("shared.bin", cls.source, len(cls.content), "127.0.0.1", checksum=cls.checksum,
+                        chunk_hashes=cls.leaves)
+
+        # A folder of small files, more than one session window's worth
+        cls.folder = os.path.join(cls.tmp, "album")
+        cls.folder_files = {}
+        for i in range(40):
+            rel_path = f"disc{i % 2}/track{i:02}.bin"
+            cls.folder_files[rel_path] = os.urandom(1000 + i * 997)
+            os.makedirs(os.path.join(cls.folder, f"disc{i % 2}"), exist_ok=True)
+            with open(os.path.join(cls.folder, rel_path), 'wb') as f:
+                f.write(cls.folder_files[rel_path])
+        cls.db.add_file("album", cls.folder, 0, "127.0.0.1", is_folder=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        cls.client.close()
+        cls.db.close()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def setUp(self):
+        self.target = os.path.join(self.client.save_dir, "shared.bin")
+        for path in (self.target, self.target + ".part", self.target + ".part.json"):
+            if os.path.exists(path): os.remove(path)
+
+    def _read_target(self):
+        with open(self.target, 'rb') as f:
+            return f.read()
+
+    def _write_partial(self, data):
+        with open(self.target + ".part", 'wb') as f:
+            f.write(data)
+        with open(self.target + ".part.json", 'w') as f:
+            json.dump({'path': self.source, 'checksum': self.checksum, 'received': len(data)}, f)
+
+    def _no_read_back(self):
+        # Downloads are verified with the digest computed while receiving
+        return patch.object(FileTransferManager, "calculate_sha256", side_effect=AssertionError("file read back"))
+
+    def test_download_and_verify(self):
+        with self._no_read_back():
+            self.assertTrue(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum))
+        self.assertEqual(self._read_target(), self.content)
+        self.assertEqual(file_transfer._HASH_INDEX.get(self.target), self.checksum)
+        self.assertFalse(os.path.exists(self.target + ".part"))
+        self.assertFalse(os.path.exists(self.target + ".part.json"))
+
+    def test_resumes_from_sidecar(self):
+        half = len(self.content) // 2
+        self._write_partial(self.content[:half])
+        sent, recording = self._record_ranges()
+        with recording, self._no_read_back():
+            self.assertTrue(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum))
+        # Only the missing range was requested
+        self.assertEqual(sent, [(half, len(self.content) - half)])
+        self.assertEqual(self._read_target(), self.content)
+
+    def test_corrupt_partial_is_discarded(self):
+        self._write_partial(b"\0" * 1000)
+        self.assertFalse(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum))
+        self.assertFalse(os.path.exists(self.target))
+        self.assertFalse(os.path.exists(self.target + ".part"))
+
+    def _share_changing_file(self, old, new):
+        """Shares a file without a checksum, leaves a partial of *old* and then changes it to *new*."""
+        path = os.path.join(self.tmp, "notes.log")
+        with open(path, 'wb') as f:
+            f.write(new)
+        self.db.add_file("notes.log", path, len(new), "127.0.0.1")
+        target = os.path.join(self.client.save_dir, "notes.log")
+        os.makedirs(self.client.save_dir, exist_ok=True)
+        with open(target + ".part", 'wb') as f:
+            f.write(old[:len(old) // 2])
+        with open(target + ".part.json", 'w') as f:
+            json.dump({'path': path, 'checksum': None, 'size': len(old), 'received': len(old) // 2}, f)
+        self.addCleanup(lambda: os.path.exists(target) and os.remove(target))
+        return path, target
+
+    def test_resume_restarts_when_remote_file_changed(self):
+        old = os.urandom(200000)
+        path, target = self._share_changing_file(old, os.urandom(50000) + old)
+        sent, recording = self._record_ranges()
+        with recording:
+            self.assertTrue(self.client.download_file("127.0.0.1", path))
+        self.assertEqual(sent[-1], (0, 250000))
+        with open(target, 'rb') as f, open(path, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_session_resume_restarts_when_remote_file_changed(self):
+        old = os.urandom(200000)
+        path, target = self._share_changing_file(old, os.urandom(50000) + old)
+        # The listing still reports the old size; only the reply shows the change
+        jobs = [{'path': path, 'local_path': target, 'checksum': None, 'size': len(old), 'label': "notes.log"},
+                {'path': self.source, 'local_path': self.target, 'checksum': self.checksum,
+                 'size': len(self.content), 'label': "shared.bin"}]
+        with patch.object(ChunkedDownloader, "MIN_SIZE", 64 * 1024 * 1024):
+            self.client._download_batch("127.0.0.1", jobs)
+        self.assertEqual([job['result'] for job in jobs], [True, True])
+        with open(target, 'rb') as f, open(path, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(self._read_target(), self.content)
+
+    def test_resume_past_end_of_shrunk_file_starts_over(self):
+        old = os.urandom(200000)
+        path, target = self._share_changing_file(old, old[:50000])
+        engine = MagicMock()
+        with patch("security_engine.get_engine", return_value=engine):
+            self.assertTrue(self.client.download_file("127.0.0.1", path))
+        engine.report_incident.assert_not_called()
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), old[:50000])
+        self.assertFalse(os.path.exists(target + ".part.json"))
+
+    def test_reconnects_after_drop(self):
+        real_connect = self.client._connect
+        limits = iter([1024 * 1024, 512 * 1024])
+
+        def flaky_connect(*args, **kwargs):
+            sock = real_connect(*args, **kwargs)
+            limit = next(limits, None)
+            return _DroppingSocket(sock, limit + 1024) if limit else sock
+        with patch.object(self.client, "_connect", side_effect=flaky_connect):
+            self.assertTrue(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum))
+        self.assertEqual(self._read_target(), self.content)
+
+    def _record_ranges(self):
+        sent = []
+        real_send_range = self.server._send_range
+        return sent, patch.object(self.server, "_send_range", side_effect=lambda *a: (sent.append(a[2:]), real_send_range(*a)))
+
+    @patch.multiple(ChunkedDownloader, RANGE_SIZE=256 * 1024, MIN_SIZE=1024 * 1024, SAMPLE_INTERVAL=0.02)
+    def test_parallel_download(self):
+        sent, recording = self._record_ranges()
+        with recording, self._no_read_back():
+            self.assertTrue(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum,
+                                                      size=len(self.content)))
+        self.assertEqual(self._read_target(), self.content)
+        self.assertEqual(sum(length for _, length in sent), len(self.content))
+        stats = self.client.last_download_stats
+        self.assertGreaterEqual(len(stats['streams']), 2)
+        self.assertEqual(stats['bytes'], len(self.content))
+
+    @patch.multiple(ChunkedDownloader, RANGE_SIZE=1024 * 1024, MIN_SIZE=1024 * 1024, SAMPLE_INTERVAL=0.02)
+    def test_parallel_resume_skips_done_ranges(self):
+        size = len(self.content)
+        with open(self.target + ".part", 'wb') as f:
+            f.write(self.content[:1024 * 1024] + b"\0" * (size - 1024 * 1024))
+        with open(self.target + ".part.json", 'w') as f:
+            json.dump({'path': self.source, 'checksum': self.checksum, 'size': size,
+                       'received': 1024 * 1024, 'done': [[0, 1024 * 1024]]}, f)
+        sent, recording = self._record_ranges()
+        with recording, self._no_read_back():
+            self.assertTrue(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum, size=size))
+        self.assertNotIn(0, [offset for offset, _ in sent])
+        self.assertEqual(self._read_target(), self.content)
+
+    @patch.multiple(ChunkedDownloader, RANGE_SIZE=256 * 1024, MIN_SIZE=1024 * 1024, SAMPLE_INTERVAL=0.02)
+    def test_swarm_download_with_failover(self):
+        # Two more seeders of the same content on their own loopback addresses
+        port = self.PORT + 2
+        seeders = [FileTransferManager(self.db, port, save_dir=os.path.join(self.tmp, "served"), bind_ip=ip)
+                   for ip in ("127.0.0.2", "127.0.0.3")]
+        try:
+            self.client.port = port
+            self.assertEqual(self.client.find_sources(self.checksum, ["127.0.0.3", "127.0.0.4"]),
+                             [("127.0.0.3", self.source)])
+            self.assertTrue(self.client.download_file("127.0.0.2", self.source, expected_checksum=self.checksum,
+                                                      size=len(self.content), swarm_peers=["127.0.0.3"]))
+            self.assertEqual(self._read_target(), self.content)
+            sources = {source['source']: source['bytes'] for source in self.client.last_download_stats['sources']}
+            self.assertEqual(set(sources), {"127.0.0.2", "127.0.0.3"})
+            self.assertTrue(all(sources.values()))
+
+            # Nothing listens on 127.0.0.4; its ranges fail over to the live seeder
+            os.remove(self.target)
+            downloader = ChunkedDownloader(self.client, [("127.0.0.4", self.source), ("127.0.0.2", self.source)],
+                                           self.target, len(self.content), self.checksum, port=port)
+            self.assertTrue(downloader.run())
+            self.assertEqual(self._read_target(), self.content)
+            self.assertEqual(downloader.sources[0]['bytes'], 0)
+        finally:
+            self.client.port = self.PORT
+            for seeder in seeders:
+                seeder.close()
+
+    def _download_album(self, **patches):
+        shutil.rmtree(os.path.join(self.client.save_dir, "album"), ignore_errors=True)
+        events = []
+        self.client.download_folder("127.0.0.1", self.folder,
+                                    progress_callback=lambda rel_path, status, file_ratio, overall:
+                                        events.append((rel_path, status, overall)))
+        for rel_path, data in self.folder_files.items():
+            with open(os.path.join(self.client.save_dir, "album", rel_path), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(sorted(event[0] for event in events if event[1] == "DONE"), sorted(self.folder_files))
+        # One overall count across every phase of the download: it never goes back and ends full
+        overall = [event[2] for event in events]
+        self.assertEqual(overall, sorted(overall))
+        self.assertEqual(overall[-1], 1.0)
+        return events
+
+    def _without_streams(self):
+        return patch.object(self.client, "_stream_folder", side_effect=SessionUnsupported("127.0.0.1"))
+
+    def test_folder_stream(self):
+        with patch.object(self.client, "_connect", wraps=self.client._connect) as connect, \
+                patch.object(self.client, "_open_session") as open_session:
+            events = self._download_album()
+        self.assertEqual(connect.call_count, 1)
+        open_session.assert_not_called()
+        self.assertEqual(events[0][1], "START")
+
+    def test_interrupted_stream_finishes_over_session(self):
+        real_recv = file_transfer._StreamReader.recv
+        budget = [len(b"".join(self.folder_files.values())) // 2]
+
+        def dropping_recv(reader, size):
+            if budget[0] <= 0:
+                raise ConnectionResetError("link dropped")
+            data = real_recv(reader, min(size, budget[0]))
+            budget[0] -= len(data)
+            return data
+        pulled = []
+        real_pull = self.client._pull_over_session
+
+        def recording_pull(target_ip, jobs, *args):
+            pulled.extend(job['label'] for job in jobs)
+            return real_pull(target_ip, jobs, *args)
+        with patch.object(file_transfer._StreamReader, "recv", dropping_recv), \
+                patch.object(self.client, "_pull_over_session", side_effect=recording_pull):
+            self._download_album()
+        # Only what the stream had not delivered was pulled again
+        self.assertTrue(0 < len(pulled) < len(self.folder_files))
+
+    @patch.multiple(ChunkedDownloader, RANGE_SIZE=8192, MIN_SIZE=30000, SAMPLE_INTERVAL=0.02)
+    def test_folder_stream_leaves_large_files_to_parallel_streams(self):
+        with patch.object(self.client, "_download", wraps=self.client._download) as download:
+            self._download_album()
+        large = [rel_path for rel_path, data in self.folder_files.items() if len(data) >= 30000]
+        self.assertEqual(sorted(call.args[1] for call in download.call_args_list),
+                         sorted(os.path.join(self.folder, rel_path) for rel_path in large))
+
+    def test_unsafe_folder_paths(self):
+        base = os.path.abspath(self.client.save_dir)
+        self.assertEqual(FileTransferManager._safe_local_path(base, "a/b.txt"), os.path.join(base, "a", "b.txt"))
+        for rel_path in ("../evil", "a/../../evil", "/etc/passwd", "", "a//b", ".", None):
+            self.assertIsNone(FileTransferManager._safe_local_path(base, rel_path), rel_path)
+
+    def test_folder_over_one_session(self):
+        with self._without_streams(), patch.object(self.client, "_connect", wraps=self.client._connect) as connect:
+            events = self._download_album()
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(events[0][1], "START")
+
+    def test_session_resumes_after_drop(self):
+        real_connect = self.client._connect
+        limits = iter([len(b"".join(self.folder_files.values())) // 2])
+
+        def flaky_connect(*args, **kwargs):
+            sock = real_connect(*args, **kwargs)
+            limit = next(limits, None)
+            return _DroppingSocket(sock, limit) if limit else sock
+        with self._without_streams(), patch.object(self.client, "_connect", side_effect=flaky_connect) as connect:
+            self._download_album()
+        self.assertEqual(connect.call_count, 2)
+
+    def test_folder_from_peer_without_sessions(self):
+        with self._without_streams(), \
+                patch.object(self.client, "_open_session", side_effect=SessionUnsupported("127.0.0.1")):
+            self._download_album()
+
+    def test_download_files_batch(self):
+        listing = [{'filename': "shared.bin", 'path': self.source, 'checksum': self.checksum, 'size': len(self.content)},
+                   {'filename': "track00.bin", 'path': os.path.join(self.folder, "disc0", "track00.bin"),
+                    'checksum': hashlib.sha256(self.folder_files["disc0/track00.bin"]).hexdigest()},
+                   {'filename': "missing.bin", 'path': os.path.join(self.folder, "missing.bin")}]
+        self.assertEqual(self.client.download_files("127.0.0.1", listing), [True, True, False])
+        self.assertEqual(self._read_target(), self.content)
+
+    def _corrupt_once(self, at):
+        """Makes the server flip the byte at file offset *at* the first time it sends it."""
+        sent = []
+        real_send_range = self.server._send_range
+        armed = [True]
+
+        def send_range(sock, path, offset, length):
+            sent.append((offset, length))
+            if armed[0] and offset <= at < offset + length:
+                armed[0] = False
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = bytearray(f.read(length))
+                data[at - offset] ^= 0xFF
+                sock.sendall(data)
+            else:
+                real_send_range(sock, path, offset, length)
+        return sent, patch.object(self.server, "_send_range", side_effect=send_range)
+
+    def test_get_chunk_hashes(self):
+        self.assertEqual(self.client.get_chunk_hashes("127.0.0.1", self.checksum, self.chunk_root),
+                         (chunk_hashes.CHUNK_SIZE, self.leaves))
+        self.assertIsNone(self.client.get_chunk_hashes("127.0.0.1", self.checksum, "0" * 64))
+        self.assertIsNone(self.client.get_chunk_hashes("127.0.0.1", "unknown"))
+        listed = [f for f in self.client.get_shared_files("127.0.0.1") if f['path'] == self.source]
+        self.assertEqual(listed[0]['chunk_root'], self.chunk_root)
+
+    def test_bad_chunk_is_fetched_again_alone(self):
+        chunk = chunk_hashes.CHUNK_SIZE
+        sent, corrupting = self._corrupt_once(chunk + 10)
+        with corrupting:
+            self.assertTrue(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum,
+                                                      size=len(self.content), chunk_root=self.chunk_root))
+        self.assertEqual(self._read_target(), self.content)
+        # The first chunk was kept; the transfer resumed at the bad one
+        self.assertEqual(sent, [(0, len(self.content)), (chunk, len(self.content) - chunk)])
+
+    @patch.multiple(ChunkedDownloader, RANGE_SIZE=2 * 1024 * 1024, MIN_SIZE=1024 * 1024, SAMPLE_INTERVAL=0.02)
+    def test_parallel_bad_chunk_requeues_rest_of_range(self):
+        chunk = chunk_hashes.CHUNK_SIZE
+        sent, corrupting = self._corrupt_once(chunk + 10)
+        with corrupting:
+            self.assertTrue(self.client.download_file("127.0.0.1", self.source, expected_checksum=self.checksum,
+                                                      size=len(self.content), chunk_root=self.chunk_root))
+        self.assertEqual(self._read_target(), self.content)
+        self.assertIn((chunk, chunk), sent)
+        self.assertEqual(sent.count((0, 2 * chunk)), 1)
+
+    def test_split_piece_stays_split_for_a_superseded_stream(self):
+        chunk = chunk_hashes.CHUNK_SIZE
+        downloader = ChunkedDownloader(self.client, [("127.0.0.1", self.source)], self.target, len(self.content))
+        piece = (0, 2 * chunk)
+        downloader._in_flight[piece] = {0: chunk + 10, 1: 4096}
+        # Stream 0 finds a bad second chunk; stream 1, an endgame duplicate, then stops as superseded
+        downloader._release(0, piece, finished=False, good_until=chunk)
+        downloader._release(1, piece, finished=True)
+        self.assertEqual(downloader._done, {(0, chunk)})
+        self.assertEqual(downloader._done_bytes, chunk)
+        self.assertEqual(downloader._pending, [(chunk, 2 * chunk)])
+
+
+if __name__ == '__main__':
+    unittest.main()
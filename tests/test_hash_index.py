@@ -0,0 +1,69 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from hash_index import HashIndex, RunningHash
+
+
+class TestHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.index = HashIndex(capacity=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_hash_file_is_indexed_until_the_file_changes(self):
+        path = self._write("a.bin", b"first")
+        self.assertEqual(self.index.hash_file(path), hashlib.sha256(b"first").hexdigest())
+        self.assertEqual(self.index.get(path), hashlib.sha256(b"first").hexdigest())
+        self._write("a.bin", b"second!")
+        self.assertIsNone(self.index.get(path))
+        self.assertEqual(self.index.hash_file(path), hashlib.sha256(b"second!").hexdigest())
+
+    def test_put_is_served_without_reading(self):
+        path = self._write("b.bin", b"payload")
+        self.index.put(path, "digest-from-receive")
+        self.assertEqual(self.index.hash_file(path), "digest-from-receive")
+
+    def test_least_recently_used_is_dropped(self):
+        paths = [self._write(f"{i}.bin", bytes([i])) for i in range(3)]
+        self.index.hash_file(paths[0])
+        self.index.hash_file(paths[1])
+        self.index.get(paths[0])
+        self.index.hash_file(paths[2])
+        self.assertIsNotNone(self.index.get(paths[0]))
+        self.assertIsNone(self.index.get(paths[1]))
+
+    def test_missing_file(self):
+        self.assertIsNone(self.index.hash_file(os.path.join(self.tmp, "missing")))
+
+
+class TestRunningHash(unittest.TestCase):
+    def test_sync_rehashes_only_a_different_prefix(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "part")
+            with open(path, 'wb') as f:
+                f.write(b"abcdef")
+            digest = RunningHash()
+            digest.sync(path, 4)
+            digest.update(b"ef")
+            self.assertEqual(digest.hexdigest(), hashlib.sha256(b"abcdef").hexdigest())
+            digest.sync(path, 6)  # Already there; nothing is read
+            self.assertEqual(digest.length, 6)
+            digest.sync(path, 0)
+            self.assertEqual(digest.hexdigest(), hashlib.sha256().hexdigest())
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import time
+import unittest
+from unittest.mock import patch
+from db import Database
+from history_cache import HistoryCache, MessageRecord
+
+
+class TestHistoryCache(unittest.TestCase):
+    def test_window_is_bounded_and_sorted(self):
+        cache = HistoryCache(capacity=3)
+        cache.fill(None, [], cache.generation, 3)
+        for i, ts in enumerate([1, 2, 4, 3, 5]):
+            cache.add(MessageRecord(f"m{i}", "bob", f"text {i}", ts))
+        rows = cache.get(None, 3)
+        self.assertEqual([row[3] for row in rows], [3, 4, 5])
+        # The window was truncated, so it cannot answer for more than it holds once shrunk
+        cache.remove(["m4"])
+        self.assertIsNone(cache.get(None, 3))
+        self.assertEqual(len(cache.get(None, 2)), 2)
+
+    def test_stale_fill_is_dropped(self):
+        cache = HistoryCache()
+        generation = cache.generation
+        cache.add(MessageRecord("m1", "bob", "hi", 1))
+        cache.fill(None, [], generation, 10)
+        self.assertIsNone(cache.get(None, 10))
+
+
+class TestDatabaseHistory(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_history_cache.db"
+        self.key_file = ".test_history_cache.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def test_mutations_are_served_from_cache(self):
+        first = self.db.add_message("me", "one")
+        self.db.add_received_message("p1", "bob", "private", time.time(), recipient="10.0.0.2")
+        self.db.get_messages(200)
+        self.db.get_messages(100, peer_ip="10.0.0.2")
+
+        second = self.db.add_message("me", "two")
+        self.db.add_received_message("g1", "bob", "three", time.time() + 1)
+        self.db.edit_message(first, "one (edited)")
+        self.db.delete_message(second)
+        self.db.add_received_message("p2", "bob", "expired", time.time(), recipient="10.0.0.2", expires_at=time.time() - 1)
+        self.db.delete_expired_messages()
+
+        # Neither SQLite nor the cipher is touched on a re-render
+        with patch.object(self.db, "conn", None), \
+             patch.object(self.db.cipher, "decrypt_many", side_effect=AssertionError("decrypted on the hot path")):
+            cached = self.db.get_messages(200)
+            private = self.db.get_messages(100, peer_ip="10.0.0.2")
+        self.assertEqual([row[2] for row in cached], ["one (edited)", "three"])
+        self.assertEqual([row[0] for row in private], ["p1"])
+
+        # The cache agrees with a fresh read from the database
+        self.db.history.clear()
+        self.assertEqual(self.db.get_messages(200), cached)
+        self.assertEqual(self.db.get_messages(100, peer_ip="10.0.0.2"), private)
+
+    def test_lock_clears_cache(self):
+        self.db.add_message("me", "secret")
+        self.db.get_messages(200)
+        self.db.lock_db()
+        self.assertIsNone(self.db.history.get(None, 200))
+
+
+if __name__ == '__main__':
+    unittest.main()
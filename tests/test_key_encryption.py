@@ -1,6 +1,7 @@
 import os
+import base64
 import unittest
-from db import EncryptionManager
+from db import EncryptionManager, CIPHERTEXT_VERSION
 
 class TestKeyEncryption(unittest.TestCase):
     def setUp(self):
@@ -19,13 +20,64 @@ class TestKeyEncryption(unittest.TestCase):
         test_data = "Hello World"
         encrypted = em.encrypt(test_data)
         self.assertNotEqual(test_data, encrypted)
-        self.assertTrue(encrypted.startswith("enc:"))
+        self.assertIsInstance(encrypted, bytes)
+        self.assertEqual(encrypted[0], CIPHERTEXT_VERSION)
+        # version(1) + nonce(12) + plaintext + tag(16)
+        self.assertEqual(len(encrypted), 1 + 12 + len(test_data) + 16)
 
         # New manager instance with same password
         em2 = EncryptionManager(key_file=self.key_file, password=password)
         decrypted = em2.decrypt(encrypted)
         self.assertEqual(test_data, decrypted)
 
+    def test_legacy_ciphertext(self):
+        em = EncryptionManager(key_file=self.key_file, password="pw")
+        blob = em.encrypt("legacy value")
+        legacy = "enc:" + base64.b64encode(blob[1:]).decode()
+
+        self.assertEqual(em.decrypt(legacy), "legacy value")
+        self.assertEqual(EncryptionManager.upgrade_legacy(legacy), blob)
+        self.assertIsNone(EncryptionManager.upgrade_legacy("plain text"))
+
+    def test_decrypt_many_preserves_order(self):
+        em = EncryptionManager(key_file=self.key_file, password="pw")
+        plain = [f"message {i}" for i in range(600)]
+        encrypted = [em.encrypt(p) for p in plain]
+
+        self.assertEqual(em.decrypt_many(encrypted), plain)
+        # Above the threshold the work is split into batches with timing per batch
+        self.assertGreater(len(em.last_batch_timings), 1)
+        self.assertEqual(sum(count for count, _ in em.last_batch_timings), len(plain))
+
+        self.assertEqual(em.decrypt_many(encrypted[:5]), plain[:5])
+        self.assertEqual(len(em.last_batch_timings), 1)
+        em.close()
+
+    def test_session_unlock_after_inactivity_lock(self):
+        em = EncryptionManager(key_file=self.key_file, password="pw", session_minutes=5)
+        blob = em.encrypt("kept")
+        em.lock(keep_session=True)
+        self.assertTrue(em.is_locked())
+
+        # The sealed copy is protected by the full KDF and restored without the key file
+        derive = em._derive_key
+        iterations = []
+        em._derive_key = lambda password, salt, n=None: (iterations.append(n or em.KDF_ITERATIONS), derive(password, salt, n))[1]
+        em._unlock_key_file = None
+        em.unlock("pw")
+        self.assertEqual(em.decrypt(blob), "kept")
+        self.assertEqual(iterations, [EncryptionManager.KDF_ITERATIONS])
+        del em._unlock_key_file
+
+        # A wrong password discards the session, and a manual lock keeps none
+        em.lock(keep_session=True)
+        with self.assertRaises(ValueError):
+            em.unlock("wrong")
+        self.assertIsNone(em._session)
+        em.unlock("pw")
+        em.lock()
+        self.assertIsNone(em._session)
+
     def test_invalid_password(self):
         password = "correct_password"
         EncryptionManager(key_file=self.key_file, password=password)
@@ -0,0 +1,102 @@
+import os
+import threading
+import unittest
+from db import Database, REKEY_STATE_KEY
+
+
+class TestKeyRotation(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_key_rotation.db"
+        self.key_file = ".test_key_rotation.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        for i in range(50):
+            self.db.add_message("alice", f"message {i}")
+        self.db.add_file("doc.txt", "/tmp/doc.txt", 10, "10.0.0.2")
+        self.db.set_config("mfa_secret", "SECRET", encrypt=True)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def _assert_readable(self, db):
+        self.assertEqual([m[2] for m in db.get_messages(limit=100)], [f"message {i}" for i in range(50)])
+        self.assertEqual(db.get_files()[0][1], "doc.txt")
+        self.assertEqual(db.get_config("mfa_secret", decrypt=True), "SECRET")
+
+    def test_full_rotation(self):
+        self.assertEqual(self.db.rekey(batch_size=16, pause=0), 53)
+        self.assertEqual(self.db.cipher.key_generations(), [2])
+        self.assertFalse(self.db.key_rotation_pending())
+        first_bytes = {row[0] for row in self.db.conn.execute("SELECT substr(content, 1, 1) FROM messages")}
+        self.assertEqual(first_bytes, {b"\x02"})
+        self._assert_readable(self.db)
+
+        # The rotated keyring reopens with the same password
+        self.db.close()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        self._assert_readable(self.db)
+
+    def test_resume_after_interruption(self):
+        stop = threading.Event()
+        self.db.rekey(batch_size=16, pause=0, stop_event=stop, progress_callback=lambda done, total: stop.set())
+        self.assertTrue(self.db.get_config(REKEY_STATE_KEY).startswith("messages:"))
+        self.db.close()
+
+        # Both keys survive the restart, so half-converted data stays readable
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        self.assertTrue(self.db.key_rotation_pending())
+        self._assert_readable(self.db)
+
+        self.assertEqual(self.db.rekey(batch_size=16, pause=0), 37)
+        self.assertEqual(self.db.cipher.key_generations(), [2])
+        self.assertIsNone(self.db.get_config(REKEY_STATE_KEY))
+        self._assert_readable(self.db)
+
+    def test_lock_mid_rotation_keeps_data(self):
+        locked = []
+
+        def lock_once(done, total):
+            if not locked:
+                locked.append(done)
+                self.db.lock_db()
+        self.db.rekey(batch_size=16, pause=0, progress_callback=lock_once)
+        self.assertEqual(locked, [16])
+        self.assertNotIn("[Encrypted]", {row[0] for row in self.db.conn.execute("SELECT content FROM messages")})
+
+        self.assertTrue(self.db.unlock("pw"))
+        self.assertTrue(self.db.key_rotation_pending())
+        self._assert_readable(self.db)
+        self.assertEqual(self.db.rekey(batch_size=16, pause=0), 37)
+        self.assertEqual(self.db.cipher.key_generations(), [2])
+        self._assert_readable(self.db)
+
+    def test_lock_during_batch_discards_it(self):
+        snapshot = self.db.cipher.snapshot
+
+        def locking_snapshot():
+            keys = snapshot()
+            decrypt = keys.decrypt
+
+            def decrypt_then_lock(value, cache_key=None):
+                self.db.lock_db()  # Locks after the batch was read, before it is written
+                return decrypt(value, cache_key)
+            keys.decrypt = decrypt_then_lock
+            return keys
+        self.db.cipher.snapshot = locking_snapshot
+        self.assertEqual(self.db.rekey(batch_size=16, pause=0), 0)
+        del self.db.cipher.snapshot
+
+        self.assertTrue(self.db.unlock("pw"))
+        self.assertIsNone(self.db.get_config(REKEY_STATE_KEY))
+        self._assert_readable(self.db)
+        self.assertEqual(self.db.rekey(batch_size=16, pause=0), 53)
+        self._assert_readable(self.db)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import time
+import unittest
+from db import Database
+
+
+class TestDatabaseMaintenance(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_maintenance.db"
+        self.key_file = ".test_maintenance.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def test_delete_keeps_tombstone_without_content(self):
+        msg_id = self.db.add_message("alice", "secret")
+        self.db.delete_message(msg_id)
+        row = self.db.conn.execute("SELECT is_deleted, content, deleted_at FROM messages WHERE id = ?", (msg_id,)).fetchone()
+        self.assertEqual(row[0], 1)
+        self.assertIsNone(row[1])
+        self.assertIsNotNone(row[2])
+
+        # A re-delivered copy must not resurrect the message
+        self.db.add_received_message(msg_id, "alice", "secret", time.time())
+        self.assertEqual(self.db.get_messages(), [])
+
+    def test_maintenance_purges_and_reclaims(self):
+        self.assertEqual(self.db.conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        ids = [self.db.add_message("alice", "x" * 2000) for _ in range(300)]
+        keep = self.db.add_message("alice", "recent")
+        for msg_id in ids:
+            self.db.delete_message(msg_id)
+        self.db.conn.execute("UPDATE messages SET deleted_at = 1 WHERE is_deleted = 1")
+        self.db.conn.commit()
+        self.db.checkpoint_wal()
+
+        result = self.db.run_maintenance(tombstone_retention=86400)
+        self.assertEqual(result['tombstones_purged'], 300)
+        self.assertGreater(result['bytes_reclaimed'], 0)
+        self.assertEqual(self.db.conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        self.assertEqual([m[0] for m in self.db.get_messages()], [keep])
+
+    def test_run_stops_when_not_idle(self):
+        msg_id = self.db.add_message("alice", "old")
+        self.db.delete_message(msg_id)
+        result = self.db.run_maintenance(tombstone_retention=-1, should_continue=lambda: False)
+        self.assertEqual(result['tombstones_purged'], 0)
+
+    def test_vacuum_conversion_only_on_request(self):
+        self.db.conn.execute("PRAGMA auto_vacuum=NONE")
+        self.db.conn.execute("VACUUM")
+        self.assertTrue(self.db.needs_vacuum_conversion())
+        self.db.run_maintenance(tombstone_retention=86400)
+        self.assertTrue(self.db.needs_vacuum_conversion())
+
+        self.assertTrue(self.db.enable_incremental_vacuum())
+        self.assertFalse(self.db.needs_vacuum_conversion())
+        self.assertFalse(self.db.enable_incremental_vacuum())
+
+
+if __name__ == "__main__":
+    unittest.main()
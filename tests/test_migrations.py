@@ -0,0 +1,98 @@
+import os
+import base64
+import sqlite3
+import unittest
+from unittest.mock import patch
+import db as db_module
+from db import Database, EncryptionManager, SCHEMA_VERSION, MIGRATION_STEPS_KEY
+
+
+class TestSchemaMigrations(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_migrations.db"
+        self.key_file = ".test_migrations.key"
+        self._cleanup()
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def _version(self, conn):
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def test_new_database_is_current(self):
+        db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        self.assertEqual(self._version(db.conn), SCHEMA_VERSION)
+        self.assertIsNone(db._migration_thread)
+        db.close()
+
+        # Reopening an up-to-date database runs no migrations
+        db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        self.assertIsNone(db._migration_thread)
+        db.close()
+
+    def test_legacy_database_upgrade(self):
+        cipher = EncryptionManager(key_file=self.key_file, password="pw")
+        legacy = "enc:" + base64.b64encode(cipher.encrypt("old message")[1:]).decode()
+
+        # A pre-versioning database: old column set and no user_version
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("CREATE TABLE messages (id TEXT PRIMARY KEY, sender TEXT NOT NULL, content TEXT, "
+                     "timestamp REAL NOT NULL, is_deleted BOOLEAN DEFAULT 0)")
+        conn.execute("CREATE TABLE trusted_peers (ip TEXT PRIMARY KEY, fingerprint TEXT, last_seen REAL)")
+        conn.execute("INSERT INTO messages (id, sender, content, timestamp) VALUES ('m1', 'bob', ?, 1.0)", (legacy,))
+        conn.commit()
+        conn.close()
+
+        progress = []
+        db = Database("pw", db_name=self.db_name, key_file=self.key_file,
+                      migration_callback=lambda step, done, total: progress.append((step, done, total)))
+        db._migration_thread.join(timeout=10)
+
+        self.assertEqual(self._version(db.conn), SCHEMA_VERSION)
+        self.assertEqual(progress[-1], ("binary ciphertext", 1, 1))
+        self.assertEqual(db.conn.execute("SELECT typeof(content) FROM messages").fetchone()[0], "blob")
+        self.assertEqual(db.get_messages()[0][2], "old message")
+        columns = [row[1] for row in db.conn.execute("PRAGMA table_info(trusted_peers)")]
+        self.assertIn("is_verified", columns)
+        db.close()
+
+    def test_steps_after_pending_background_step_run_once(self):
+        cipher = EncryptionManager(key_file=self.key_file, password="pw")
+        legacy = "enc:" + base64.b64encode(cipher.encrypt("old message")[1:]).decode()
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("CREATE TABLE messages (id TEXT PRIMARY KEY, sender TEXT NOT NULL, content TEXT, "
+                     "timestamp REAL NOT NULL, is_deleted BOOLEAN DEFAULT 0)")
+        conn.execute("INSERT INTO messages (id, sender, content, timestamp) VALUES ('m1', 'bob', ?, 1.0)", (legacy,))
+        conn.commit()
+        conn.close()
+
+        # The binary ciphertext step is interrupted on every start, so it stays pending
+        stalled = [(v, d, (lambda db, stop, progress: stop.set()) if bg else f, bg)
+                   for v, d, f, bg in db_module.MIGRATIONS]
+        with patch('db.MIGRATIONS', stalled):
+            db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+            db._migration_thread.join(timeout=10)
+            self.assertEqual(self._version(db.conn), 1)
+            db.conn.execute("UPDATE conversations SET unread_count = 3, last_read_at = 42")
+            db.conn.commit()
+            db.close()
+
+            db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+            db._migration_thread.join(timeout=10)
+            self.assertEqual(db.conn.execute("SELECT unread_count, last_read_at FROM conversations").fetchone(), (3, 42))
+            db.close()
+
+        db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        db._migration_thread.join(timeout=10)
+        self.assertEqual(self._version(db.conn), SCHEMA_VERSION)
+        self.assertIsNone(db.get_config(MIGRATION_STEPS_KEY))
+        self.assertEqual(db.conn.execute("SELECT unread_count FROM conversations").fetchone()[0], 3)
+        db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import unittest
+from db import Database
+
+
+class TestPeerState(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_peer_state.db"
+        self.key_file = ".test_peer_state.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def _stored_last_seen(self, ip):
+        return self.db.conn.execute("SELECT last_seen FROM trusted_peers WHERE ip = ?", (ip,)).fetchone()[0]
+
+    def test_touches_are_coalesced(self):
+        self.db.add_trusted_peer("10.0.0.2", "bob", "fp")
+        stored = self._stored_last_seen("10.0.0.2")
+        for _ in range(50):
+            self.db.touch_peer("10.0.0.2", "bobby")
+
+        # Reads see the pending values before anything is written
+        peer = self.db.get_trusted_peer("10.0.0.2")
+        self.assertEqual(peer[1], "bobby")
+        self.assertGreaterEqual(peer[8], stored)
+        self.assertEqual(self._stored_last_seen("10.0.0.2"), stored)
+
+        self.assertEqual(self.db.flush_peer_touches(), 1)
+        self.assertEqual(self._stored_last_seen("10.0.0.2"), peer[8])
+        self.assertEqual(self.db.flush_peer_touches(), 0)
+
+    def test_touch_keeps_permissions_cached(self):
+        self.db.update_peer_permissions("10.0.0.3", {'can_chat': 0})
+        self.assertFalse(self.db.get_peer_permissions("10.0.0.3")['can_chat'])
+        self.db.touch_peer("10.0.0.3")
+        self.db.flush_peer_touches()
+        self.assertFalse(self.db.get_peer_permissions("10.0.0.3")['can_chat'])
+
+    def test_policy_table_is_write_through(self):
+        self.db.add_trusted_peer("10.0.0.4", "carol", "fp", trust_level="trusted")
+        self.db.update_peer_permissions("10.0.0.5", {'is_blocked': 1, 'can_chat': 0})
+        self.assertEqual(self.db.get_peer_trust_levels(["10.0.0.4", "10.0.0.5", "10.0.0.9"]),
+                         {"10.0.0.4": "trusted", "10.0.0.5": "untrusted"})
+        self.assertTrue(self.db.get_peer_permissions("10.0.0.5")['is_blocked'])
+        self.assertFalse(self.db.get_peer_permissions("10.0.0.4")['is_blocked'])
+        self.assertTrue(self.db.get_peer_permissions("10.0.0.9")['can_chat'])
+
+        self.db.unblock_peer("10.0.0.5")
+        self.db.update_peer_trust("10.0.0.4", "mismatch")
+        self.assertFalse(self.db.get_peers_permissions(["10.0.0.5"])["10.0.0.5"]['is_blocked'])
+
+        # A fresh load from disk matches what was served from memory
+        before = dict(self.db._peer_policies)
+        self.db._load_peer_policies()
+        self.assertEqual(self.db._peer_policies, before)
+        self.assertEqual(before["10.0.0.4"][5], "mismatch")
+
+
+if __name__ == "__main__":
+    unittest.main()
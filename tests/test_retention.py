@@ -0,0 +1,87 @@
+import os
+import time
+import unittest
+from db import Database
+from maintenance import retention_from_settings
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_retention.db"
+        self.key_file = ".test_retention.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def _receive(self, msg_id, timestamp, peer="10.0.0.2", content="hello", expires_at=None):
+        self.db.add_received_message(msg_id, "bob", content, timestamp, recipient=peer, expires_at=expires_at)
+
+    def _ids(self, peer="10.0.0.2"):
+        return [row[0] for row in self.db.get_messages(100, peer_ip=peer)]
+
+    def _summary(self, peer):
+        return next(conv for conv in self.db.get_conversations() if conv[0] == peer)
+
+    def test_count_limit_prunes_expired_first(self):
+        now = time.time()
+        for i in range(5):
+            self._receive(f"m{i}", now - 100 + i)
+        # Newest, but already past its TTL, so it goes before older live messages
+        self._receive("ttl", now, expires_at=now - 1)
+        self.db.delete_message("m0")
+
+        result = self.db.enforce_retention({'max_messages': 2})
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['conversations'], {"10.0.0.2"})
+        self.assertEqual(self._ids(), ["m3", "m4"])
+        # The tombstone is left for purge_tombstones
+        self.assertEqual(self.db.conn.execute("SELECT is_deleted FROM messages WHERE id = 'm0'").fetchone()[0], 1)
+        self.assertEqual(self._summary("10.0.0.2")[4], 2)
+
+    def test_age_and_override(self):
+        now = time.time()
+        self._receive("old", now - 3 * 86400)
+        self._receive("new", now)
+        self._receive("kept", now - 3 * 86400, peer="10.0.0.3")
+
+        result = self.db.enforce_retention({'max_age': 86400}, overrides={"10.0.0.3": {}})
+        self.assertEqual(result['age'], 1)
+        self.assertEqual(self._ids(), ["new"])
+        self.assertEqual(self._ids("10.0.0.3"), ["kept"])
+
+    def test_byte_limits(self):
+        now = time.time()
+        for i in range(10):
+            self._receive(f"a{i}", now - 50 + i, content="x" * 1000)
+            self._receive(f"b{i}", now - 20 + i, peer="10.0.0.3", content="y" * 1000)
+        size = self._summary("10.0.0.2")[5]
+        self.assertEqual(size, self.db.conn.execute(
+            "SELECT SUM(length(content)) FROM messages WHERE recipient = '10.0.0.2'").fetchone()[0])
+
+        self.db.enforce_retention({'max_bytes': size // 2}, overrides={"10.0.0.3": {}})
+        self.assertEqual(self._ids(), [f"a{i}" for i in range(5, 10)])
+        self.assertLessEqual(self._summary("10.0.0.2")[5], size // 2)
+
+        # The global cap takes the oldest messages across conversations
+        self.db.enforce_retention({}, max_total_bytes=size)
+        self.assertEqual(self._ids(), [])
+        self.assertEqual(len(self._ids("10.0.0.3")), 10)
+
+    def test_settings(self):
+        self.assertIsNone(retention_from_settings({"retention_max_messages": 0}))
+        retention = retention_from_settings({"retention_max_age_days": 1, "retention_total_mb": 1,
+                                             "retention_overrides": {"*": {"max_messages": 10}}})
+        self.assertEqual(retention['policy'], {'max_messages': 0, 'max_age': 86400, 'max_bytes': 0})
+        self.assertEqual(retention['overrides'][None]['max_messages'], 10)
+        self.assertEqual(retention['max_total_bytes'], 1024 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import time
+import unittest
+from db import Database
+from warmup import HistoryWarmup
+
+
+class TestHistoryWarmup(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_warmup.db"
+        self.key_file = ".test_warmup.key"
+        self._cleanup()
+        self.db = Database("pw", db_name=self.db_name, key_file=self.key_file)
+        self.db.add_message("me", "hello all")
+        now = time.time()
+        for i in range(4):
+            self.db.add_received_message(f"p{i}", "peer", "hi", now + i, recipient=f"10.0.0.{i + 2}")
+        self.db.add_file("doc.txt", "/tmp/doc.txt", 10, "127.0.0.1")
+        self.db.history.clear()
+        self.db.cipher.cache.wipe()
+
+    def tearDown(self):
+        self.db.close()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.db_name, self.key_file, self.db_name + "-wal", self.db_name + "-shm"):
+            if os.path.exists(f): os.remove(f)
+
+    def test_preloads_recent_conversations(self):
+        warmup = HistoryWarmup(self.db, private_conversations=2)
+        order = [name for name, _ in warmup._tasks("10.0.0.2")]
+        # Focus first, then the two most recently active chats
+        self.assertEqual(order, ["10.0.0.2", "global", "files", "10.0.0.5", "10.0.0.4"])
+
+        warmup.start("files")
+        warmup._thread.join(5)
+        self.assertIsNotNone(self.db.history.get(None, 200))
+        self.assertIsNotNone(self.db.history.get("10.0.0.5", 100))
+        self.assertIsNone(self.db.history.get("10.0.0.2", 100))
+        self.assertGreater(self.db.cipher.cache.stats()['entries'], 0)
+
+    def test_locked_database_is_not_loaded(self):
+        self.db.lock_db()
+        warmup = HistoryWarmup(self.db)
+        warmup.start()
+        warmup._thread.join(5)
+        self.assertIsNone(self.db.history.get(None, 200))
+
+
+if __name__ == '__main__':
+    unittest.main()
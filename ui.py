@@ -7,6 +7,8 @@ import threading
 import time
 import shutil
 import json
+import csv
+import itertools
 import audit
 import ssl_utils
 import security_engine
@@ -14,11 +16,32 @@ import pyotp
 import qrcode
 from PIL import ImageTk
 from concurrent.futures import ThreadPoolExecutor
-from db import Database
+from db import Database, THREAT_EVENTS
+from expiry import ExpiryScheduler
+from maintenance import MaintenanceScheduler, retention_from_settings
+from backup import BackupScheduler
+from warmup import HistoryWarmup
 from network import NetworkManager, DiscoveryManager
 from file_transfer import FileTransferManager
 from config import load_settings, save_settings
 
+ALL_EVENTS = "All events"
+AUDIT_PAGE_SIZE = 200
+# Audit event type -> Textbox tag
+AUDIT_TAGS = {
+    "SECURITY_ALERT": "alert",
+    "FILE_INTEGRITY_FAILURE": "alert",
+    "AUTH_FAILURE": "warning",
+    "FILE_TRANSFER": "info",
+    "FILE_INTEGRITY_SUCCESS": "info",
+    "CONNECTION": "info",
+    "APP_START": "info",
+    "DATA_RETENTION": "info",
+    "SETTINGS_CHANGE": "info",
+    "TOFU_TRUST": "info",
+    "SECURITY_INFO": "info"
+}
+
 class MasterPasswordDialog(ctk.CTkToplevel):
     def __init__(self, parent, callback):
         super().__init__(parent)
@@ -306,6 +329,10 @@ class LockScreen(ctk.CTkFrame):
         self.btn = ctk.CTkButton(inner_frame, text="Unlock", command=self.attempt_unlock)
         self.btn.pack(pady=20)
 
+        # Shown while the key derivation runs on a worker thread
+        self.progress = ctk.CTkProgressBar(inner_frame, mode="indeterminate", width=250)
+        self._busy = False
+
         if self.db.needs_setup():
             self.title_label.configure(text="Initial Security Setup")
             self.info_label.configure(text="Create a Master Password to protect your database")
@@ -315,16 +342,54 @@ class LockScreen(ctk.CTkFrame):
 
     def attempt_unlock(self):
         password = self.password_entry.get()
-        if not password:
+        if not password or self._busy:
             return
 
-        if self.db.needs_setup():
-            self.db.setup(password)
+        # Key derivation takes about a second; keep the Tk thread free meanwhile
+        self._set_busy(True)
+        setup = self.db.needs_setup()
+
+        def worker():
+            try:
+                if setup:
+                    self.db.setup(password)
+                    ok = True
+                else:
+                    ok = self.db.unlock(password)
+                error = None
+            except Exception as e:
+                print(f"[DEBUG] Unlock failed: {e}")
+                ok, error = False, e
+            self.after(0, lambda: self._finish_unlock(ok, setup, error))
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _set_busy(self, busy):
+        self._busy = busy
+        state = "disabled" if busy else "normal"
+        self.btn.configure(state=state)
+        self.password_entry.configure(state=state)
+        if busy:
+            self.info_label.configure(text="Unlocking...", text_color=("gray10", "gray90"))
+            self.progress.pack(pady=(0, 20))
+            self.progress.start()
+        else:
+            self.progress.stop()
+            self.progress.pack_forget()
+
+    def _finish_unlock(self, ok, setup, error=None):
+        if not self.winfo_exists():
+            return
+        self._set_busy(False)
+        if error is not None:
+            # The screen stays usable, so the user can try again
+            self.info_label.configure(text=f"Unlock failed: {error}", text_color="red")
+            self.password_entry.delete(0, "end")
+        elif setup:
             audit.get_logger().log("MASTER_PASSWORD_SETUP", "Initial master password configured.")
             self.on_unlock()
             self.destroy()
         else:
-            if self.db.unlock(password):
+            if ok:
                 # Check MFA if enabled
                 if self.mfa_enabled:
                     mfa_code = self.mfa_entry.get().strip()
@@ -382,7 +447,10 @@ class LANMessengerApp(ctk.CTk):
                 return
 
             try:
-                self.db = Database(password)
+                self.db = self._run_in_background(
+                    lambda: Database(password, migration_callback=self._on_migration_progress,
+                                     session_minutes=self.settings.get("session_unlock_minutes", 0)),
+                    "Unlocking database...")
                 self._master_password = password
                 break
             except ValueError as e:
@@ -413,6 +481,7 @@ class LANMessengerApp(ctk.CTk):
             bind_ip=self.settings.get("bind_ip", "0.0.0.0"),
             auth_token=self.settings.get("auth_token") or None,
             allowed_ips=self.settings.get("allowed_ips") or None,
+            download_streams=self.settings.get("download_streams", 4),
         )
         self.network = NetworkManager(
             self.db,
@@ -448,6 +517,10 @@ class LANMessengerApp(ctk.CTk):
         self.create_sidebar()
         self.create_main_area()
 
+        # Decrypt recent history in the background so first renders skip SQL and AES-GCM
+        self.warmup = HistoryWarmup(self.db, self.settings.get("warmup_conversations", 5))
+        self.warmup.start(self._warmup_focus())
+
         # App Locking
         self.lock_screen = None
         self.check_lock()
@@ -468,9 +541,32 @@ class LANMessengerApp(ctk.CTk):
         self.bind_all("<KeyPress>", self._update_activity)
         self.bind_all("<Button>", self._update_activity)
 
-        # Start Message Reaper
-        self.reaper_thread = threading.Thread(target=self.message_reaper_loop, daemon=True)
-        self.reaper_thread.start()
+        # Start Expiry Scheduler (wakes exactly when the next message/file share expires)
+        self.expiry = ExpiryScheduler(self.db, on_expired=lambda convs, files: self.after(0, lambda: self._refresh_after_reap(convs, files)))
+        self.expiry.start()
+
+        # Database housekeeping while the user is away
+        idle_after = self.settings.get("maintenance_idle_seconds", 120)
+        self.audit_archive = audit.AuditArchive()
+        self.maintenance = MaintenanceScheduler(self.db, lambda: time.time() - self._last_activity > idle_after,
+                                                self.settings.get("tombstone_retention_days", 7),
+                                                audit_archive=self.audit_archive,
+                                                audit_retention_days=self.settings.get("audit_retention_days", 90),
+                                                audit_max_rows=self.settings.get("audit_max_rows", 50000),
+                                                retention=retention_from_settings(self.settings),
+                                                on_pruned=lambda convs: self.after(0, lambda: self._refresh_after_reap(convs, 0)))
+        self.maintenance.start()
+
+        self.backups = BackupScheduler(self.db, self.settings.get("backup_dir", "backups"),
+                                       self.settings.get("backup_interval_hours", 24),
+                                       self.settings.get("backup_keep", 7))
+        self.backups.start()
+
+        # Finish a key rotation interrupted by a crash or shutdown
+        self._rekey_stop = threading.Event()
+        self._rekey_thread = None
+        if self.db.key_rotation_pending():
+            self.start_key_rotation()
 
         # Start inactivity checker
         self.after(10000, self._check_inactivity)
@@ -480,44 +576,106 @@ class LANMessengerApp(ctk.CTk):
 
     def _check_inactivity(self):
         if time.time() - self._last_activity > self._lock_timeout:
-            self.lock_app()
+            self._on_inactivity()
         self.after(10000, self._check_inactivity)
 
+    def _on_migration_progress(self, step, done, total):
+        """Shows background database upgrade progress in the window title (called from a worker thread)."""
+        def update():
+            if not self.winfo_exists():
+                return
+            if total and done < total:
+                self.title(f"LAN Messenger - Upgrading database ({done * 100 // total}%)")
+            else:
+                self.title("LAN Messenger")
+        self.after(0, update)
+
+    def start_key_rotation(self):
+        """Rotates the data key (or resumes a rotation) on a background thread."""
+        if self._rekey_thread is not None and self._rekey_thread.is_alive():
+            if not self._rekey_stop.is_set():
+                return
+            # A run stopped by a lock exits at its next batch
+            self._rekey_thread.join(timeout=5)
+            if self._rekey_thread.is_alive():
+                return
+        self._rekey_stop = stop = threading.Event()
+        resuming = self.db.key_rotation_pending()
+        self.logger.log("KEY_ROTATION", "Resuming interrupted key rotation." if resuming else "Data key rotation started.")
+
+        def run():
+            try:
+                count = self.db.rekey(stop_event=stop,
+                                      progress_callback=lambda done, total: self._on_rekey_progress(done, total))
+                if not stop.is_set() and not self.db.is_locked():
+                    self.logger.log("KEY_ROTATION", f"Data key rotation finished: {count} values re-encrypted.")
+            except Exception as e:
+                print(f"[DEBUG] Key rotation failed: {e}")
+                self.logger.log("KEY_ROTATION", f"Data key rotation failed: {e}")
+            self._on_rekey_progress(1, 1)
+
+        self._rekey_thread = threading.Thread(target=run, daemon=True)
+        self._rekey_thread.start()
+
+    def _on_rekey_progress(self, done, total):
+        """Shows key rotation progress in the window title (called from a worker thread)."""
+        def update():
+            if not self.winfo_exists():
+                return
+            if total and done < total:
+                self.title(f"LAN Messenger - Rotating encryption key ({done * 100 // total}%)")
+            else:
+                self.title("LAN Messenger")
+        self.after(0, update)
+
+    def _run_in_background(self, func, message):
+        """Runs *func* on a worker thread behind a small progress window, pumping the Tk
+        event loop until it finishes. Returns its result or re-raises its exception."""
+        result = {}
+
+        def run():
+            try:
+                result['value'] = func()
+            except Exception as e:
+                result['error'] = e
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+
+        dialog = ctk.CTkToplevel(self)
+        dialog.title("LAN Messenger")
+        dialog.geometry("300x100")
+        dialog.resizable(False, False)
+        ctk.CTkLabel(dialog, text=message).pack(pady=(20, 10))
+        bar = ctk.CTkProgressBar(dialog, mode="indeterminate", width=240)
+        bar.pack()
+        bar.start()
+        while worker.is_alive():
+            self.update()
+            worker.join(0.02)
+        bar.stop()
+        dialog.destroy()
+
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
     def _prompt_password(self):
         pw_dialog = PasswordDialog(self)
         return pw_dialog.result
 
-    def _refresh_after_reap(self):
-        """Thread-safe UI refresh after background reaping."""
+    def _refresh_after_reap(self, conversations, file_count):
+        """Thread-safe UI refresh after background reaping; only touches the visible view if it was affected."""
         if not self.winfo_exists():
             return
-        # Only refresh visible chat tabs to save resources
         current_tab = self.tabview.get()
         if current_tab == "Global Chat":
-            self.load_chat_history(debounce=True)
+            if None in conversations:
+                self.load_chat_history(debounce=True)
         elif current_tab.startswith("Chat: "):
-            if self.current_private_peer:
+            if self.current_private_peer and self.current_private_peer in conversations:
                 self.load_private_chat(self.current_private_peer)
-
-    def message_reaper_loop(self):
-        """Background thread for periodic database maintenance (runs every 15s)."""
-        while True:
-            try:
-                # Reap messages and files in background
-                msg_count = self.db.reap_expired_messages()
-                file_count = self.db.delete_expired_files()
-
-                if msg_count > 0 or file_count > 0:
-                    if msg_count > 0:
-                        self.logger.log("DATA_RETENTION", f"Automatically reaped {msg_count} expired messages.")
-                    if file_count > 0:
-                        self.logger.log("DATA_RETENTION", f"Automatically reaped {file_count} expired file shares.")
-
-                    # Schedule UI refresh on main thread
-                    self.after(0, lambda: self._refresh_after_reap(msg_count))
-            except Exception as e:
-                print(f"[DEBUG] Reaper error: {e}")
-            time.sleep(15)
+        elif current_tab == "Files" and file_count:
+            self.refresh_files_view()
 
     def prompt_username(self):
         dialog = ctk.CTkInputDialog(text="Enter your username:", title="Set Username")
@@ -730,6 +888,18 @@ class LANMessengerApp(ctk.CTk):
         self.refresh_audit_btn = ctk.CTkButton(self.audit_controls, text="Refresh Logs", command=self.refresh_audit_view)
         self.refresh_audit_btn.pack(side="left", padx=10, pady=5)
 
+        self.audit_event_filter = ctk.CTkOptionMenu(self.audit_controls, values=[ALL_EVENTS], width=170,
+                                                    command=lambda _: self.load_audit_logs())
+        self.audit_event_filter.pack(side="left", padx=5, pady=5)
+
+        self.audit_ip_filter = ctk.CTkEntry(self.audit_controls, placeholder_text="Filter by IP", width=130)
+        self.audit_ip_filter.pack(side="left", padx=5, pady=5)
+        self.audit_ip_filter.bind("<Return>", lambda e: self.load_audit_logs())
+
+        self.audit_more_btn = ctk.CTkButton(self.audit_controls, text="Load More", width=90, command=self.load_more_audit_logs, state="disabled")
+        self.audit_more_btn.pack(side="left", padx=5, pady=5)
+        self._audit_cursor = None  # id of the oldest row shown
+
         self.export_audit_btn = ctk.CTkButton(self.audit_controls, text="Export Logs (SOC 2)", command=self.export_audit_logs, fg_color="#34495e")
         self.export_audit_btn.pack(side="right", padx=10, pady=5)
 
@@ -748,6 +918,12 @@ class LANMessengerApp(ctk.CTk):
         self.block_label = ctk.CTkLabel(self.sec_stats_frame, text="Active IP Blocks: 0", font=("Arial", 14, "bold"))
         self.block_label.grid(row=0, column=1, pady=10)
 
+        self.trend_label = ctk.CTkLabel(self.sec_stats_frame, text="Last 24h: 0", font=("Arial", 12))
+        self.trend_label.grid(row=1, column=0, pady=(0, 10))
+
+        self.top_ips_label = ctk.CTkLabel(self.sec_stats_frame, text="Top sources: none", font=("Arial", 12))
+        self.top_ips_label.grid(row=1, column=1, pady=(0, 10))
+
         # Blocked Peers List
         self.blocked_scroll = ctk.CTkScrollableFrame(self.security_tab, label_text="Currently Blocked Peers")
         self.blocked_scroll.grid(row=1, column=0, padx=10, pady=10, sticky="nsew")
@@ -761,53 +937,68 @@ class LANMessengerApp(ctk.CTk):
                 self.refresh_audit_btn.configure(text="Refresh Logs", fg_color=("#3B8ED0", "#1F6AA5"))
         self.after(2000, reset)
 
+    def _audit_filters(self) -> dict:
+        event_type = self.audit_event_filter.get()
+        return {
+            'event_type': None if event_type == ALL_EVENTS else event_type,
+            'ip_address': self.audit_ip_filter.get().strip() or None,
+        }
+
     def export_audit_logs(self):
-        logs = self.db.get_audit_logs(1000)
-        try:
-            with open("audit_export.txt", "w", encoding="utf-8") as f:
-                f.write("LAN Messenger Security Audit Log Export\n")
-                f.write("======================================\n")
-                for log in logs:
-                    ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(log[3]))
-                    ip = log[4] or "N/A"
-                    f.write(f"[{ts}] [{ip}] {log[1]}: {log[2]}\n")
-            messagebox.showinfo("Export Successful", "Audit logs exported to audit_export.txt")
-            self.logger.log("AUDIT_EXPORT", "Audit logs exported to file.")
-        except Exception as e:
-            messagebox.showerror("Export Failed", f"Could not export logs: {e}")
+        path = filedialog.asksaveasfilename(title="Export Audit Log", initialfile="audit_export.csv", defaultextension=".csv",
+                                            filetypes=[("CSV", "*.csv"), ("JSON Lines", "*.jsonl")])
+        if not path:
+            return
+        filters = self._audit_filters()
+        self.export_audit_btn.configure(state="disabled", text="Exporting...")
+
+        # The archive can be large; stream it on a worker thread and report back on the Tk thread
+        def run():
+            count = 0
+            try:
+                with open(path, "w", encoding="utf-8", newline="") as f:
+                    as_jsonl = path.lower().endswith(".jsonl")
+                    writer = None if as_jsonl else csv.writer(f)
+                    if writer:
+                        writer.writerow(["id", "timestamp", "time", "event_type", "ip_address", "details"])
+                    # Archived segments first, then the live table, both streamed oldest first
+                    for log in itertools.chain(self.audit_archive.iter_records(**filters), self.db.iter_audit_logs(**filters)):
+                        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(log[3]))
+                        if as_jsonl:
+                            f.write(json.dumps({'id': log[0], 'timestamp': log[3], 'time': ts, 'event_type': log[1],
+                                                'ip_address': log[4], 'details': log[2]}) + "\n")
+                        else:
+                            writer.writerow([log[0], log[3], ts, log[1], log[4] or "", log[2]])
+                        count += 1
+                self.logger.log("AUDIT_EXPORT", f"{count} audit records exported to file.")
+                error = None
+            except Exception as e:
+                error = e
+            self.after(0, lambda: self._finish_audit_export(path, count, error))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _finish_audit_export(self, path, count, error):
+        if not self.winfo_exists():
+            return
+        self.export_audit_btn.configure(state="normal", text="Export Logs (SOC 2)")
+        if error is not None:
+            messagebox.showerror("Export Failed", f"Could not export logs: {error}")
+        else:
+            messagebox.showinfo("Export Successful", f"{count} audit records exported to {path}")
 
     def load_audit_logs(self):
         if not self.winfo_exists() or self.tabview.get() != "Audit Logs":
             return
-        logs = self.db.get_audit_logs(200)
+        event_types = sorted(self.db.get_event_counts())
+        self.audit_event_filter.configure(values=[ALL_EVENTS] + event_types)
+
+        logs = self.db.query_audit_logs(limit=AUDIT_PAGE_SIZE, **self._audit_filters())
         self.audit_display.configure(state="normal")
         self.audit_display.delete("1.0", "end")
-
         if not logs:
             self.audit_display.insert("end", "\n\nNo audit logs found.", "center")
-        else:
-            # Event type mapping to semantic tags
-            tag_map = {
-                "SECURITY_ALERT": "alert",
-                "FILE_INTEGRITY_FAILURE": "alert",
-                "AUTH_FAILURE": "warning",
-                "FILE_TRANSFER": "info",
-                "FILE_INTEGRITY_SUCCESS": "info",
-                "CONNECTION": "info",
-                "APP_START": "info",
-                "DATA_RETENTION": "info",
-                "SETTINGS_CHANGE": "info",
-                "TOFU_TRUST": "info",
-                "SECURITY_INFO": "info"
-            }
-
-            for log in logs:
-                # log: (id, event_type, details, timestamp)
-                event_type = log[1]
-                ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(log[3]))
-                tag = tag_map.get(event_type, "")
-                self.audit_display.insert("end", f"[{ts}] {event_type}: {log[2]}\n", tag)
-
+        self._append_audit_page(logs)
         self.audit_display.configure(state="disabled")
         self.audit_display.see("1.0")
 
@@ -816,6 +1007,30 @@ class LANMessengerApp(ctk.CTk):
         self.refresh_audit_btn.configure(text="Refreshed", fg_color="#2ecc71")
         self.after(1500, lambda: self.refresh_audit_btn.configure(text="Refresh Logs", fg_color=original_fg) if self.refresh_audit_btn.winfo_exists() else None)
 
+    def load_more_audit_logs(self):
+        if self._audit_cursor is None:
+            return
+        logs = self.db.query_audit_logs(before_id=self._audit_cursor, limit=AUDIT_PAGE_SIZE, **self._audit_filters())
+        self.audit_display.configure(state="normal")
+        self._append_audit_page(logs)
+        self.audit_display.configure(state="disabled")
+
+    def _append_audit_page(self, logs):
+        """Appends one page of rows, one insert per run of rows with the same tag. Textbox must be writable."""
+        runs = []  # [text, tag]
+        for log in logs:
+            ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(log[3]))
+            line, tag = f"[{ts}] {log[1]}: {log[2]}\n", AUDIT_TAGS.get(log[1])
+            if runs and runs[-1][1] == tag:
+                runs[-1][0] += line
+            else:
+                runs.append([line, tag])
+        for text, tag in runs:
+            self.audit_display.insert("end", text, tag)
+        # A short page means the end of the log was reached
+        self._audit_cursor = logs[-1][0] if len(logs) == AUDIT_PAGE_SIZE else None
+        self.audit_more_btn.configure(state="normal" if self._audit_cursor is not None else "disabled")
+
     def update_username(self, event=None):
         new_name = self.username_entry.get().strip()
         if new_name and new_name != self.username:
@@ -855,11 +1070,15 @@ class LANMessengerApp(ctk.CTk):
         for ip in self.peers:
             self.peer_trust[ip] = trust_levels.get(ip, 'untrusted')
 
-        # Also include blocked status in snapshot for UI refreshes
-        all_perms = self.db.get_peers_permissions(list(self.peers.keys()))
+        # Unread counts and recency come from the incrementally maintained conversation summaries
+        conversations = {c[0]: c for c in self.db.get_conversations() if c[0] is not None}
+        unread = {ip: conversations[ip][3] for ip in self.peers if ip in conversations}
+        # Most recently active conversations first, peers we never talked to last
+        ordered = sorted(self.peers, key=lambda ip: -(conversations[ip][2] or 0) if ip in conversations else 0)
 
         # Prevent unnecessary UI rebuilds using snapshot comparison
-        current_snapshot = json.dumps({"peers": self.peers, "trust": self.peer_trust, "perms": all_perms}, sort_keys=True)
+        current_snapshot = json.dumps({"peers": self.peers, "trust": self.peer_trust, "perms": all_perms,
+                                       "unread": unread, "order": ordered}, sort_keys=True)
         if current_snapshot == self._last_peers_snapshot:
             self.after(2000, self.refresh_peers)
             return
@@ -873,7 +1092,8 @@ class LANMessengerApp(ctk.CTk):
             lbl = ctk.CTkLabel(self.peers_scroll, text="No peers found yet...", font=("Arial", 11, "italic"), text_color="gray")
             lbl.pack(pady=20)
 
-        for ip, name in self.peers.items():
+        for ip in ordered:
+            name = self.peers[ip]
             perms = all_perms.get(ip, {})
             is_blocked = perms.get('is_blocked', False)
             is_verified = perms.get('is_verified', False)
@@ -894,6 +1114,12 @@ class LANMessengerApp(ctk.CTk):
                 v_lbl = ctk.CTkLabel(row, text="✓", text_color="#2ecc71", font=("Arial", 12, "bold"), width=15)
                 v_lbl.pack(side="left", padx=2)
 
+            # Unread badge
+            if unread.get(ip):
+                badge = ctk.CTkLabel(row, text=str(unread[ip]), fg_color="#e74c3c", text_color="white",
+                                     corner_radius=8, font=("Arial", 10, "bold"), width=20)
+                badge.pack(side="left", padx=2)
+
             # Security button
             btn_sec = ctk.CTkButton(row, text="Sec", width=35, height=20, fg_color="#555555",
                               command=lambda i=ip, n=name: PeerSecurityDialog(self, self.db, i, n, self.refresh_peers))
@@ -979,10 +1205,17 @@ class LANMessengerApp(ctk.CTk):
         if not self.winfo_exists() or self.tabview.get() != "Security":
             return
 
-        # Update Stats
-        logs = self.db.get_audit_logs(1000)
-        suspicious = [l for l in logs if l[1] in ('AUTH_FAILURE', 'SECURITY_ALERT', 'UNAUTHORIZED_ACCESS', 'PROTOCOL_VIOLATION', 'IPS_AUTO_BLOCK')]
-        self.threat_label.configure(text=f"Total Threats Intercepted: {len(suspicious)}")
+        # Update Stats (from the running aggregates, not the log itself)
+        threats = sum(self.db.get_event_counts(THREAT_EVENTS).values())
+        self.threat_label.configure(text=f"Total Threats Intercepted: {threats}")
+
+        trend = self.db.get_hourly_trend(THREAT_EVENTS, hours=24)
+        peak = max(trend) or 1
+        sparkline = "".join("▁▂▃▄▅▆▇█"[min(7, count * 8 // (peak + 1))] if count else " " for count in trend)
+        self.trend_label.configure(text=f"Last 24h: {sum(trend)}  {sparkline}")
+
+        top = self.db.get_top_ips(THREAT_EVENTS, limit=3)
+        self.top_ips_label.configure(text="Top sources: " + (", ".join(f"{ip} ({n})" for ip, n in top) or "none"))
 
         blocked = self.db.get_blocked_peers()
         self.block_label.configure(text=f"Active IP Blocks: {len(blocked)}")
@@ -1102,6 +1335,7 @@ class LANMessengerApp(ctk.CTk):
 
         self.chat_display.configure(state="disabled")
         self.chat_display.see("end")
+        self.db.mark_conversation_read(None)
 
     def _get_ttl_seconds(self, var=None):
         val = var.get() if var else self.ttl_var.get()
@@ -1238,6 +1472,7 @@ class LANMessengerApp(ctk.CTk):
 
         display.configure(state="disabled")
         display.see("end")
+        self.db.mark_conversation_read(peer_ip)
 
     def show_context_menu(self, event):
         self.context_menu.tk_popup(event.x_root, event.y_root)
@@ -1284,10 +1519,12 @@ class LANMessengerApp(ctk.CTk):
         if path:
             filename = os.path.basename(path)
             size = os.path.getsize(path)
-            checksum = FileTransferManager.calculate_sha256(path)
+            # One pass gives the checksum and the chunk hashes peers verify downloads against
+            checksum, chunk_hashes = FileTransferManager.hash_for_sharing(path)
             local_ip = socket.gethostbyname(socket.gethostname())
             ttl = self._get_ttl_seconds(var=self.file_ttl_var)
-            self.db.add_file(filename, path, size, local_ip, is_folder=False, checksum=checksum, ttl=ttl)
+            self.db.add_file(filename, path, size, local_ip, is_folder=False, checksum=checksum, ttl=ttl,
+                             chunk_hashes=chunk_hashes)
             self.current_file_view_source = "Local"
             self.source_label.configure(text="Viewing: Local Shared Files")
             self.refresh_files_view()
@@ -1446,16 +1683,22 @@ class LANMessengerApp(ctk.CTk):
         items = [(var, f) for var, f in self.file_checkboxes if var.get() == 1]
         if not items: return
 
+        # Other peers sharing identical content can serve parts of large files
+        perms = self.db.get_peers_permissions(list(self.peers))
+        swarm_peers = [ip for ip in self.peers if ip != target_ip and not perms.get(ip, {}).get('is_blocked')]
+
         def worker():
             self.after(0, lambda: self.overall_progress.set(0))
             self.after(0, lambda: self.file_progress.set(0))
 
+            # Selected files share one pipelined session; each folder gets its own
+            files = [f for var, f in items if not f.get('is_folder')]
+            if files:
+                self.file_manager.download_files(target_ip, files, progress_callback=self._download_progress,
+                                                 swarm_peers=swarm_peers)
             for var, f in items:
                 if f.get('is_folder'):
                     self.file_manager.download_folder(target_ip, f['path'], progress_callback=self._download_progress)
-                else:
-                    self.file_manager.download_file(target_ip, f['path'], expected_checksum=f.get('checksum'))
-                    self.after(0, lambda p=f['filename']: self.progress_file_lbl.configure(text=f"Downloaded {p}"))
 
             def reset():
                 if self.download_btn.winfo_exists():
@@ -1500,14 +1743,26 @@ class LANMessengerApp(ctk.CTk):
                 self.lock_screen.destroy()
                 self.lock_screen = None
 
+    def _warmup_focus(self):
+        """What the visible tab shows, in HistoryWarmup.start terms."""
+        tab = self.tabview.get()
+        if tab == "Files":
+            return 'files'
+        return self.private_chat_tabs.get(tab, 'global')
+
     def after_unlock(self):
         self.lock_screen = None
+        self.warmup.start(self._warmup_focus())
         self.load_chat_history()
         self.refresh_peers()
         self._reset_lock_timer()
+        if self.db.key_rotation_pending():
+            self.start_key_rotation()  # Stopped by the lock; continues from its saved position
 
     def lock_app(self):
         if not self.db.is_locked():
+            self._rekey_stop.set()
+            self.warmup.cancel()
             self.db.lock_db()
             self.logger.log("APP_LOCKED", "Application manually locked.")
             self.check_lock()
@@ -1520,7 +1775,10 @@ class LANMessengerApp(ctk.CTk):
 
     def _on_inactivity(self):
         if not self.db.is_locked():
-            self.db.lock_db()
+            # Session unlock: coming back within session_unlock_minutes restores the keys from memory
+            self._rekey_stop.set()
+            self.warmup.cancel()
+            self.db.lock_db(keep_session=True)
             self.logger.log("APP_LOCKED", "Application locked due to inactivity.")
             self.check_lock()
 
@@ -1549,6 +1807,23 @@ class LANMessengerApp(ctk.CTk):
         entry_file.insert(0, str(self.settings["tcp_file_port"]))
         entry_file.pack(pady=5)
 
+        if self.db.needs_vacuum_conversion():
+            # Older databases only return free space to the disk after a one-off full rewrite
+            def compact():
+                if not messagebox.askyesno("Compact Database", "Rewrite the database so deleted data can be reclaimed "
+                                                               "automatically?\n\nChat is paused until it finishes."):
+                    return
+                try:
+                    self._run_in_background(self.db.enable_incremental_vacuum, "Compacting database...")
+                except Exception as e:
+                    messagebox.showerror("Error", f"Compacting failed: {e}")
+                    return
+                self.logger.log("DB_MAINTENANCE", "Database converted to incremental vacuum.")
+                compact_btn.configure(text="Database Compacted", state="disabled")
+
+            compact_btn = ctk.CTkButton(gen_tab, text="Compact Database", command=compact)
+            compact_btn.pack(pady=(15, 0))
+
         # -- Security Tab --
         ctk.CTkLabel(sec_tab, text="Multi-Factor Authentication (MFA)", font=("Arial", 14, "bold")).pack(pady=10)
 
@@ -1588,6 +1863,17 @@ class LANMessengerApp(ctk.CTk):
         mfa_btn = ctk.CTkButton(sec_tab, text=mfa_btn_text, fg_color=mfa_btn_color, command=toggle_mfa)
         mfa_btn.pack(pady=20)
 
+        ctk.CTkLabel(sec_tab, text="Data Encryption Key", font=("Arial", 14, "bold")).pack(pady=10)
+
+        def rotate_key():
+            if messagebox.askyesno("Rotate Key", "Generate a new data encryption key and re-encrypt all stored data?\n\n"
+                                                 "This runs in the background; chat stays available."):
+                self.start_key_rotation()
+                rotate_btn.configure(text="Rotation Started", state="disabled")
+
+        rotate_btn = ctk.CTkButton(sec_tab, text="Rotate Encryption Key", command=rotate_key)
+        rotate_btn.pack(pady=5)
+
         def save(event=None):
             try:
                 self.settings["tcp_chat_port"] = int(entry_chat.get())
@@ -1606,6 +1892,18 @@ class LANMessengerApp(ctk.CTk):
         self.after(200, lambda: entry_chat.focus_set())
 
     def on_closing(self):
+        if hasattr(self, '_rekey_stop'):
+            self._rekey_stop.set()  # Resumes from its saved position next start
+            if self._rekey_thread is not None:
+                self._rekey_thread.join(timeout=5)
+        if hasattr(self, 'expiry'):
+            self.expiry.stop()
+        if hasattr(self, 'warmup'):
+            self.warmup.cancel()
+        if hasattr(self, 'maintenance'):
+            self.maintenance.stop()
+        if hasattr(self, 'backups'):
+            self.backups.stop()
         if hasattr(self, 'discovery'):
             self.discovery.stop()
         if hasattr(self, 'network'):
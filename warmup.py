@@ -0,0 +1,58 @@
+import threading
+import time
+
+
+class HistoryWarmup:
+    """Preloads chat history and the share catalog after unlock, off the Tk thread.
+
+    The most recent page of the global chat, the most recently active private
+    conversations and the local share catalog are read (and so decrypted) into the
+    history and decrypt caches, starting with whatever the visible tab shows. A run is
+    cancelled by cancel() or a later start(), and stops on its own if the database locks.
+    """
+    # Pages requested by the chat views, so the warmed windows answer their first render
+    GLOBAL_PAGE = 200
+    PRIVATE_PAGE = 100
+
+    def __init__(self, db, private_conversations: int = 5):
+        self.db = db
+        self.private_conversations = private_conversations
+        self._cancel = threading.Event()
+        self._thread = None
+
+    def start(self, focus=None):
+        """Starts a new run. *focus* is 'global', 'files' or a peer IP; it is loaded first."""
+        self.cancel()
+        cancel = self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(focus, cancel), daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _tasks(self, focus):
+        tasks = [('global', lambda: self.db.get_messages(self.GLOBAL_PAGE)),
+                 ('files', self.db.get_files)]
+        # get_conversations is ordered by most recent activity
+        peers = [conv[0] for conv in self.db.get_conversations() if conv[0] is not None][:self.private_conversations]
+        if focus not in ('global', 'files', None) and focus not in peers:
+            peers.append(focus)
+        for peer in peers:
+            tasks.append((peer, lambda p=peer: self.db.get_messages(self.PRIVATE_PAGE, peer_ip=p)))
+        # Whatever the user is looking at goes first
+        tasks.sort(key=lambda task: task[0] != focus)
+        return tasks
+
+    def _run(self, focus, cancel):
+        start = time.perf_counter()
+        done = 0
+        try:
+            for name, load in self._tasks(focus):
+                if cancel.is_set() or self.db.is_locked():
+                    break
+                load()
+                done += 1
+        except Exception as e:
+            # A lock racing a load makes decryption fail; the next unlock starts over
+            print(f"[DEBUG] History warm-up stopped: {e}")
+        print(f"[DEBUG] History warm-up loaded {done} views in {time.perf_counter() - start:.2f}s")